@@ -1,4 +1,5 @@
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 import os
@@ -22,10 +23,64 @@ def create_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
+    # Reverse proxies (nginx, a load balancer) in front of the app; their X-Forwarded-For/-Proto/-Host
+    # headers are trusted so request.remote_addr is the client, as the login throttle needs. 0 = none
+    app.config['PROXY_FIX_HOPS'] = int(os.getenv('PROXY_FIX_HOPS', 0))
+    if app.config['PROXY_FIX_HOPS'] > 0:
+        hops = app.config['PROXY_FIX_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    # 'sync' sends the STK push inside the request, 'async' queues it and returns 202
+    app.config['STK_DISPATCH_MODE'] = os.getenv('STK_DISPATCH_MODE', 'sync')
+    # 'sync' applies each M-Pesa callback in the request, 'batch' spools and applies them in bulk
+    app.config['CALLBACK_INGEST_MODE'] = os.getenv('CALLBACK_INGEST_MODE', 'sync')
+    app.config['CALLBACK_BATCH_SIZE'] = int(os.getenv('CALLBACK_BATCH_SIZE', 200))
+    app.config['CALLBACK_FLUSH_INTERVAL'] = float(os.getenv('CALLBACK_FLUSH_INTERVAL', 0.5))
+    app.config['CALLBACK_SPOOL_DIR'] = os.getenv('CALLBACK_SPOOL_DIR', os.path.join(app.instance_path, 'callback-spool'))
+    app.config['CALLBACK_SPOOL_FSYNC'] = os.getenv('CALLBACK_SPOOL_FSYNC', '1') == '1'
+    # Seconds between rollup compactions; 0 leaves it to `flask compact-rollups` (cron)
+    app.config['ROLLUP_COMPACT_INTERVAL'] = float(os.getenv('ROLLUP_COMPACT_INTERVAL', 30))
+    # Pending contributions older than RECONCILE_AFTER seconds are checked with STK Push Query
+    # every RECONCILE_INTERVAL seconds (0 = only via `flask reconcile-pending`)
+    app.config['RECONCILE_INTERVAL'] = float(os.getenv('RECONCILE_INTERVAL', 0))
+    app.config['RECONCILE_AFTER'] = int(os.getenv('RECONCILE_AFTER', 120))
+    app.config['RECONCILE_EXPIRE_AFTER'] = int(os.getenv('RECONCILE_EXPIRE_AFTER', 3600))
+    app.config['RECONCILE_BATCH'] = int(os.getenv('RECONCILE_BATCH', 200))
+    app.config['RECONCILE_WORKERS'] = int(os.getenv('RECONCILE_WORKERS', 4))
+    app.config['RECONCILE_QPS'] = float(os.getenv('RECONCILE_QPS', 5))
+    # ASGI mode (asgi.py): threads for database work, cap on STK pushes awaiting Safaricom, httpx pool size
+    app.config['ASGI_DB_THREADS'] = int(os.getenv('ASGI_DB_THREADS', 16))
+    app.config['ASGI_MAX_STK_PUSHES'] = int(os.getenv('ASGI_MAX_STK_PUSHES', 2000))
+    app.config['MPESA_ASYNC_POOL_SIZE'] = int(os.getenv('MPESA_ASYNC_POOL_SIZE', 200))
+    # `flask archive-history` moves events closed this many days, and callbacks this old, to the archive tables
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+    app.config['CALLBACK_RETENTION_DAYS'] = int(os.getenv('CALLBACK_RETENTION_DAYS', 90))
+    # Server-Sent Events for live progress; each open stream holds a worker thread, so only
+    # enable with threaded or async workers (gthread, gevent, uvicorn). Off, pages fetch and reload
+    app.config['LIVE_STREAMS'] = os.getenv('LIVE_STREAMS', '0') == '1'
+    # Prometheus /metrics (per worker); METRICS_TOKEN requires "Authorization: Bearer <token>".
+    # Without a token /metrics is not served at all unless METRICS_PUBLIC=1 says so explicitly
+    app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') == '1'
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN', '')
+    app.config['METRICS_PUBLIC'] = os.getenv('METRICS_PUBLIC', '0') == '1'
+    # Requests slower than PROFILE_SLOW_MS get a collapsed-stack profile in PROFILE_DIR; 0 disables
+    app.config['PROFILE_SLOW_MS'] = float(os.getenv('PROFILE_SLOW_MS', 0))
+    app.config['PROFILE_INTERVAL_MS'] = float(os.getenv('PROFILE_INTERVAL_MS', 5))
+    app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+    # JSON logs are written by a background thread; LOG_SAMPLE_* keep a fraction of info/debug records
+    app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO').upper()
+    app.config['LOG_FILE'] = os.getenv('LOG_FILE', '')
+    app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    app.config['LOG_SAMPLE_INFO'] = float(os.getenv('LOG_SAMPLE_INFO', 1.0))
+    app.config['LOG_SAMPLE_DEBUG'] = float(os.getenv('LOG_SAMPLE_DEBUG', 1.0))
+    
+    # Structured logging first so everything after it can log
+    from app.logs import init_logging
+    init_logging(app)
     
     # Initialize extensions
     db.init_app(app)
-    migrate.init_app(app, db)
+    # Batch mode lets ALTER-style migrations run on SQLite too
+    migrate.init_app(app, db, render_as_batch=True)
     
     # Register blueprints
     from app.routes import main_bp, api_bp, admin_bp
@@ -33,8 +88,24 @@ def create_app():
     app.register_blueprint(api_bp, url_prefix='/api')
     app.register_blueprint(admin_bp, url_prefix='/admin')
     
-    # Create tables
-    with app.app_context():
-        db.create_all()
+    # Register CLI commands
+    from app.commands import register_commands
+    register_commands(app)
+    
+    # Start the callback batcher (replays any spool left by a crash)
+    from app.ingest import init_ingest
+    init_ingest(app)
+    
+    # Keep the contribution rollups behind /stats current
+    from app.rollups import init_rollups
+    init_rollups(app)
+    
+    # Settle or expire pending contributions whose callback never came
+    from app.reconciler import init_reconciler
+    init_reconciler(app)
+    
+    # Latency/SQL metrics, /metrics and the slow-request profiler
+    from app.instrumentation import init_instrumentation
+    init_instrumentation(app)
     
     return app
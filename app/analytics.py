@@ -0,0 +1,234 @@
+# Admin dashboard analytics computed with NumPy over columnar ledger extracts
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app import db
+from app.cache import MemoryCache
+from app.rollups import SETTLE_LAG, UTC_OFFSET
+from app.models import Event, LedgerEntry, Contribution, ContributionArchive, Expenditure, ExpenditureCategory, raw_cents
+
+CONTRIBUTION, EXPENDITURE, REVERSAL = 0, 1, 2
+ENTRY_KINDS = {'contribution': CONTRIBUTION, 'expenditure': EXPENDITURE, 'expenditure_reversal': REVERSAL}
+CATEGORIES = list(ExpenditureCategory)
+CATEGORY_CODES = {category: code for code, category in enumerate(CATEGORIES)}
+
+SERIES_DAYS = 30
+VELOCITY_HOURS = 24
+PROJECTION_DAYS = 7
+BURN_DAYS = 30
+TOP_CONTRIBUTORS = 10
+HOUR = 3600
+DAY = 24 * HOUR
+EPOCH = datetime(1970, 1, 1)
+
+
+class LedgerExtract:
+    """Columnar copy of one admin's ledger entries, extended incrementally.
+
+    The ledger is append-only, so each refresh fetches only rows whose id
+    is above ``watermark``; rows already extracted never change. A lower id
+    can commit after a higher one, so like the rollup compactor a refresh
+    stops before the first entry younger than SETTLE_LAG and the watermark
+    only ever passes settled entries.
+    """
+
+    def __init__(self, admin_id):
+        self.admin_id = admin_id
+        self.watermark = 0
+        self.lock = threading.Lock()
+        self.event_id = np.empty(0, np.int64)
+        self.kind = np.empty(0, np.int8)
+        self.cents = np.empty(0, np.int64)
+        self.ts = np.empty(0, np.int64)
+        self.phone = np.empty(0, np.int64)
+        self.name = np.empty(0, object)
+        self.category = np.empty(0, np.int8)
+        self.source_id = np.empty(0, np.int64)
+        self.result = None
+        self.result_key = None
+
+    def __len__(self):
+        return len(self.cents)
+
+    def refresh(self, settle_lag=SETTLE_LAG):
+        """Append settled ledger entries newer than the watermark; returns rows added"""
+        # Contributions of archived events are joined from the archive instead
+        when = db.func.coalesce(Contribution.created_at, ContributionArchive.created_at, Expenditure.created_at,
+                                LedgerEntry.created_at)
+        contributor_phone = db.func.coalesce(Contribution.contributor_phone, ContributionArchive.contributor_phone)
+        contributor_name = db.func.coalesce(Contribution.contributor_name, ContributionArchive.contributor_name)
+        stmt = (
+            db.select(
+                LedgerEntry.id, LedgerEntry.event_id, LedgerEntry.entry_type, raw_cents(LedgerEntry.amount), when,
+                contributor_phone, contributor_name, Expenditure.category, LedgerEntry.source_id
+            )
+            .join(Event, Event.id == LedgerEntry.event_id)
+            .outerjoin(Contribution, db.and_(LedgerEntry.source_type == 'contribution',
+                                             Contribution.id == LedgerEntry.source_id))
+            .outerjoin(ContributionArchive, db.and_(LedgerEntry.source_type == 'contribution',
+                                                    ContributionArchive.id == LedgerEntry.source_id))
+            .outerjoin(Expenditure, db.and_(LedgerEntry.source_type == 'expenditure',
+                                            Expenditure.id == LedgerEntry.source_id))
+            .where(Event.admin_id == self.admin_id, LedgerEntry.id > self.watermark)
+            .order_by(LedgerEntry.id)
+        )
+        unsettled = db.session.scalar(
+            db.select(db.func.min(LedgerEntry.id))
+            .where(LedgerEntry.id > self.watermark, LedgerEntry.created_at > datetime.utcnow() - settle_lag)
+        )
+        if unsettled is not None:
+            stmt = stmt.where(LedgerEntry.id < unsettled)
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            return 0
+
+        ids, event_ids, kinds, cents, times, phones, names, categories, source_ids = zip(*rows)
+        kind = np.array([ENTRY_KINDS.get(k, -1) for k in kinds], np.int8)
+        category = np.array([CATEGORY_CODES.get(c, -1) for c in categories], np.int8)
+        source_id = np.array(source_ids, np.int64)
+
+        self.event_id = np.concatenate([self.event_id, np.array(event_ids, np.int64)])
+        self.kind = np.concatenate([self.kind, kind])
+        self.cents = np.concatenate([self.cents, np.array(cents, np.int64)])
+        self.ts = np.concatenate([self.ts, np.array(times, 'datetime64[s]').astype(np.int64)])
+        self.phone = np.concatenate([self.phone, np.array(
+            [int(p) if p and p.isdigit() else 0 for p in phones], np.int64)])
+        self.name = np.concatenate([self.name, np.array(names, object)])
+        self.source_id = np.concatenate([self.source_id, source_id])
+        self.category = np.concatenate([self.category, category])
+        self._fill_reversal_categories(len(rows))
+        self.watermark = ids[-1]
+        return len(rows)
+
+    def _fill_reversal_categories(self, added):
+        # A reversal's expenditure row is gone; take the category from its original entry
+        new = np.zeros(len(self), bool)
+        new[-added:] = True
+        missing = new & (self.kind == REVERSAL) & (self.category < 0)
+        if not missing.any():
+            return
+        spent = self.kind == EXPENDITURE
+        order = np.argsort(self.source_id[spent])
+        sources = self.source_id[spent][order]
+        if not len(sources):
+            return
+        found = np.searchsorted(sources, self.source_id[missing]).clip(0, len(sources) - 1)
+        match = sources[found] == self.source_id[missing]
+        self.category[np.flatnonzero(missing)[match]] = self.category[spent][order][found[match]]
+
+
+def _units(cents):
+    return round(float(cents) / 100, 2)
+
+
+def compute_metrics(extract, events, now=None):
+    """Dashboard metrics for ``events`` (Event rows) from an admin's extract"""
+    now = now or datetime.utcnow()
+    now_ts = int((now - EPOCH).total_seconds())
+    contributions = extract.kind == CONTRIBUTION
+    ts = extract.ts[contributions]
+    cents = extract.cents[contributions]
+
+    # Daily totals for the last SERIES_DAYS local days
+    today = (now_ts + UTC_OFFSET) // DAY * DAY - UTC_OFFSET
+    series_start = today - (SERIES_DAYS - 1) * DAY
+    recent = ts >= series_start
+    day = (ts[recent] - series_start) // DAY
+    daily_cents = np.bincount(day, weights=cents[recent], minlength=SERIES_DAYS)
+    daily_count = np.bincount(day, minlength=SERIES_DAYS)
+    series = [{
+        'date': (EPOCH + timedelta(seconds=int(series_start + UTC_OFFSET), days=i)).date().isoformat(),
+        'amount': _units(daily_cents[i]),
+        'count': int(daily_count[i])
+    } for i in range(SERIES_DAYS)]
+
+    # Hourly velocity over the last VELOCITY_HOURS
+    velocity_start = now_ts - VELOCITY_HOURS * HOUR
+    recent = (ts >= velocity_start) & (ts <= now_ts)
+    hour = ((ts[recent] - velocity_start) // HOUR).clip(0, VELOCITY_HOURS - 1)
+    hourly_cents = np.bincount(hour, weights=cents[recent], minlength=VELOCITY_HOURS)
+    velocity = {
+        'hourly': [_units(c) for c in hourly_cents],
+        'per_hour': _units(hourly_cents.sum() / VELOCITY_HOURS),
+        'count': int(recent.sum())
+    }
+
+    # Top contributors by phone number
+    known = extract.phone[contributions] != 0
+    top = []
+    if known.any():
+        phones, first, inverse = np.unique(extract.phone[contributions][known], return_index=True,
+                                           return_inverse=True)
+        totals = np.bincount(inverse, weights=cents[known])
+        counts = np.bincount(inverse)
+        names = extract.name[contributions][known]
+        for i in np.argsort(-totals, kind='stable')[:TOP_CONTRIBUTORS]:
+            phone = str(phones[i])
+            top.append({'name': names[first[i]], 'phone': f'{phone[:4]}****{phone[-3:]}',
+                        'amount': _units(totals[i]), 'count': int(counts[i])})
+
+    # Projected time to target from each event's rate over the last PROJECTION_DAYS
+    recent = ts >= now_ts - PROJECTION_DAYS * DAY
+    event_ids, inverse = np.unique(extract.event_id[contributions][recent], return_inverse=True)
+    recent_cents = dict(zip(event_ids.tolist(), np.bincount(inverse, weights=cents[recent]).tolist()))
+    projections = []
+    for event in events:
+        remaining = float(event.target_amount - (event.current_amount or 0))
+        rate = recent_cents.get(event.id, 0) / 100 / (PROJECTION_DAYS * 24)
+        hours = remaining / rate if remaining > 0 and rate > 0 else None
+        projections.append({
+            'event_id': event.id,
+            'title': event.title,
+            'remaining': max(remaining, 0.0),
+            'per_hour': round(rate, 2),
+            'hours_to_target': round(hours, 1) if hours is not None else None,
+            'projected_at': (now + timedelta(hours=hours)).isoformat() if hours is not None else None,
+            'reached': remaining <= 0
+        })
+
+    # Net spend per category per day over the last BURN_DAYS (reversals subtract)
+    spending = (extract.kind != CONTRIBUTION) & (extract.ts >= now_ts - BURN_DAYS * DAY) & (extract.category >= 0)
+    by_category = np.bincount(extract.category[spending], weights=-extract.cents[spending],
+                              minlength=len(CATEGORIES))
+    burn_rate = {category.value: _units(by_category[code] / BURN_DAYS)
+                 for code, category in enumerate(CATEGORIES) if by_category[code]}
+
+    return {
+        'series': series,
+        'velocity': velocity,
+        'top_contributors': top,
+        'projections': projections,
+        'burn_rate': burn_rate,
+        'rows': len(extract),
+        'watermark': int(extract.watermark)
+    }
+
+
+# Extracts hold NumPy arrays, so they stay in this worker's memory
+# regardless of CACHE_BACKEND
+extracts = MemoryCache(maxsize=int(os.getenv('ANALYTICS_MAX_ADMINS', 256)),
+                       ttl=int(os.getenv('ANALYTICS_TTL', 3600)))
+
+
+def dashboard_metrics(admin_id, events):
+    """Metrics for one admin's dashboard, refreshing their cached extract first.
+
+    The computed result is reused until a new ledger row arrives, an event
+    target changes, or the minute rolls over (time windows move).
+    """
+    extract = extracts.get(f'admin:{admin_id}')
+    if extract is None:
+        extract = LedgerExtract(admin_id)
+        extracts.set(f'admin:{admin_id}', extract)
+    with extract.lock:
+        extract.refresh()
+        now = datetime.utcnow()
+        key = (extract.watermark, now.replace(second=0, microsecond=0),
+               tuple((event.id, event.target_amount, event.current_amount) for event in events))
+        if key != extract.result_key:
+            extract.result = compute_metrics(extract, events, now)
+            extract.result_key = key
+        return extract.result
@@ -0,0 +1,169 @@
+# Move contributions of closed events and old M-Pesa callbacks out of the hot tables
+import logging
+import time
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import Contribution, ContributionArchive, Event, PaymentCallback, PaymentCallbackArchive
+from app.cache import invalidate_event
+from app.logs import log_event
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BATCH = 5000
+# Columns copied verbatim between Contribution and ContributionArchive
+CONTRIBUTION_COLUMNS = ['id', 'created_at', 'event_id', 'contributor_name', 'contributor_phone', 'amount',
+                        'payment_method', 'transaction_id', 'status', 'updated_at']
+CALLBACK_COLUMNS = ['id', 'created_at', 'contribution_id', 'transaction_id', 'mpesa_receipt_number',
+                    'phone_number', 'amount', 'status']
+
+
+def _months(start, end):
+    month = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month <= end:
+        following = (month + timedelta(days=32)).replace(day=1)
+        yield month, following
+        month = following
+
+
+def ensure_partitions(model, start, end):
+    """Create the monthly partitions of an archive table covering ``start``..``end``.
+
+    A no-op outside PostgreSQL, where the archive tables are plain tables.
+    """
+    if db.engine.dialect.name != 'postgresql' or start is None:
+        return
+    table = model.__tablename__
+    for month, following in _months(start, end):
+        db.session.execute(db.text(
+            f"CREATE TABLE IF NOT EXISTS {table}_{month:%Y_%m} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        ))
+
+
+def archivable_events(closed_for):
+    """Closed or completed events untouched for ``closed_for`` with nothing left pending"""
+    pending = db.exists().where(Contribution.event_id == Event.id, Contribution.status == 'pending')
+    return db.session.scalars(
+        db.select(Event.id)
+        .where(Event.status.in_(['closed', 'completed']), Event.archived_at.is_(None),
+               db.func.coalesce(Event.updated_at, Event.created_at) < datetime.utcnow() - closed_for, ~pending)
+        .order_by(Event.id)
+    ).all()
+
+
+def _move_callbacks(condition, batch_size, now):
+    """Move up to ``batch_size`` callbacks matching ``condition`` into the archive, compressed.
+
+    Runs in the caller's transaction. Returns the number moved.
+    """
+    rows = db.session.execute(
+        db.select(*(getattr(PaymentCallback, name) for name in CALLBACK_COLUMNS), PaymentCallback.raw_response)
+        .where(condition)
+        .order_by(PaymentCallback.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+    created = [row.created_at for row in rows]
+    ensure_partitions(PaymentCallbackArchive, min(created), max(created))
+    db.session.execute(db.insert(PaymentCallbackArchive), [
+        {**{name: getattr(row, name) for name in CALLBACK_COLUMNS},
+         'raw_response_z': PaymentCallbackArchive.compress(row.raw_response), 'archived_at': now}
+        for row in rows
+    ])
+    db.session.execute(
+        db.delete(PaymentCallback).where(PaymentCallback.id.in_([row.id for row in rows]))
+        .execution_options(synchronize_session=False)
+    )
+    return len(rows)
+
+
+def archive_event(event_id, batch_size=ARCHIVE_BATCH):
+    """Move one event's contributions, and the callbacks that settled them, to the archive.
+
+    One transaction: INSERT ... SELECT into contributions_archive, then the
+    callbacks (their foreign key points at the contributions), then DELETE.
+    Totals, the ledger and rollups are untouched. Returns the number of
+    contributions moved.
+    """
+    now = datetime.utcnow()
+    first, last = db.session.execute(
+        db.select(db.func.min(Contribution.created_at), db.func.max(Contribution.created_at))
+        .where(Contribution.event_id == event_id)
+    ).one()
+    ensure_partitions(ContributionArchive, first, last)
+    moved = db.session.execute(
+        db.insert(ContributionArchive).from_select(
+            CONTRIBUTION_COLUMNS + ['archived_at'],
+            db.select(*(getattr(Contribution, name) for name in CONTRIBUTION_COLUMNS), db.literal(now, db.DateTime))
+            .where(Contribution.event_id == event_id)
+        )
+    ).rowcount
+    settled = PaymentCallback.contribution_id.in_(db.select(Contribution.id).where(Contribution.event_id == event_id))
+    while _move_callbacks(settled, batch_size, now) == batch_size:
+        pass
+    db.session.execute(
+        db.delete(Contribution).where(Contribution.event_id == event_id)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(db.update(Event).where(Event.id == event_id).values(archived_at=now))
+    db.session.commit()
+    invalidate_event(event_id)
+    return moved
+
+
+def restore_event(event_id):
+    """Move an archived event's contributions back to the hot table (e.g. when it is reopened).
+
+    Archived callbacks stay archived. Returns the number of contributions restored.
+    """
+    restored = db.session.execute(
+        db.insert(Contribution).from_select(
+            CONTRIBUTION_COLUMNS,
+            db.select(*(getattr(ContributionArchive, name) for name in CONTRIBUTION_COLUMNS))
+            .where(ContributionArchive.event_id == event_id)
+        )
+    ).rowcount
+    db.session.execute(db.delete(ContributionArchive).where(ContributionArchive.event_id == event_id))
+    db.session.execute(db.update(Event).where(Event.id == event_id).values(archived_at=None))
+    db.session.commit()
+    invalidate_event(event_id)
+    return restored
+
+
+def archive_callbacks(older_than, batch_size=ARCHIVE_BATCH):
+    """Move callbacks received more than ``older_than`` ago, committing every batch.
+
+    Safaricom stops retrying a delivery within minutes, so the unique indexes
+    only need recent callbacks. Returns the number moved.
+    """
+    cutoff = datetime.utcnow() - older_than
+    moved = 0
+    while True:
+        done = _move_callbacks(PaymentCallback.created_at < cutoff, batch_size, datetime.utcnow())
+        db.session.commit()
+        moved += done
+        if done < batch_size:
+            return moved
+
+
+def archive(closed_for, callbacks_older_than, batch_size=ARCHIVE_BATCH, dry_run=False):
+    """Archive every eligible event, then old callbacks. Returns a report."""
+    start = time.perf_counter()
+    event_ids = archivable_events(closed_for)
+    report = {'events': len(event_ids), 'contributions': 0, 'callbacks': 0, 'dry_run': dry_run}
+    if dry_run:
+        report['contributions'] = db.session.scalar(
+            db.select(db.func.count(Contribution.id)).where(Contribution.event_id.in_(event_ids)))
+        report['callbacks'] = db.session.scalar(
+            db.select(db.func.count(PaymentCallback.id))
+            .where(PaymentCallback.created_at < datetime.utcnow() - callbacks_older_than))
+    else:
+        for event_id in event_ids:
+            report['contributions'] += archive_event(event_id, batch_size)
+        report['callbacks'] = archive_callbacks(callbacks_older_than, batch_size)
+    report['seconds'] = time.perf_counter() - start
+    if not dry_run and (report['events'] or report['callbacks']):
+        log_event(logger, logging.INFO, 'archive.run', **{k: v for k, v in report.items() if k != 'dry_run'})
+    return report
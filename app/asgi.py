@@ -0,0 +1,262 @@
+# ASGI serving mode: async contribution and callback endpoints, Flask for everything else
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+from app.payments import get_stk_handler, fail_contribution
+from app.routes import InvalidContribution, create_pending_contribution, handle_payment_callback
+from app.instrumentation import metrics, observe_outbound, request_latency
+from app.logs import bind, log_event, mask_phone
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDarajaClient:
+    """Non-blocking transport for STKPushHandler's STK pushes.
+
+    Builds the same payloads through the handler and applies the same retry
+    rules and time budget as STKPushHandler._request, on an httpx.AsyncClient.
+    A push waiting on Safaricom then costs a coroutine instead of a worker
+    thread. The OAuth token still comes from the handler's shared cache.
+    """
+
+    def __init__(self, handler, pool_size=200):
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError('ASGI mode requires the httpx package (pip install uvicorn asgiref httpx)')
+        self.handler = handler
+        self.httpx = httpx
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=pool_size,
+                                                            max_keepalive_connections=pool_size))
+
+    async def _request(self, method, url, idempotent=True, **kwargs):
+        httpx = self.httpx
+        handler = self.handler
+        deadline = time.monotonic() + handler.timeout_budget
+        retryable = (httpx.ConnectError, httpx.RemoteProtocolError)
+        if idempotent:
+            retryable += (httpx.TimeoutException,)
+
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise httpx.TimeoutException(f'{method} {url} exceeded its time budget')
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(
+                    method, url,
+                    timeout=httpx.Timeout(remaining, connect=min(handler.connect_timeout, remaining)),
+                    **kwargs
+                )
+                observe_outbound(urlsplit(url).path, started, response.status_code)
+                if response.status_code < 500 or attempt >= handler.max_retries:
+                    return response
+            except httpx.HTTPError as e:
+                observe_outbound(urlsplit(url).path, started, type(e).__name__)
+                if not isinstance(e, retryable) or attempt >= handler.max_retries:
+                    raise
+
+            delay = random.uniform(0, handler.retry_backoff * (2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                raise httpx.TimeoutException(f'{method} {url} exceeded its time budget')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def stk_push(self, access_token, payload, contribution_id):
+        """Send a prepared STK push; returns Daraja's response JSON or {'error': ...}"""
+        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+        try:
+            log_event(logger, logging.INFO, 'stk_push.sending', contribution_id=contribution_id,
+                      amount=payload['Amount'], phone=mask_phone(payload['PhoneNumber']),
+                      account_ref=payload['AccountReference'])
+            response = await self._request('POST', self.handler.stk_url, idempotent=False,
+                                           json=payload, headers=headers)
+            if response.status_code == 401:
+                self.handler.token_cache.invalidate()
+            response.raise_for_status()
+            return response.json()
+        except (self.httpx.HTTPError, ValueError) as e:
+            log_event(logger, logging.ERROR, 'stk_push.failed', contribution_id=contribution_id, error=str(e))
+            return {'error': str(e)}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class AsyncPaymentsApp:
+    """ASGI application for one worker process.
+
+    ``POST /api/contribution`` and ``POST /api/payment/callback`` are served
+    natively. Their database work runs in the Flask app context on a small
+    thread pool (``db_threads``, sized like the SQLAlchemy pool), and the
+    Safaricom round trip is awaited on the event loop. Every other route goes
+    to the Flask app through asgiref's WsgiToAsgi, so pages, admin views and
+    streams behave exactly as under gunicorn.
+    """
+
+    def __init__(self, flask_app, db_threads=16, max_stk_pushes=2000, pool_size=200):
+        try:
+            from asgiref.wsgi import WsgiToAsgi
+        except ImportError:
+            raise RuntimeError('ASGI mode requires the asgiref package (pip install uvicorn asgiref httpx)')
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix='asgi-db')
+        self.max_stk_pushes = max_stk_pushes
+        self.pool_size = pool_size
+        self.daraja = None
+        self.routes = {
+            ('POST', '/api/contribution'): self.process_contribution,
+            ('POST', '/api/payment/callback'): self.payment_callback,
+        }
+        self.in_flight = 0
+        self.stk_in_flight = 0
+        self.stk_rejected = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        view = self.routes.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+
+        started = time.perf_counter()
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        request_id = headers.get('x-request-id', '')[:64] or uuid.uuid4().hex
+        self.in_flight += 1
+        try:
+            with bind(request_id=request_id):
+                body = await self._read_body(receive)
+                try:
+                    data = self._parse(body, headers.get('content-type', ''))
+                except ValueError as e:
+                    payload, status = {'error': f'Invalid input: {str(e)}'}, 400
+                else:
+                    payload, status = await view(data)
+        finally:
+            self.in_flight -= 1
+        request_latency.observe(time.perf_counter() - started, endpoint=f'asgi.{view.__name__}',
+                                method=scope['method'], status=status)
+        await self._respond(send, status, payload, request_id)
+
+    async def process_contribution(self, data):
+        def create():
+            contribution, event = create_pending_contribution(data)
+            return contribution.id, contribution.contributor_phone, int(contribution.amount), event.title
+
+        # Bound pushes waiting on Safaricom, like STK_DISPATCH_MAX_QUEUED in threaded mode
+        if self.stk_in_flight >= self.max_stk_pushes:
+            self.stk_rejected += 1
+            return {'error': 'Too many payment requests in progress, please retry shortly'}, 503
+        self.stk_in_flight += 1
+        try:
+            try:
+                contribution_id, phone, amount, title = await self.run_sync(create)
+            except InvalidContribution as e:
+                return {'error': str(e)}, e.status
+            except Exception as e:
+                return {'error': str(e)}, 500
+            response = await self._stk_push(get_stk_handler(), contribution_id, phone, amount, f"Contribution to {title}")
+        finally:
+            self.stk_in_flight -= 1
+
+        if 'error' in response:
+            await self.run_sync(fail_contribution, contribution_id)
+            return {'error': response['error']}, 400
+        await self.run_sync(get_stk_handler().record_stk_push, contribution_id, response)
+        return {
+            'success': True,
+            'message': 'STK Push sent successfully',
+            'checkout_request_id': response.get('CheckoutRequestID'),
+            'contribution_id': contribution_id
+        }, 200
+
+    async def payment_callback(self, data):
+        return await self.run_sync(handle_payment_callback, data)
+
+    async def _stk_push(self, handler, contribution_id, phone, amount, description):
+        # A cache hit returns at once; only a refresh blocks, so it waits on a thread
+        access_token = await asyncio.get_running_loop().run_in_executor(None, handler.get_access_token)
+        if not access_token:
+            return {'error': 'Failed to get access token'}
+        payload = handler.stk_push_payload(phone, amount, contribution_id, description)
+        if 'error' in payload:
+            return payload
+        if self.daraja is None:
+            self.daraja = AsyncDarajaClient(handler, self.pool_size)
+        return await self.daraja.stk_push(access_token, payload, contribution_id)
+
+    async def run_sync(self, fn, *args):
+        """Run ``fn`` inside the Flask app context on the database thread pool"""
+        def call():
+            with self.flask_app.app_context():
+                return fn(*args)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, call)
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'stk_in_flight': self.stk_in_flight, 'stk_rejected': self.stk_rejected}
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    def _parse(body, content_type):
+        if not body:
+            return {}
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return dict(parse_qsl(body.decode()))
+        return json.loads(body)
+
+    @staticmethod
+    async def _respond(send, status, payload, request_id):
+        body = json.dumps(payload).encode()
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'x-request-id', request_id.encode()),
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.daraja is not None:
+                    await self.daraja.aclose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(flask_app=None):
+    """Wrap the Flask app for an ASGI server (see asgi.py)"""
+    if flask_app is None:
+        from app import create_app
+        flask_app = create_app()
+    config = flask_app.config
+    asgi_app = AsyncPaymentsApp(
+        flask_app,
+        db_threads=config['ASGI_DB_THREADS'],
+        max_stk_pushes=config['ASGI_MAX_STK_PUSHES'],
+        pool_size=config['MPESA_ASYNC_POOL_SIZE']
+    )
+    flask_app.extensions['asgi'] = asgi_app
+    metrics.register_stats('asgi', asgi_app.stats)
+    return asgi_app
@@ -0,0 +1,149 @@
+# Password hashing off the request path, and login attempt throttling
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from app.ratelimit import TokenBucket
+
+
+class HasherBusyError(Exception):
+    """Raised when too many password hashes are already waiting for the pool"""
+
+
+class PasswordHasher:
+    """Run werkzeug password hashing on a bounded pool of ``workers`` threads.
+
+    scrypt and PBKDF2 release the GIL, so the pool hashes on up to
+    ``workers`` cores in parallel. However many logins arrive at once,
+    hashing never takes more than those cores away from payment requests.
+    At most ``max_pending`` hashes may be queued or running; beyond that,
+    callers get HasherBusyError at once instead of piling up.
+    ``workers=0`` hashes inline on the calling thread.
+
+    ``method`` is any werkzeug method string, e.g. ``scrypt``,
+    ``scrypt:65536:8:1`` or ``pbkdf2:sha256:1000000``. Stored hashes made
+    with other parameters are reported by needs_rehash(), and login
+    rehashes them.
+    """
+
+    def __init__(self, method='scrypt', workers=2, max_pending=64, timeout=10.0):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pid = None
+        self._executor = None
+        self._prefix = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.hashed = 0
+        self.verified = 0
+        self.rejected = 0
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusyError('Too many sign-in attempts in progress, please retry shortly')
+            self.pending += 1
+            # A fork (gunicorn --preload) leaves the child without the pool's threads
+            if self.pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+                self.pid = os.getpid()
+            executor = self._executor
+        try:
+            return executor.submit(fn, *args).result(self.timeout)
+        except TimeoutError:
+            raise HasherBusyError('Password hashing timed out, please retry shortly')
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def hash(self, password):
+        digest = self._run(generate_password_hash, password, self.method)
+        with self._lock:
+            self.hashed += 1
+        return digest
+
+    def verify(self, pwhash, password):
+        ok = self._run(check_password_hash, pwhash, password)
+        with self._lock:
+            self.verified += 1
+        return ok
+
+    def needs_rehash(self, pwhash):
+        """True if ``pwhash`` was made with another method or cost than ``method``"""
+        if self._prefix is None:
+            # werkzeug fills in default costs (e.g. scrypt -> scrypt:32768:8:1); hash once to learn them
+            self._prefix = self.hash('').split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'pending': self.pending, 'hashed': self.hashed,
+                    'verified': self.verified, 'rejected': self.rejected}
+
+
+class LoginThrottle:
+    """Token buckets per client IP and per username for sign-in attempts.
+
+    Each attempt takes a token from both buckets: ``per_ip`` attempts per
+    minute from one address, and ``per_user`` per minute against one
+    username from anywhere. The full allowance is available as a burst.
+    At most ``max_keys`` buckets are kept, least recently used first out.
+    """
+
+    def __init__(self, per_ip=20, per_user=5, max_keys=10000):
+        self.limits = {'ip': per_ip, 'user': per_user}
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.throttled = 0
+
+    def _bucket(self, kind, key):
+        with self._lock:
+            bucket = self._buckets.get((kind, key))
+            if bucket is None:
+                limit = self.limits[kind]
+                bucket = self._buckets[kind, key] = TokenBucket(limit / 60.0, capacity=limit)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end((kind, key))
+            return bucket
+
+    def check(self, ip, username=None):
+        """Take one attempt; returns 0 if allowed, else seconds until the next one would be"""
+        buckets = [self._bucket('ip', ip or '')]
+        if username:
+            buckets.append(self._bucket('user', username.lower()))
+        waits = [bucket.wait_time() for bucket in buckets]
+        if any(waits) or not all(bucket.try_acquire() for bucket in buckets):
+            with self._lock:
+                self.throttled += 1
+            return max(max(waits), 1.0)
+        with self._lock:
+            self.allowed += 1
+        return 0
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._buckets), 'allowed': self.allowed, 'throttled': self.throttled}
+
+
+# Singleton instances
+password_hasher = PasswordHasher(
+    method=os.getenv('PASSWORD_HASH_METHOD', 'scrypt'),
+    workers=int(os.getenv('PASSWORD_HASH_WORKERS', 2)),
+    max_pending=int(os.getenv('PASSWORD_HASH_MAX_PENDING', 64))
+)
+login_throttle = LoginThrottle(
+    per_ip=int(os.getenv('LOGIN_ATTEMPTS_PER_IP', 20)),
+    per_user=int(os.getenv('LOGIN_ATTEMPTS_PER_USER', 5))
+)
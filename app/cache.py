@@ -0,0 +1,182 @@
+# Read-through caching of event snapshots and other derived, read-mostly data
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.models import Event, Contribution, ContributionArchive, Expenditure
+
+RECENT_CONTRIBUTORS = 10
+
+
+class MemoryCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds"""
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self._clock() >= entry[1]:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, self._clock() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'memory',
+                'entries': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+class RedisCache:
+    """Cache backed by a Redis-compatible server, shared by all workers.
+
+    Values must be JSON-serialisable. Requires the optional ``redis`` package.
+    """
+
+    def __init__(self, url, ttl=60, prefix='finance:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('CACHE_BACKEND=redis requires the redis package (pip install redis)')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'redis',
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+def make_cache():
+    """Build the cache selected by CACHE_BACKEND (memory or redis)"""
+    ttl = int(os.getenv('CACHE_TTL', 60))
+    if os.getenv('CACHE_BACKEND', 'memory') == 'redis':
+        return RedisCache(os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0'), ttl=ttl)
+    return MemoryCache(maxsize=int(os.getenv('CACHE_MAX_ENTRIES', 1024)), ttl=ttl)
+
+
+# Singleton instance
+cache = make_cache()
+
+
+def _read_through(key, load):
+    value = cache.get(key)
+    if value is None:
+        value = load()
+        if value is not None:
+            cache.set(key, value)
+    return value
+
+
+def event_snapshot(event_id):
+    """Event.to_dict() for one event, or None if it does not exist"""
+    def load():
+        event = Event.query.get(event_id)
+        return event.to_dict() if event else None
+    return _read_through(f'event:{event_id}', load)
+
+
+def active_events():
+    """Snapshots of all active events, as listed on the homepage"""
+    return _read_through(
+        'events:active',
+        lambda: [event.to_dict() for event in Event.query.filter_by(status='active').all()]
+    )
+
+
+def event_page(event_id):
+    """Everything the public event page renders, or None if it does not exist"""
+    def load():
+        event = Event.query.get(event_id)
+        if not event:
+            return None
+        model = ContributionArchive if event.archived_at else Contribution
+        contributors = model.query.filter_by(
+            event_id=event_id,
+            status='completed'
+        ).order_by(model.created_at.desc()).limit(RECENT_CONTRIBUTORS).all()
+        return {
+            'event': dict(event.to_dict(), organizer_phone=event.organizer_phone),
+            'contributors': [contrib.to_dict() for contrib in contributors]
+        }
+    return _read_through(f'event-page:{event_id}', load)
+
+
+def invalidate_event(event_id):
+    """Drop cached snapshots after a payment or an admin edit changes an event"""
+    cache.delete(f'event:{event_id}', f'event-page:{event_id}', 'events:active')
+
+
+def expenditure_summary(event_id):
+    """Per-event expenditure totals, cached until the next add/delete"""
+    return _read_through(f'expenditure-summary:{event_id}', lambda: Expenditure.summarize(event_id))
+
+
+def invalidate_expenditure_summary(event_id):
+    cache.delete(f'expenditure-summary:{event_id}')
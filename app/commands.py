@@ -0,0 +1,190 @@
+# Flask CLI commands (run with `flask <command>`)
+import os
+import time
+from datetime import timedelta
+
+import click
+from flask import current_app
+
+from app import db
+from app.models import Event, LedgerEntry, ContributionRollup, RollupState
+from app.cache import cache
+from app.exports import EXPORTS, FORMATS, EXPORT_CHUNK, write_export
+from app.imports import IMPORT_BATCH, read_rows, import_contributions
+from app.rollups import COMPACT_BATCH, compact_all
+from app.reconciler import make_reconciler, reconcile
+from app.archive import ARCHIVE_BATCH, archive, restore_event
+
+
+@click.command('init-db')
+def init_db_command():
+    """Create the schema on an empty database, or migrate an existing one to the latest revision"""
+    from flask_migrate import stamp, upgrade
+    tables = db.inspect(db.engine).get_table_names()
+    if not tables:
+        db.create_all()
+        # The models are the latest revision, so later `flask db upgrade` runs start from here
+        stamp()
+        click.echo(f"Created {len(db.metadata.tables)} tables")
+    elif 'alembic_version' not in tables:
+        raise click.ClickException('Tables exist without a migration history; '
+                                   'run `flask db stamp <revision>` first (see README)')
+    else:
+        upgrade()
+        click.echo("Database is at the latest revision")
+
+
+@click.command('reconcile-totals')
+@click.option('--dry-run', is_flag=True, help='Only report events whose total has drifted')
+def reconcile_totals_command(dry_run):
+    """Rebuild event totals and counts from completed contributions"""
+    totals = Event.completed_totals_subquery()
+    rows = db.session.execute(
+        db.select(
+            Event.id, Event.title, Event.current_amount, Event.contribution_count,
+            db.func.coalesce(totals.c.total, 0), db.func.coalesce(totals.c.count, 0)
+        )
+        .outerjoin(totals, totals.c.event_id == Event.id)
+    ).all()
+
+    # Amounts are integer cents, so any difference at all is drift
+    drifted = [row for row in rows if (row[2] or 0) != row[4] or row[3] != row[5]]
+    for event_id, title, current, count, expected, expected_count in drifted:
+        click.echo(f"Event {event_id} ({title}): stored {current or 0:,.2f} from {count} contributions, "
+                   f"actual {expected:,.2f} from {expected_count}")
+    click.echo(f"{len(drifted)} of {len(rows)} event totals out of sync")
+
+    if dry_run or not drifted:
+        return
+    Event.rebuild_totals()
+    db.session.commit()
+    cache.clear()
+    click.echo("Event totals rebuilt")
+
+
+@click.command('backfill-ledger')
+def backfill_ledger_command():
+    """Post existing contributions and expenditures to the ledger and rebuild balances"""
+    posted, balanced = LedgerEntry.backfill()
+    db.session.commit()
+    click.echo(f"Posted {posted} ledger entries; balances rebuilt for {balanced} events")
+
+
+@click.command('export-event')
+@click.argument('event_id', type=int)
+@click.option('--kind', type=click.Choice(list(EXPORTS)), default='contributions', show_default=True)
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True),
+              help='Defaults to event-<id>-<kind>.<format>')
+@click.option('--chunk', type=int, default=EXPORT_CHUNK, show_default=True, help='Rows fetched per round trip')
+def export_event_command(event_id, kind, fmt, output, chunk):
+    """Export an event's contributions or expenditures without loading them into memory"""
+    if not db.session.get(Event, event_id):
+        raise click.ClickException(f'Event {event_id} not found')
+    output = output or f'event-{event_id}-{kind}.{fmt}'
+    start = time.perf_counter()
+    try:
+        with open(output, 'wb') as f:
+            count = write_export(kind, event_id, fmt, f, chunk)
+    except RuntimeError as e:
+        os.remove(output)
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+    click.echo(f"Wrote {count:,} rows to {output} in {elapsed:.1f}s ({count / elapsed:,.0f} rows/s)")
+
+
+@click.command('import-contributions')
+@click.argument('event_id', type=int)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, default=IMPORT_BATCH, show_default=True)
+@click.option('--dry-run', is_flag=True, help='Validate and report without writing anything')
+def import_contributions_command(event_id, path, batch_size, dry_run):
+    """Import cash/bank contributions from a CSV or XLSX file"""
+    if not db.session.get(Event, event_id):
+        raise click.ClickException(f'Event {event_id} not found')
+    with open(path, 'rb') as f:
+        try:
+            report = import_contributions(event_id, read_rows(f, path), batch_size, dry_run)
+        except (RuntimeError, ValueError) as e:
+            raise click.ClickException(str(e))
+    for line, reason in report['errors']:
+        click.echo(f"Line {line}: {reason}")
+    click.echo(f"{'Would import' if dry_run else 'Imported'} {report['imported']:,} contributions "
+               f"(KES {report['amount']:,.2f}); {report['duplicates']:,} duplicates, {report['invalid']:,} invalid")
+    click.echo(f"{report['rows']:,} rows in {report['seconds']:.1f}s ({report['rows_per_sec']:,.0f} rows/s)")
+
+
+@click.command('compact-rollups')
+@click.option('--batch-size', type=int, default=COMPACT_BATCH, show_default=True, help='Ledger entries per transaction')
+@click.option('--rebuild', is_flag=True, help='Drop all rollups and rebuild them from the whole ledger')
+def compact_rollups_command(batch_size, rebuild):
+    """Fold new contributions into the per-minute/hour/day rollups"""
+    if rebuild:
+        db.session.execute(db.delete(ContributionRollup))
+        db.session.execute(db.delete(RollupState))
+        db.session.commit()
+    start = time.perf_counter()
+    folded = compact_all(batch_size)
+    click.echo(f"Folded {folded:,} ledger entries into rollups in {time.perf_counter() - start:.1f}s")
+
+
+@click.command('reconcile-pending')
+@click.option('--older-than', type=int, default=None, help='Seconds a contribution must be pending (default RECONCILE_AFTER)')
+@click.option('--dry-run', is_flag=True, help='Query Daraja and report without changing anything')
+@click.option('--watch', type=float, default=0, help='Keep running, reconciling every N seconds')
+def reconcile_pending_command(older_than, dry_run, watch):
+    """Settle or expire stale pending contributions using STK Push Query"""
+    reconciler = make_reconciler(current_app._get_current_object())
+    if older_than is not None:
+        reconciler.older_than = timedelta(seconds=older_than)
+    while True:
+        if dry_run:
+            report = reconcile(reconciler.handler, reconciler.older_than, reconciler.expire_after,
+                               reconciler.bucket, reconciler.batch_size, reconciler.workers, dry_run=True)
+        else:
+            report = reconciler.run_once()
+        click.echo(f"{'Dry run: checked' if dry_run else 'Checked'} {report['checked']:,} of {report['backlog']:,} stale "
+                   f"pending: {report['completed']} completed, {report['failed']} failed, {report['expired']} expired, "
+                   f"{report['unresolved']} unresolved ({report['resolved_per_sec']:,.1f}/s); "
+                   f"{report['remaining']:,} remaining")
+        if not watch:
+            return
+        db.session.remove()
+        time.sleep(watch)
+
+
+@click.command('archive-history')
+@click.option('--closed-for', type=int, default=None, help='Days an event must be closed (default ARCHIVE_AFTER_DAYS)')
+@click.option('--callbacks-older-than', type=int, default=None,
+              help='Days before a callback is archived (default CALLBACK_RETENTION_DAYS)')
+@click.option('--batch-size', type=int, default=ARCHIVE_BATCH, show_default=True, help='Callbacks moved per round trip')
+@click.option('--dry-run', is_flag=True, help='Report what would be archived without moving anything')
+@click.option('--restore', 'restore_id', type=int, default=None, help='Move one archived event back to the hot tables')
+def archive_history_command(closed_for, callbacks_older_than, batch_size, dry_run, restore_id):
+    """Move closed events' contributions and old callbacks to the archive tables"""
+    if restore_id is not None:
+        event = db.session.get(Event, restore_id)
+        if not event or not event.archived_at:
+            raise click.ClickException(f'Event {restore_id} is not archived')
+        click.echo(f"Restored {restore_event(restore_id):,} contributions of event {restore_id}")
+        return
+    config = current_app.config
+    report = archive(
+        timedelta(days=config['ARCHIVE_AFTER_DAYS'] if closed_for is None else closed_for),
+        timedelta(days=config['CALLBACK_RETENTION_DAYS'] if callbacks_older_than is None else callbacks_older_than),
+        batch_size, dry_run
+    )
+    click.echo(f"{'Would archive' if dry_run else 'Archived'} {report['events']:,} events "
+               f"({report['contributions']:,} contributions) and {report['callbacks']:,} callbacks "
+               f"in {report['seconds']:.1f}s")
+
+
+def register_commands(app):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(reconcile_totals_command)
+    app.cli.add_command(backfill_ledger_command)
+    app.cli.add_command(export_event_command)
+    app.cli.add_command(import_contributions_command)
+    app.cli.add_command(compact_rollups_command)
+    app.cli.add_command(reconcile_pending_command)
+    app.cli.add_command(archive_history_command)
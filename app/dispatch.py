@@ -0,0 +1,79 @@
+# Background dispatch of STK Push requests
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.payments import get_stk_handler, fail_contribution
+from app.logs import bind, current_context, log_event
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when too many STK pushes are already waiting to be sent"""
+
+
+class STKDispatcher:
+    """Send STK Push requests on a thread pool so the request worker is freed"""
+
+    def __init__(self, max_workers=8, max_queued=500):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stk-dispatch')
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+
+    def submit(self, app, contribution_id, phone, amount, description):
+        """Queue an STK push for an already committed pending Contribution"""
+        with self._lock:
+            if self.queued >= self.max_queued:
+                raise QueueFullError('Too many payment requests in progress, please retry shortly')
+            self.queued += 1
+        # Carry the request id over to the worker thread
+        return self.executor.submit(self._run, app, contribution_id, phone, amount, description, current_context())
+
+    def _run(self, app, contribution_id, phone, amount, description, context=None):
+        try:
+            with app.app_context(), bind(**(context or {})):
+                response = get_stk_handler().initiate_stk_push(
+                    phone_number=phone,
+                    amount=amount,
+                    contribution_id=contribution_id,
+                    description=description
+                )
+                if 'error' in response:
+                    fail_contribution(contribution_id)
+                    with self._lock:
+                        self.failed += 1
+                else:
+                    with self._lock:
+                        self.sent += 1
+        except Exception as e:
+            log_event(logger, logging.ERROR, 'stk_push.dispatch_failed', exc_info=True,
+                      contribution_id=contribution_id, error=str(e))
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self.queued -= 1
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self.queued, 'sent': self.sent, 'failed': self.failed}
+
+
+def contribution_progress(contribution):
+    """Describe where a contribution is in the STK push lifecycle"""
+    if contribution.status == 'pending':
+        # transaction_id holds the CheckoutRequestID once Safaricom accepted the push
+        return 'awaiting_payment' if contribution.transaction_id else 'queued'
+    return contribution.status
+
+
+# Singleton instance
+dispatcher = STKDispatcher(
+    max_workers=int(os.getenv('STK_DISPATCH_WORKERS', 8)),
+    max_queued=int(os.getenv('STK_DISPATCH_MAX_QUEUED', 500))
+)
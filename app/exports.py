@@ -0,0 +1,152 @@
+# Streaming statement exports (CSV, XLSX, Parquet) of an event's contributions and expenditures
+import csv
+import io
+
+from app import db
+from app.models import Contribution, Event, Expenditure, raw_cents, cents_to_units
+
+EXPORT_CHUNK = 5000
+
+EXPORTS = {
+    'contributions': (Contribution, ['id', 'created_at', 'contributor_name', 'contributor_phone', 'amount',
+                                     'payment_method', 'status', 'transaction_id']),
+    'expenditures': (Expenditure, ['id', 'created_at', 'description', 'category', 'amount', 'approved_by']),
+}
+
+# Text starting with one of these is run as a formula by Excel/LibreOffice (CSV injection)
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def export_chunks(kind, event_id, chunk=EXPORT_CHUNK):
+    """Yield an event's rows as lists of tuples, oldest first, ``chunk`` at a time.
+
+    Rows come from a server-side cursor (yield_per) as plain column tuples, so
+    no ORM objects are built and memory stays flat. Amounts are read as
+    integer cents and converted a whole chunk at a time.
+    """
+    model, columns = EXPORTS[kind]
+    if model is Contribution:
+        model = Event.contribution_model(event_id)
+    selected = [raw_cents(model.amount) if name == 'amount' else getattr(model, name) for name in columns]
+    stmt = (
+        db.select(*selected)
+        .where(model.event_id == event_id)
+        .order_by(model.created_at, model.id)
+        .execution_options(yield_per=chunk)
+    )
+    amount_index = columns.index('amount')
+    enum_indexes = [i for i, column in enumerate(selected) if getattr(column.type, 'enum_class', None)]
+    for rows in db.session.execute(stmt).partitions():
+        amounts = cents_to_units([row[amount_index] for row in rows])
+        out = []
+        for row, amount in zip(rows, amounts):
+            row = list(row)
+            row[amount_index] = amount
+            for i in enum_indexes:
+                if row[i] is not None:
+                    row[i] = row[i].value
+            out.append(row)
+        yield out
+
+
+def spreadsheet_safe(rows):
+    """Quote text cells a spreadsheet would evaluate, e.g. a contributor named '=HYPERLINK(...)'"""
+    return [[f"'{value}" if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) else value
+             for value in row] for row in rows]
+
+
+def arrow_schema(pa, kind):
+    """Arrow schema of an export from its model's column types.
+
+    Inferring it from the first chunk would type an all-NULL column (e.g.
+    transaction_id of a chunk of pending rows) as null, and a later chunk
+    with values would then not match the file's schema.
+    """
+    model, columns = EXPORTS[kind]
+    fields = []
+    for name in columns:
+        column_type = model.__table__.c[name].type
+        if name == 'amount':
+            # cents_to_units yields KES as floats
+            arrow_type = pa.float64()
+        elif isinstance(column_type, db.DateTime):
+            arrow_type = pa.timestamp('us')
+        elif isinstance(column_type, db.Integer):
+            arrow_type = pa.int64()
+        else:
+            # Strings, and enums exported by value
+            arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def csv_stream(chunks, header):
+    """Encode chunks as CSV text, one string per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for rows in chunks:
+        writer.writerows(spreadsheet_safe(rows))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_xlsx(chunks, header, fileobj):
+    """Write chunks to ``fileobj`` with openpyxl's write-only (streaming) workbook"""
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError('XLSX export requires the openpyxl package (pip install openpyxl)')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for rows in chunks:
+        # openpyxl stores any string starting with '=' as a formula
+        for row in spreadsheet_safe(rows):
+            sheet.append(row)
+    workbook.save(fileobj)
+
+
+def write_parquet(chunks, kind, fileobj):
+    """Write each chunk of a ``kind`` export to ``fileobj`` as one Parquet row group"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export requires the pyarrow package (pip install pyarrow)')
+    schema = arrow_schema(pa, kind)
+    # An empty export still produces a valid file with just the columns
+    with pq.ParquetWriter(fileobj, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)], schema=schema))
+
+
+def write_export(kind, event_id, fmt, fileobj, chunk=EXPORT_CHUNK):
+    """Write a complete export to a binary file object; returns the row count"""
+    header = EXPORTS[kind][1]
+    count = [0]
+
+    def counted():
+        for rows in export_chunks(kind, event_id, chunk):
+            count[0] += len(rows)
+            yield rows
+
+    if fmt == 'csv':
+        for text in csv_stream(counted(), header):
+            fileobj.write(text.encode())
+    elif fmt == 'xlsx':
+        write_xlsx(counted(), header, fileobj)
+    elif fmt == 'parquet':
+        write_parquet(counted(), kind, fileobj)
+    else:
+        raise ValueError(f'Unknown export format {fmt!r}')
+    return count[0]
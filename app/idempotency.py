@@ -0,0 +1,44 @@
+# In-process record of recently processed M-Pesa callbacks
+import os
+import threading
+from collections import OrderedDict
+
+
+class RecentKeys:
+    """Bounded, thread-safe LRU set of recently seen keys.
+
+    Sits in front of the unique index on PaymentCallback.transaction_id so a
+    retried delivery that this worker has already processed is acknowledged
+    without a database round trip. Misses fall through to the index.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._keys), 'hits': self.hits, 'misses': self.misses}
+
+
+# Singleton instance
+seen_callbacks = RecentKeys(int(os.getenv('CALLBACK_DEDUP_CACHE_SIZE', 10000)))
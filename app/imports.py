@@ -0,0 +1,196 @@
+# Bulk import of offline (cash / bank) contributions from spreadsheets
+import csv
+import hashlib
+import io
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from app import db
+from app.models import Contribution, Event, LedgerEntry, to_money
+from app.payments import normalize_phone
+from app.cache import invalidate_event
+
+IMPORT_BATCH = 1000
+MAX_REPORTED_ERRORS = 100
+OFFLINE_METHODS = ('cash', 'bank')
+REQUIRED_COLUMNS = ('phone', 'amount')
+
+Posted = namedtuple('Posted', 'id amount')
+
+
+def read_rows(fileobj, filename):
+    """Yield (line number, row dict) from an uploaded CSV or XLSX file.
+
+    Headers are matched case-insensitively: name, phone, amount, and
+    optionally method (cash/bank), reference and date.
+    """
+    if filename.lower().endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise RuntimeError('XLSX import requires the openpyxl package (pip install openpyxl)')
+        rows = load_workbook(fileobj, read_only=True, data_only=True).active.iter_rows(values_only=True)
+        header = [str(value).strip().lower() if value is not None else '' for value in next(rows, ())]
+    else:
+        reader = csv.reader(io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline=''))
+        rows = reader
+        header = [value.strip().lower() for value in next(reader, [])]
+
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    for number, values in enumerate(rows, start=2):
+        if any(value not in (None, '') for value in values):
+            yield number, dict(zip(header, values))
+
+
+def _parse_amount(value):
+    try:
+        amount = to_money(value)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    return amount if amount >= 1 else None
+
+
+def _parse_date(value):
+    if value in (None, ''):
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return False
+
+
+def _text(value):
+    return '' if value is None else str(value).strip()
+
+
+def _key(method, *parts):
+    return f"{method.upper()}-{hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()[:20]}"
+
+
+def validate_batch(event_id, batch, seen, occurrences):
+    """Validate one batch column by column.
+
+    Returns (mappings ready for insert, [(line, reason)], duplicate count).
+    A row's transaction_id is its method, event and reference. A row with no
+    reference gets a hash of its fields and of how many identical rows came
+    before it in the file, so two equal cash payments are both kept.
+    Re-importing a sheet therefore finds every row already present. ``seen``
+    carries keys, and ``occurrences`` the identical-row counts, across
+    batches of a file.
+    """
+    numbers = [number for number, _ in batch]
+    rows = [row for _, row in batch]
+    names = [_text(row.get('name'))[:100] or 'Anonymous' for row in rows]
+    phones = [normalize_phone(row.get('phone') or '') for row in rows]
+    amounts = [_parse_amount(row.get('amount')) for row in rows]
+    methods = [_text(row.get('method')).lower() or 'cash' for row in rows]
+    references = [_text(row.get('reference'))[:80] for row in rows]
+    dates = [_parse_date(row.get('date')) for row in rows]
+    keys = []
+    # Keys of imports made before the event id and occurrence were part of
+    # them; they only count as duplicates within this event
+    legacy = []
+    for method, reference, name, phone, amount, date in zip(methods, references, names, phones, amounts, dates):
+        if reference:
+            keys.append(f'{method.upper()}-{event_id}-{reference}')
+            legacy.append(f'{method.upper()}-{reference}')
+        else:
+            fields = (event_id, name, phone, amount, date)
+            occurrences[method, fields] += 1
+            keys.append(_key(method, *fields, occurrences[method, fields]))
+            legacy.append(_key(method, *fields) if occurrences[method, fields] == 1 else None)
+
+    existing = set(db.session.scalars(
+        db.select(Contribution.transaction_id).where(db.or_(
+            Contribution.transaction_id.in_(keys),
+            db.and_(Contribution.event_id == event_id,
+                    Contribution.transaction_id.in_([key for key in legacy if key]))
+        ))
+    ).all())
+
+    mappings = []
+    errors = []
+    duplicates = 0
+    now = datetime.utcnow()
+    for i, number in enumerate(numbers):
+        if phones[i] is None:
+            errors.append((number, 'invalid phone number'))
+        elif amounts[i] is None:
+            errors.append((number, 'amount must be a number of at least 1'))
+        elif methods[i] not in OFFLINE_METHODS:
+            errors.append((number, f"method must be one of {', '.join(OFFLINE_METHODS)}"))
+        elif dates[i] is False:
+            errors.append((number, 'date must be ISO 8601 (YYYY-MM-DD)'))
+        elif keys[i] in seen or keys[i] in existing or legacy[i] in existing:
+            duplicates += 1
+        else:
+            seen.add(keys[i])
+            mappings.append({
+                'event_id': event_id,
+                'contributor_name': names[i],
+                'contributor_phone': phones[i],
+                'amount': amounts[i],
+                'payment_method': methods[i],
+                'transaction_id': keys[i],
+                'status': 'completed',
+                'created_at': dates[i] or now,
+                'updated_at': now
+            })
+    return mappings, errors, duplicates
+
+
+def import_contributions(event_id, rows, batch_size=IMPORT_BATCH, dry_run=False):
+    """Import (line, row) pairs as completed offline contributions.
+
+    Each batch is validated, inserted with bulk_insert_mappings, added to
+    the event total and ledger once, and committed. Batches already
+    committed stay if a later one fails; re-running the import skips them
+    as duplicates. Returns a report dict including rows/sec.
+    """
+    # Reads of an archived event go to contributions_archive, so new rows would be stranded
+    if db.session.scalar(db.select(Event.archived_at).where(Event.id == event_id)):
+        raise ValueError(f'Event {event_id} is archived; restore it first (flask archive-history --restore {event_id})')
+    report = {'rows': 0, 'imported': 0, 'duplicates': 0, 'invalid': 0,
+              'amount': Decimal('0.00'), 'errors': [], 'dry_run': dry_run}
+    seen = set()
+    occurrences = Counter()
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        mappings, errors, duplicates = validate_batch(event_id, batch, seen, occurrences)
+        report['rows'] += len(batch)
+        report['duplicates'] += duplicates
+        report['invalid'] += len(errors)
+        report['errors'].extend(errors[:MAX_REPORTED_ERRORS - len(report['errors'])])
+        batch.clear()
+        if not mappings:
+            return
+        total = sum(mapping['amount'] for mapping in mappings)
+        report['imported'] += len(mappings)
+        report['amount'] += total
+        if dry_run:
+            return
+        db.session.bulk_insert_mappings(Contribution, mappings, return_defaults=True)
+        Event.add_to_total(event_id, total, len(mappings))
+        LedgerEntry.post_contributions(event_id, [Posted(m['id'], m['amount']) for m in mappings])
+        db.session.commit()
+
+    for item in rows:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    if report['imported'] and not dry_run:
+        invalidate_event(event_id)
+    report['seconds'] = time.perf_counter() - start
+    report['rows_per_sec'] = report['rows'] / report['seconds'] if report['seconds'] else 0.0
+    return report
@@ -0,0 +1,362 @@
+# Batched ingestion of M-Pesa callbacks
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from app import db
+from app.models import Contribution, PaymentCallback, Event, LedgerEntry
+from app.payments import parse_stk_callback
+from app.idempotency import seen_callbacks
+from app.cache import invalidate_event
+from app.live import notify_payment
+from app.logs import log_event
+
+logger = logging.getLogger(__name__)
+
+
+def apply_batch(payloads):
+    """Apply a list of raw callback payloads in one transaction.
+
+    One bulk lookup of the contributions being settled, one bulk status
+    update, one bulk PaymentCallback insert, and per event one total update
+    and one bulk ledger insert. The status update is guarded by
+    status != 'completed', so contributions the reconciler settled in the
+    meantime are not counted again.
+    Callbacks already stored (or repeated within the batch) are skipped, so
+    re-applying a batch is a no-op. Returns [(checkout_id, status, event_id)].
+    """
+    fresh = {}
+    anonymous = []
+    for payload in payloads:
+        parsed = parse_stk_callback(payload)
+        if parsed['checkout_id'] is None:
+            anonymous.append((parsed, payload))
+        else:
+            fresh.setdefault(parsed['checkout_id'], (parsed, payload))
+
+    if fresh:
+        stored = db.session.scalars(
+            db.select(PaymentCallback.transaction_id)
+            .where(PaymentCallback.transaction_id.in_(list(fresh)))
+        ).all()
+        for checkout_id in stored:
+            del fresh[checkout_id]
+    items = list(fresh.values()) + anonymous
+
+    receipts = [parsed['receipt'] for parsed, _ in items if parsed['receipt']]
+    if receipts:
+        known = set(db.session.scalars(
+            db.select(PaymentCallback.mpesa_receipt_number)
+            .where(PaymentCallback.mpesa_receipt_number.in_(receipts))
+        ).all())
+        items = [(parsed, payload) for parsed, payload in items if parsed['receipt'] not in known]
+
+    successful = [parsed['checkout_id'] for parsed, _ in items if parsed['result_code'] == 0 and parsed['checkout_id']]
+    contributions = {}
+    if successful:
+        rows = db.session.execute(
+            db.select(Contribution.id, Contribution.event_id, Contribution.amount, Contribution.transaction_id)
+            .where(Contribution.transaction_id.in_(successful), Contribution.status != 'completed')
+        ).all()
+        contributions = {row.transaction_id: row for row in rows}
+    if contributions:
+        won = set(db.session.scalars(
+            db.update(Contribution)
+            .where(Contribution.id.in_([row.id for row in contributions.values()]),
+                   Contribution.status != 'completed')
+            .values(status='completed')
+            .returning(Contribution.id)
+            .execution_options(synchronize_session=False)
+        ).all())
+        contributions = {key: row for key, row in contributions.items() if row.id in won}
+
+    updates = []
+    callbacks = []
+    settled = defaultdict(list)
+    results = []
+    for parsed, payload in items:
+        contribution = contributions.get(parsed['checkout_id']) if parsed['result_code'] == 0 else None
+        if contribution:
+            updates.append({'id': contribution.id, 'transaction_id': parsed['receipt']})
+            settled[contribution.event_id].append(contribution)
+        callbacks.append({
+            'raw_response': payload,
+            'transaction_id': parsed['checkout_id'],
+            'status': 'success' if parsed['result_code'] == 0 else 'failed',
+            'mpesa_receipt_number': parsed['receipt'],
+            'phone_number': parsed['phone'],
+            'amount': parsed['amount'],
+            'contribution_id': contribution.id if contribution else None
+        })
+        results.append((
+            parsed['checkout_id'],
+            'completed' if parsed['result_code'] == 0 else 'failed',
+            contribution.event_id if contribution else None
+        ))
+
+    if updates:
+        db.session.execute(db.update(Contribution), updates)
+    if callbacks:
+        db.session.execute(db.insert(PaymentCallback), callbacks)
+    for event_id, contributions in settled.items():
+        Event.add_to_total(event_id, sum(c.amount for c in contributions), len(contributions))
+        LedgerEntry.post_contributions(event_id, contributions)
+    db.session.commit()
+    return results
+
+
+class CallbackBatcher:
+    """Acknowledge callbacks immediately and apply them in micro-batches.
+
+    Crash recovery: each accepted payload is appended to this process's spool
+    file, flushed (and fsynced unless disabled), before Safaricom gets its 200.
+    A flush renames the spool to a batch file, applies it in one transaction
+    and deletes the file only after the commit. If the process dies, the
+    spool and any unapplied batch files stay on disk. Each batcher holds an
+    flock on ``owner-<pid>.lock`` for its lifetime, and the kernel drops it
+    when the process dies. The next batcher to start in the same spool
+    directory replays every file whose owner lock it can take. PID liveness
+    would not do: in a container a dead worker's PID is soon reused by an
+    unrelated process. Replays are safe because apply_batch skips callbacks that were
+    already stored. A truncated last line from a crash mid-write is
+    discarded; that callback was never acknowledged, so Safaricom retries it.
+
+    A batch that fails for any reason other than the database being
+    unreachable is retried one callback at a time. Callbacks that still fail
+    are moved to ``dead-letter/`` in the spool directory for inspection, so
+    one bad payload never holds up the batches behind it.
+    """
+
+    def __init__(self, app, spool_dir, batch_size=200, flush_interval=0.5, fsync=True):
+        self.app = app
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.pid = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._spool = None
+        self._owner_lock = None
+        self._sequence = 0
+        self.pending = 0
+        self.applied = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_lettered = 0
+
+    @property
+    def spool_path(self):
+        return os.path.join(self.spool_dir, f'spool-{self.pid}.jsonl')
+
+    def start(self):
+        with self._start_lock:
+            # A fork (gunicorn --preload) leaves the child without our thread
+            if self.pid == os.getpid():
+                return self
+            self.pid = os.getpid()
+            self.pending = 0
+            os.makedirs(self.spool_dir, exist_ok=True)
+            if self._owner_lock is not None:
+                # Inherited across a fork; the parent still holds the lock through its own copy
+                os.close(self._owner_lock)
+            self._owner_lock = os.open(self._lock_path(self.pid), os.O_RDWR | os.O_CREAT, 0o644)
+            # Blocks only while another batcher is adopting the files of a dead process with our PID
+            fcntl.flock(self._owner_lock, fcntl.LOCK_EX)
+            self.recover()
+            self._spool = open(self.spool_path, 'a')
+            threading.Thread(target=self._run, name='callback-batcher', daemon=True).start()
+            atexit.register(self.stop)
+        return self
+
+    def submit(self, callback_data):
+        """Durably queue one callback payload for the next batch"""
+        if self.pid != os.getpid():
+            self.start()
+        line = json.dumps(callback_data, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._spool.write(line)
+            self._spool.flush()
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self):
+        """Apply everything spooled so far"""
+        self._rotate()
+        self._drain()
+
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+    def recover(self):
+        """Adopt spool and batch files of processes that no longer hold their owner lock"""
+        owners = {int(os.path.basename(path).split('-')[1].split('.')[0])
+                  for path in glob.glob(os.path.join(self.spool_dir, '*.jsonl'))}
+        for owner in sorted(owners - {self.pid}):
+            lock = os.open(self._lock_path(owner), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                # Hold the lock while renaming, so a new process with that PID waits for us
+                paths = (glob.glob(os.path.join(self.spool_dir, f'spool-{owner}.jsonl'))
+                         + glob.glob(os.path.join(self.spool_dir, f'batch-{owner}-*.jsonl')))
+                for path in paths:
+                    self._sequence += 1
+                    try:
+                        os.replace(path, self._batch_path(f'recovered{self._sequence}'))
+                    except FileNotFoundError:
+                        # Another batcher adopted it first
+                        pass
+            finally:
+                os.close(lock)
+        self._drain()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self.pending, 'applied': self.applied, 'batches': self.batches,
+                    'failures': self.failures, 'dead_lettered': self.dead_lettered}
+
+    def _lock_path(self, owner):
+        return os.path.join(self.spool_dir, f'owner-{owner}.lock')
+
+    def _batch_path(self, suffix):
+        return os.path.join(self.spool_dir, f'batch-{self.pid}-{time.time_ns()}-{suffix}.jsonl')
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log_event(logger, logging.ERROR, 'callback_batch.flush_failed', exc_info=True, error=str(e))
+
+    def _rotate(self):
+        with self._lock:
+            if not self.pending or self._spool is None:
+                return
+            self._spool.close()
+            self._sequence += 1
+            os.replace(self.spool_path, self._batch_path(self._sequence))
+            self._spool = open(self.spool_path, 'a')
+            self.pending = 0
+
+    def _apply(self, payloads):
+        """apply_batch in the app context, then tell caches and live streams"""
+        with self.app.app_context():
+            try:
+                try:
+                    results = apply_batch(payloads)
+                except IntegrityError:
+                    # Raced with another writer; the retry skips what it stored
+                    db.session.rollback()
+                    results = apply_batch(payloads)
+            except Exception:
+                db.session.rollback()
+                raise
+            for checkout_id, status, event_id in results:
+                if checkout_id:
+                    seen_callbacks.add(checkout_id)
+                if event_id:
+                    invalidate_event(event_id)
+                notify_payment(checkout_id, status, event_id)
+            return results
+
+    def _apply_one_by_one(self, path, payloads):
+        """Apply a failed batch per callback, dead-lettering the ones that still fail"""
+        results = []
+        dead = []
+        for payload in payloads:
+            try:
+                results.extend(self._apply([payload]))
+            except OperationalError:
+                raise
+            except Exception as e:
+                dead.append(payload)
+                log_event(logger, logging.ERROR, 'callback_batch.dead_letter', exc_info=True,
+                          batch=os.path.basename(path), error=str(e))
+        if dead:
+            dead_dir = os.path.join(self.spool_dir, 'dead-letter')
+            os.makedirs(dead_dir, exist_ok=True)
+            with open(os.path.join(dead_dir, os.path.basename(path)), 'a') as f:
+                for payload in dead:
+                    f.write(json.dumps(payload, separators=(',', ':')) + '\n')
+            with self._lock:
+                self.dead_lettered += len(dead)
+        return results
+
+    def _drain(self):
+        with self._drain_lock:
+            for path in sorted(glob.glob(os.path.join(self.spool_dir, f'batch-{self.pid}-*.jsonl'))):
+                payloads = _read_spool(path)
+                try:
+                    try:
+                        results = self._apply(payloads)
+                    except OperationalError:
+                        raise
+                    except Exception as e:
+                        with self._lock:
+                            self.failures += 1
+                        log_event(logger, logging.WARNING, 'callback_batch.split', exc_info=True,
+                                  batch=os.path.basename(path), callbacks=len(payloads), error=str(e))
+                        results = self._apply_one_by_one(path, payloads)
+                except OperationalError as e:
+                    # Database unreachable: leave the file for the next flush to retry
+                    with self._lock:
+                        self.failures += 1
+                    log_event(logger, logging.ERROR, 'callback_batch.failed', exc_info=True,
+                              batch=os.path.basename(path), callbacks=len(payloads), error=str(e))
+                    return
+                os.remove(path)
+                log_event(logger, logging.INFO, 'callback_batch.applied', batch=os.path.basename(path),
+                          callbacks=len(payloads), settled=sum(1 for _, status, _ in results if status == 'completed'))
+                with self._lock:
+                    self.applied += len(payloads)
+                    self.batches += 1
+
+
+def _read_spool(path):
+    payloads = []
+    with open(path) as f:
+        for line in f:
+            try:
+                payloads.append(json.loads(line))
+            except ValueError:
+                # Partial line from a crash mid-write; it was never acknowledged
+                continue
+    return payloads
+
+
+def init_ingest(app):
+    """Start the callback batcher when CALLBACK_INGEST_MODE=batch"""
+    if app.config['CALLBACK_INGEST_MODE'] != 'batch':
+        return None
+    batcher = CallbackBatcher(
+        app,
+        spool_dir=app.config['CALLBACK_SPOOL_DIR'],
+        batch_size=app.config['CALLBACK_BATCH_SIZE'],
+        flush_interval=app.config['CALLBACK_FLUSH_INTERVAL'],
+        fsync=app.config['CALLBACK_SPOOL_FSYNC']
+    ).start()
+    app.extensions['callback_batcher'] = batcher
+    return batcher
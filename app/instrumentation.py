@@ -0,0 +1,340 @@
+# Request metrics, SQL and Safaricom call timings, Prometheus /metrics and a slow-request profiler
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import Counter as Tally
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+PREFIX = 'finance_'
+
+
+def _label_text(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus exposition layout"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            snapshot = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = _label_text(self.labels, key, f'le="{bound}"')
+                yield f'{self.name}_bucket{le} {cumulative}'
+            le = _label_text(self.labels, key, 'le="+Inf"')
+            yield f'{self.name}_bucket{le} {count}'
+            yield f'{self.name}_sum{_label_text(self.labels, key)} {total}'
+            yield f'{self.name}_count{_label_text(self.labels, key)} {count}'
+
+
+class Registry:
+    """Process-local metrics plus gauges read from components' stats() dicts"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = {}
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(PREFIX + name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register_stats(self, component, stats):
+        """Export each numeric value of ``stats()`` as finance_<component>_<key>"""
+        self.collectors[component] = stats
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        for component, stats in sorted(self.collectors.items()):
+            try:
+                values = stats() or {}
+            except Exception:
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f'{PREFIX}{component}_{key}'
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Registry()
+request_latency = metrics.histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint', ('endpoint', 'method', 'status'))
+request_queries = metrics.histogram(
+    'http_request_sql_queries', 'SQL statements executed per request', ('endpoint',), QUERY_BUCKETS)
+request_sql_time = metrics.histogram(
+    'http_request_sql_seconds', 'Time spent in SQL per request', ('endpoint',))
+sql_latency = metrics.histogram(
+    'sql_statement_duration_seconds', 'SQL statement latency by verb', ('verb',))
+outbound_latency = metrics.histogram(
+    'mpesa_request_duration_seconds', 'Safaricom API call latency per attempt', ('path', 'outcome'))
+_in_flight = [0]
+_in_flight_lock = threading.Lock()
+
+
+def observe_outbound(path, start, outcome):
+    """Record one outbound Safaricom attempt that began at ``start`` (perf_counter)"""
+    outbound_latency.observe(time.perf_counter() - start, path=path, outcome=outcome)
+
+
+# ---------------------------------------------------------------------------
+# SQL timing via SQLAlchemy engine events
+# ---------------------------------------------------------------------------
+
+_sql_hooked = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    sql_latency.observe(elapsed, verb=statement.lstrip().split(None, 1)[0].upper() if statement.strip() else '')
+    if has_request_context() and '_metrics' in g:
+        g._metrics['queries'] += 1
+        g._metrics['sql_seconds'] += elapsed
+
+
+def hook_sql():
+    """Listen on every Engine once per process"""
+    global _sql_hooked
+    if _sql_hooked:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _sql_hooked = True
+
+
+# ---------------------------------------------------------------------------
+# Sampling profiler for slow requests
+# ---------------------------------------------------------------------------
+
+class SlowRequestProfiler:
+    """Samples the stacks of in-flight request threads every ``interval`` seconds.
+
+    Sampling reads ``sys._current_frames()`` from one background thread, so
+    request threads pay nothing but a dict insert. When a request takes at
+    least ``threshold`` seconds its samples are written in collapsed-stack
+    format (``frame;frame;frame count``), which flamegraph.pl, speedscope and
+    inferno read directly. Only the newest ``keep`` files are kept.
+    """
+
+    def __init__(self, directory, threshold=1.0, interval=0.005, keep=200):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self.keep = keep
+        self.pid = None
+        self.written = 0
+        self._active = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            # A fork (gunicorn --preload) leaves the child without our thread
+            if self.pid == os.getpid():
+                return self
+            if self.pid is None:
+                atexit.register(self.stop)
+            self.pid = os.getpid()
+            self._active = {}
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run, name='slow-request-profiler', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+
+    def begin(self):
+        self.start()
+        samples = Tally()
+        with self._lock:
+            self._active[threading.get_ident()] = samples
+        return samples
+
+    def end(self, samples, elapsed, label):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+        if elapsed < self.threshold or not samples:
+            return None
+        with self._lock:
+            self.written += 1
+            seq = self.written
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{int(elapsed * 1000)}ms-{label}-{os.getpid()}-{seq}.folded"
+        path = os.path.join(self.directory, name.replace('/', '_'))
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        self._prune()
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._active), 'written': self.written}
+
+    def _prune(self):
+        files = sorted(
+            (os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.folded')),
+            key=os.path.getmtime
+        )
+        for path in files[:-self.keep]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stopped:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for ident, samples in active.items():
+                frame = frames.get(ident)
+                if frame is None or ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                samples[';'.join(reversed(stack))] += 1
+
+
+# ---------------------------------------------------------------------------
+# Flask wiring
+# ---------------------------------------------------------------------------
+
+def _before_request():
+    g._metrics = {'start': time.perf_counter(), 'queries': 0, 'sql_seconds': 0.0, 'samples': None}
+    with _in_flight_lock:
+        _in_flight[0] += 1
+    profiler = current_app.extensions.get('slow_request_profiler')
+    if profiler is not None:
+        g._metrics['samples'] = profiler.begin()
+
+
+def _after_request(response):
+    stats = g.get('_metrics')
+    if stats is None:
+        return response
+    elapsed = stats['elapsed'] = time.perf_counter() - stats['start']
+    endpoint = request.endpoint or 'unmatched'
+    request_latency.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    request_queries.observe(stats['queries'], endpoint=endpoint)
+    request_sql_time.observe(stats['sql_seconds'], endpoint=endpoint)
+    response.headers['Server-Timing'] = (
+        f"app;dur={elapsed * 1000:.1f}, db;dur={stats['sql_seconds'] * 1000:.1f};desc=\"{stats['queries']} queries\""
+    )
+    return response
+
+
+def _teardown_request(exc):
+    # Runs even when an exception skipped after_request
+    stats = g.pop('_metrics', None)
+    if stats is None:
+        return
+    with _in_flight_lock:
+        _in_flight[0] -= 1
+    if stats['samples'] is not None:
+        elapsed = stats.get('elapsed', time.perf_counter() - stats['start'])
+        current_app.extensions['slow_request_profiler'].end(stats['samples'], elapsed, request.endpoint or 'unmatched')
+
+
+def metrics_view():
+    """Prometheus text exposition of this worker's metrics"""
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_instrumentation(app):
+    """Register request hooks, SQL timing, /metrics and (opt-in) the slow-request profiler"""
+    if not app.config['METRICS_ENABLED']:
+        return
+    hook_sql()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    # Endpoint names, SQL timings and queue depths are not for the public internet
+    if app.config['METRICS_TOKEN'] or app.config['METRICS_PUBLIC']:
+        app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    metrics.register_stats('requests', lambda: {'in_flight': _in_flight[0]})
+    from app.cache import cache
+    from app.dispatch import dispatcher
+    from app.payments import token_cache_stats
+    from app.auth import password_hasher, login_throttle
+    metrics.register_stats('cache', cache.stats)
+    metrics.register_stats('stk_dispatch', dispatcher.stats)
+    metrics.register_stats('mpesa_token', token_cache_stats)
+    metrics.register_stats('password_hash', password_hasher.stats)
+    metrics.register_stats('login_throttle', login_throttle.stats)
+    for component, name in (('callback_batcher', 'callback_batcher'), ('rollups', 'rollup_compactor'),
+                            ('logs', 'log_pipeline'), ('reconciler', 'pending_reconciler')):
+        if name in app.extensions:
+            metrics.register_stats(component, app.extensions[name].stats)
+
+    if app.config['PROFILE_SLOW_MS'] > 0:
+        profiler = SlowRequestProfiler(
+            app.config['PROFILE_DIR'],
+            threshold=app.config['PROFILE_SLOW_MS'] / 1000,
+            interval=app.config['PROFILE_INTERVAL_MS'] / 1000
+        )
+        app.extensions['slow_request_profiler'] = profiler
+        metrics.register_stats('profiler', profiler.stats)
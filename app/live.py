@@ -0,0 +1,149 @@
+# Server-Sent Events: push payment and progress updates to open browsers
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response
+
+from app.cache import event_snapshot
+
+
+class Hub:
+    """In-process fan-out of published messages to SSE subscriber queues"""
+
+    def __init__(self, max_queue=50):
+        self.max_queue = max_queue
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, channel):
+        q = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers[channel].add(q)
+        return q
+
+    def unsubscribe(self, channel, q):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    def deliver(self, channel, message):
+        """Hand an already serialised message to every local subscriber"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+            self.published += 1
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # A stalled client must not hold up the broadcast
+                with self._lock:
+                    self.dropped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._subscribers),
+                'subscribers': sum(len(s) for s in self._subscribers.values()),
+                'published': self.published,
+                'dropped': self.dropped
+            }
+
+
+class RedisBroker:
+    """Relay publishes through Redis pub/sub so every worker's hub receives them.
+
+    Needed when gunicorn runs several worker processes: the callback lands in
+    one worker while subscribers are spread across all of them. Requires the
+    optional ``redis`` package.
+    """
+
+    prefix = 'live:'
+
+    def __init__(self, url, hub):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('LIVE_BROKER_URL requires the redis package (pip install redis)')
+        self.client = redis.Redis.from_url(url)
+        self.hub = hub
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, message)
+
+    def ensure_listening(self):
+        # Started lazily so the thread is created in the worker, not pre-fork
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self.prefix + '*')
+        for item in pubsub.listen():
+            channel = item['channel'].decode()[len(self.prefix):]
+            self.hub.deliver(channel, item['data'].decode())
+
+
+# Singleton instances
+hub = Hub(max_queue=int(os.getenv('LIVE_QUEUE_SIZE', 50)))
+broker = RedisBroker(os.environ['LIVE_BROKER_URL'], hub) if os.getenv('LIVE_BROKER_URL') else None
+
+
+def publish(channel, data):
+    """Serialise once and broadcast to every subscriber of ``channel``"""
+    message = json.dumps(data)
+    if broker:
+        broker.publish(channel, message)
+    else:
+        hub.deliver(channel, message)
+
+
+def notify_payment(checkout_id, status, event_id=None):
+    """Broadcast a processed callback to its checkout and event channels"""
+    if checkout_id:
+        publish(f'checkout:{checkout_id}', {'checkout_request_id': checkout_id, 'status': status})
+    if event_id:
+        snapshot = event_snapshot(event_id)
+        if snapshot:
+            publish(f'event:{event_id}', snapshot)
+
+
+def stream(channel, initial=None, heartbeat=15, max_seconds=None):
+    """SSE response relaying ``channel``; browsers reconnect when it ends"""
+    if broker:
+        broker.ensure_listening()
+    max_seconds = max_seconds or int(os.getenv('LIVE_STREAM_MAX_SECONDS', 300))
+    q = hub.subscribe(channel)
+
+    def generate():
+        deadline = time.monotonic() + max_seconds
+        try:
+            yield 'retry: 3000\n\n'
+            if initial is not None:
+                yield f'data: {json.dumps(initial)}\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    message = q.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'data: {message}\n\n'
+        finally:
+            hub.unsubscribe(channel, q)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
@@ -0,0 +1,214 @@
+# Structured JSON logging through a background queue, with correlation ids and sampling
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from flask import g, request
+
+# Fields bound for the current request / task, merged into every record
+_context = contextvars.ContextVar('log_context', default={})
+# Records from these loggers (and their children) go through the pipeline
+LOGGER_NAME = 'app'
+SAMPLE_KEYS = ('contribution_id', 'checkout_id', 'request_id')
+
+
+def current_context():
+    return dict(_context.get())
+
+
+@contextmanager
+def bind(**fields):
+    """Add correlation fields to every record logged inside the block"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def log_event(logger, level, event, exc_info=False, **fields):
+    """Log a structured record: ``event`` is a stable dotted name, ``fields`` its data"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+
+def mask_phone(phone):
+    phone = str(phone or '')
+    return f'{phone[:4]}****{phone[-3:]}' if len(phone) > 7 else phone
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, event, correlation fields and data"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        data.update(getattr(record, 'context', None) or {})
+        data.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, default=str, separators=(',', ':'))
+
+
+class ContextFilter(logging.Filter):
+    """Capture the correlation context on the calling thread, before the record is queued"""
+
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of records at or below INFO; warnings and errors always pass.
+
+    The decision hashes the record's correlation id (contribution, then
+    checkout, then request id). A kept payment therefore keeps its whole
+    trail: creation, STK push and callback.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.dropped = 0
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        if rate >= 1.0:
+            return True
+        key = None
+        for name in SAMPLE_KEYS:
+            key = (getattr(record, 'fields', None) or {}).get(name) or record.context.get(name)
+            if key:
+                break
+        chance = zlib.crc32(str(key).encode()) / 0xFFFFFFFF if key else random.random()
+        if chance < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: when the queue is full the record is dropped and counted"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format args now; the listener thread may see mutated objects otherwise
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = logging.Formatter().formatException(record.exc_info) if record.exc_info else None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """Queue + listener thread that writes JSON lines to stdout or LOG_FILE"""
+
+    def __init__(self, level='INFO', path=None, queue_size=10000, sample_info=1.0, sample_debug=1.0):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.handler.addFilter(ContextFilter())
+        self.sampler = SamplingFilter({logging.INFO: sample_info, logging.DEBUG: sample_debug})
+        self.handler.addFilter(self.sampler)
+        output = logging.FileHandler(path) if path else logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, output, respect_handler_level=False)
+        self.level = level
+        self.pid = None
+        self.running = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            # A fork (gunicorn --preload) leaves the child without the listener thread
+            if self.pid == os.getpid():
+                return self
+            if self.pid is None:
+                atexit.register(self.stop)
+                os.register_at_fork(after_in_child=self.start)
+            self.pid = os.getpid()
+            self.listener.start()
+            self.running = True
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(self.level)
+        logger.propagate = False
+        if self.handler not in logger.handlers:
+            logger.addHandler(self.handler)
+        return self
+
+    def stop(self):
+        """Flush queued records (the listener drains the queue before exiting)"""
+        with self._lock:
+            if self.running and self.pid == os.getpid():
+                self.listener.stop()
+                self.running = False
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.handler.dropped, 'sampled_out': self.sampler.dropped}
+
+
+_pipeline = None
+
+
+def _bind_request():
+    request_id = (request.headers.get('X-Request-ID') or '')[:64] or uuid.uuid4().hex
+    g._log_token = _context.set({'request_id': request_id})
+
+
+def _tag_response(response):
+    response.headers['X-Request-ID'] = _context.get().get('request_id', '')
+    return response
+
+
+def _unbind_request(exc):
+    token = g.pop('_log_token', None)
+    if token is not None:
+        try:
+            _context.reset(token)
+        except ValueError:
+            # Streamed responses can finish in a different context
+            pass
+
+
+def init_logging(app):
+    """Start the process-wide JSON log pipeline and per-request correlation ids"""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = LogPipeline(
+            level=app.config['LOG_LEVEL'],
+            path=app.config['LOG_FILE'] or None,
+            queue_size=app.config['LOG_QUEUE_SIZE'],
+            sample_info=app.config['LOG_SAMPLE_INFO'],
+            sample_debug=app.config['LOG_SAMPLE_DEBUG']
+        )
+    _pipeline.start()
+    app.before_request(_bind_request)
+    app.after_request(_tag_response)
+    app.teardown_request(_unbind_request)
+    app.extensions['log_pipeline'] = _pipeline
+    return _pipeline
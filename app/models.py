@@ -1,7 +1,51 @@
 from app import db
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
 import enum
-from werkzeug.security import generate_password_hash, check_password_hash
+import json
+import zlib
+from sqlalchemy.dialects import postgresql, sqlite
+from app.auth import password_hasher
+
+CENT = Decimal('0.01')
+
+def to_money(value):
+    """Round an amount (int, float, str or Decimal) to whole cents as a Decimal"""
+    if isinstance(value, float):
+        # str() gives the shortest repr, so 0.1 becomes 0.10 rather than 0.1000000000000000055
+        value = str(value)
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+def cents_to_units(cents):
+    """Convert integer cents to KES in bulk for exports, without per-value Decimals"""
+    return [None if c is None else c / 100 for c in cents]
+
+def raw_cents(column):
+    """Select a Money column as its stored integer cents"""
+    return db.type_coerce(column, db.BigInteger)
+
+class Money(db.TypeDecorator):
+    """Amount stored as integer cents and exposed as a Decimal in KES.
+    
+    Sums and running totals are then exact integer arithmetic in the
+    database, and no rounding drift builds up across repeated increments.
+    """
+    impl = db.BigInteger
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(to_money(value) * 100)
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(int(value)).scaleb(-2)
+    
+    def coerce_compared_value(self, op, value):
+        # Keep literals in expressions like amount + 5 going through the cents conversion
+        return self
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -13,12 +57,16 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def set_password(self, password):
-        """Hash and set password"""
-        self.password_hash = generate_password_hash(password)
+        """Hash and set password on the password hashing pool"""
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        """Verify password"""
-        return check_password_hash(self.password_hash, password)
+        """Verify password on the password hashing pool"""
+        return password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        """True if the stored hash predates the configured method or cost"""
+        return password_hasher.needs_rehash(self.password_hash)
 
 class EventType(enum.Enum):
     BURIAL = "burial"
@@ -32,18 +80,23 @@ class Event(db.Model):
     __tablename__ = 'events'
     
     id = db.Column(db.Integer, primary_key=True)
-    admin_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    admin_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=False)
     event_type = db.Column(db.Enum(EventType), nullable=False, default=EventType.COMMUNITY)
     organizer_name = db.Column(db.String(100), nullable=False)
     organizer_phone = db.Column(db.String(20), nullable=False)
-    target_amount = db.Column(db.Float, nullable=False)
-    current_amount = db.Column(db.Float, default=0.0)
+    target_amount = db.Column(Money, nullable=False)
+    current_amount = db.Column(Money, default=0)
+    # Completed contributions, kept in sync with current_amount so listing
+    # events never has to load the contributions relationship
+    contribution_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     event_date = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    status = db.Column(db.String(20), default='active')  # active, closed, completed
+    status = db.Column(db.String(20), default='active', index=True)  # active, closed, completed
+    # Set once app.archive has moved the event's contributions to contributions_archive
+    archived_at = db.Column(db.DateTime, nullable=True)
     
     contributions = db.relationship('Contribution', backref='event', lazy=True, cascade='all, delete-orphan')
     admin = db.relationship('User', backref='events')
@@ -55,26 +108,84 @@ class Event(db.Model):
             'description': self.description,
             'event_type': self.event_type.value,
             'organizer_name': self.organizer_name,
-            'target_amount': self.target_amount,
-            'current_amount': self.current_amount,
-            'progress_percent': (self.current_amount / self.target_amount * 100) if self.target_amount > 0 else 0,
+            'target_amount': float(self.target_amount),
+            'current_amount': float(self.current_amount or 0),
+            'progress_percent': float((self.current_amount or 0) / self.target_amount * 100) if self.target_amount > 0 else 0,
             'event_date': self.event_date.isoformat() if self.event_date else None,
             'created_at': self.created_at.isoformat(),
             'status': self.status,
-            'contribution_count': len(self.contributions)
+            'contribution_count': self.contribution_count
         }
+    
+    @classmethod
+    def add_to_total(cls, event_id, amount, count=1):
+        """Atomically add to an event's running totals with a single UPDATE"""
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id == event_id)
+            .values(
+                current_amount=db.func.coalesce(cls.current_amount, 0) + amount,
+                contribution_count=cls.contribution_count + count
+            )
+        )
+    
+    @classmethod
+    def contribution_model(cls, event_id):
+        """Model holding an event's contributions: Contribution, or ContributionArchive once archived"""
+        archived = db.session.scalar(db.select(cls.archived_at).where(cls.id == event_id))
+        return ContributionArchive if archived else Contribution
+    
+    @classmethod
+    def completed_totals_subquery(cls):
+        """Aggregate of completed contributions per event, hot and archived"""
+        completed = db.union_all(*(
+            db.select(model.event_id, model.amount, model.id).where(model.status == 'completed')
+            for model in (Contribution, ContributionArchive)
+        )).subquery()
+        return (
+            db.select(
+                completed.c.event_id.label('event_id'),
+                db.func.sum(completed.c.amount).label('total'),
+                db.func.count(completed.c.id).label('count')
+            )
+            .group_by(completed.c.event_id)
+            .subquery()
+        )
+    
+    @classmethod
+    def rebuild_totals(cls):
+        """Recompute every event's totals from completed contributions, hot and archived"""
+        completed_sum = completed_count = 0
+        for model in (Contribution, ContributionArchive):
+            completed = db.select(model).where(model.event_id == cls.id, model.status == 'completed')
+            completed_sum += completed.with_only_columns(
+                db.func.coalesce(db.func.sum(model.amount), 0)
+            ).scalar_subquery()
+            completed_count += completed.with_only_columns(db.func.count(model.id)).scalar_subquery()
+        result = db.session.execute(
+            db.update(cls).values(current_amount=completed_sum, contribution_count=completed_count)
+        )
+        return result.rowcount
 
 class Contribution(db.Model):
     __tablename__ = 'contributions'
+    __table_args__ = (
+        # Public pages list an event's contributions by status, newest first
+        db.Index('ix_contributions_event_id_status_created_at', 'event_id', 'status', 'created_at'),
+        # The pending reconciler walks stale pending rows oldest first, across events
+        db.Index('ix_contributions_status_created_at', 'status', 'created_at'),
+        # Ids are ledger source ids, so SQLite must not reuse those of archived rows
+        {'sqlite_autoincrement': True},
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
     contributor_name = db.Column(db.String(100), nullable=False)
     contributor_phone = db.Column(db.String(20), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     payment_method = db.Column(db.String(50), default='mpesa')  # mpesa, bank, cash
     transaction_id = db.Column(db.String(100), unique=True, nullable=True)
-    status = db.Column(db.String(20), default='pending')  # pending, completed, failed
+    status = db.Column(db.String(20), default='pending')  # pending, completed, failed, expired
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -83,25 +194,85 @@ class Contribution(db.Model):
             'id': self.id,
             'event_id': self.event_id,
             'contributor_name': self.contributor_name,
-            'amount': self.amount,
+            'amount': float(self.amount),
             'payment_method': self.payment_method,
             'status': self.status,
             'created_at': self.created_at.isoformat()
         }
 
+class ContributionArchive(db.Model):
+    """Contributions of closed events, moved out of the hot table by app.archive.
+    
+    Same columns as Contribution plus archived_at. The primary key includes
+    created_at so that on PostgreSQL the table can be range-partitioned by
+    month (partitions are created by app.archive as rows arrive).
+    """
+    __tablename__ = 'contributions_archive'
+    __table_args__ = (
+        db.Index('ix_contributions_archive_event_id_created_at', 'event_id', 'created_at', 'id'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
+    contributor_name = db.Column(db.String(100), nullable=False)
+    contributor_phone = db.Column(db.String(20), nullable=False)
+    amount = db.Column(Money, nullable=False)
+    payment_method = db.Column(db.String(50))
+    transaction_id = db.Column(db.String(100), nullable=True)
+    status = db.Column(db.String(20))
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, nullable=False)
+    
+    to_dict = Contribution.to_dict
+
 class PaymentCallback(db.Model):
     __tablename__ = 'payment_callbacks'
     
     id = db.Column(db.Integer, primary_key=True)
     contribution_id = db.Column(db.Integer, db.ForeignKey('contributions.id'), nullable=True)
-    transaction_id = db.Column(db.String(100))
-    mpesa_receipt_number = db.Column(db.String(100))
+    # CheckoutRequestID of the STK push; unique so retried deliveries are rejected
+    transaction_id = db.Column(db.String(100), unique=True, index=True)
+    mpesa_receipt_number = db.Column(db.String(100), unique=True, index=True)
     phone_number = db.Column(db.String(20))
-    amount = db.Column(db.Float)
+    amount = db.Column(Money)
     status = db.Column(db.String(50))
     raw_response = db.Column(db.JSON)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class PaymentCallbackArchive(db.Model):
+    """Old M-Pesa callbacks, moved out of payment_callbacks by app.archive.
+    
+    raw_response is stored zlib-compressed; range-partitioned by month on
+    PostgreSQL like ContributionArchive.
+    """
+    __tablename__ = 'payment_callbacks_archive'
+    __table_args__ = (
+        db.Index('ix_payment_callbacks_archive_transaction_id', 'transaction_id'),
+        db.Index('ix_payment_callbacks_archive_contribution_id', 'contribution_id'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime, primary_key=True)
+    contribution_id = db.Column(db.Integer, nullable=True)
+    transaction_id = db.Column(db.String(100))
+    mpesa_receipt_number = db.Column(db.String(100))
+    phone_number = db.Column(db.String(20))
+    amount = db.Column(Money)
+    status = db.Column(db.String(50))
+    raw_response_z = db.Column(db.LargeBinary)
+    archived_at = db.Column(db.DateTime, nullable=False)
+    
+    @staticmethod
+    def compress(raw_response):
+        return zlib.compress(json.dumps(raw_response, separators=(',', ':')).encode(), 6)
+    
+    @property
+    def raw_response(self):
+        return json.loads(zlib.decompress(self.raw_response_z)) if self.raw_response_z else None
+
 class ExpenditureCategory(enum.Enum):
     SUPPLIES = "supplies"
     LABOR = "labor"
@@ -114,11 +285,16 @@ class ExpenditureCategory(enum.Enum):
 
 class Expenditure(db.Model):
     __tablename__ = 'expenditures'
+    __table_args__ = (
+        db.Index('ix_expenditures_event_id_created_at', 'event_id', 'created_at'),
+        # Ids are ledger source ids, so SQLite must not reuse those of deleted rows
+        {'sqlite_autoincrement': True},
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
     description = db.Column(db.String(200), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     category = db.Column(db.Enum(ExpenditureCategory), nullable=False, default=ExpenditureCategory.OTHER)
     approved_by = db.Column(db.String(100))  # Name of person approving
     receipt_url = db.Column(db.String(500))  # Optional: URL to receipt/proof
@@ -132,8 +308,228 @@ class Expenditure(db.Model):
             'id': self.id,
             'event_id': self.event_id,
             'description': self.description,
-            'amount': self.amount,
+            'amount': float(self.amount),
             'category': self.category.value,
             'approved_by': self.approved_by,
             'created_at': self.created_at.isoformat()
         }
+    
+    @classmethod
+    def summarize(cls, event_id):
+        """Total, count and per-category breakdown in one GROUP BY query"""
+        rows = db.session.execute(
+            db.select(cls.category, db.func.sum(cls.amount), db.func.count(cls.id))
+            .where(cls.event_id == event_id)
+            .group_by(cls.category)
+        ).all()
+        return {
+            'total': float(sum(total for _, total, _ in rows)),
+            'count': sum(count for _, _, count in rows),
+            'by_category': {category.value: float(total) for category, total, _ in rows}
+        }
+
+class EventBalance(db.Model):
+    """Materialised raised/spent totals per event, maintained by LedgerEntry"""
+    __tablename__ = 'event_balances'
+    
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), primary_key=True)
+    raised = db.Column(Money, nullable=False, default=0, server_default='0')
+    spent = db.Column(Money, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    @property
+    def balance(self):
+        return self.raised - self.spent
+    
+    def to_dict(self):
+        return {
+            'event_id': self.event_id,
+            'raised': float(self.raised),
+            'spent': float(self.spent),
+            'balance': float(self.balance)
+        }
+    
+    @classmethod
+    def for_event(cls, event_id):
+        """The event's balance row, or zeros if nothing has been posted yet"""
+        return db.session.get(cls, event_id) or cls(event_id=event_id, raised=Decimal('0.00'), spent=Decimal('0.00'))
+    
+    @classmethod
+    def apply(cls, event_id, raised=0, spent=0):
+        """Atomically adjust an event's totals and return its new balance.
+        
+        One INSERT ... ON CONFLICT (event_id) DO UPDATE, so the first postings
+        of an event with no balance row yet cannot both insert it. Either way
+        the row stays locked until commit, which also serialises the running
+        balances stamped on concurrent ledger entries.
+        """
+        insert = postgresql.insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+        stmt = insert(cls).values(event_id=event_id, raised=raised, spent=spent, updated_at=datetime.utcnow())
+        return db.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[cls.event_id],
+                set_={'raised': cls.raised + stmt.excluded.raised, 'spent': cls.spent + stmt.excluded.spent,
+                      'updated_at': stmt.excluded.updated_at}
+            )
+            .returning(db.type_coerce(cls.raised - cls.spent, Money))
+        ).scalar()
+
+class LedgerEntry(db.Model):
+    """Append-only record of money moving into or out of an event.
+    
+    Contributions post positive amounts and expenditures negative ones; a
+    deleted expenditure is reversed by a new entry rather than removed.
+    balance_after is the event's running balance once the entry applied, so
+    the balance at any past moment is a single index range lookup.
+    """
+    __tablename__ = 'ledger_entries'
+    __table_args__ = (
+        db.Index('ix_ledger_entries_event_id_created_at', 'event_id', 'created_at', 'id'),
+        # Each source document is posted once per entry type
+        db.UniqueConstraint('source_type', 'source_id', 'entry_type', name='uq_ledger_entries_source'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
+    entry_type = db.Column(db.String(30), nullable=False)  # contribution, expenditure, expenditure_reversal
+    source_type = db.Column(db.String(30), nullable=False)  # contribution, expenditure
+    source_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(Money, nullable=False)
+    balance_after = db.Column(Money, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'event_id': self.event_id,
+            'entry_type': self.entry_type,
+            'source_type': self.source_type,
+            'source_id': self.source_id,
+            'amount': float(self.amount),
+            'balance_after': float(self.balance_after),
+            'created_at': self.created_at.isoformat()
+        }
+    
+    @classmethod
+    def post_contributions(cls, event_id, contributions):
+        """Credit completed contributions of one event: one balance update, one insert"""
+        amounts = [to_money(contribution.amount) for contribution in contributions]
+        balance = EventBalance.apply(event_id, raised=sum(amounts)) - sum(amounts)
+        now = datetime.utcnow()
+        rows = []
+        for contribution, amount in zip(contributions, amounts):
+            balance += amount
+            rows.append({
+                'event_id': event_id,
+                'entry_type': 'contribution',
+                'source_type': 'contribution',
+                'source_id': contribution.id,
+                'amount': amount,
+                'balance_after': balance,
+                'created_at': now
+            })
+        if rows:
+            db.session.execute(db.insert(cls), rows)
+    
+    @classmethod
+    def post_expenditure(cls, expenditure, reversal=False):
+        """Debit an expenditure, or credit it back when it is deleted"""
+        amount = to_money(expenditure.amount)
+        if not reversal:
+            amount = -amount
+        balance = EventBalance.apply(expenditure.event_id, spent=-amount)
+        db.session.execute(db.insert(cls).values(
+            event_id=expenditure.event_id,
+            entry_type='expenditure_reversal' if reversal else 'expenditure',
+            source_type='expenditure',
+            source_id=expenditure.id,
+            amount=amount,
+            balance_after=balance,
+            created_at=datetime.utcnow()
+        ))
+    
+    @classmethod
+    def balance_at(cls, event_id, when):
+        """The event's balance as of ``when`` (0 before its first entry)"""
+        balance = db.session.execute(
+            db.select(cls.balance_after)
+            .where(cls.event_id == event_id, cls.created_at <= when)
+            .order_by(cls.created_at.desc(), cls.id.desc())
+            .limit(1)
+        ).scalar()
+        return balance if balance is not None else Decimal('0.00')
+    
+    @classmethod
+    def backfill(cls):
+        """Post any completed contribution or expenditure missing from the
+        ledger, then recompute running balances and EventBalance rows.
+        
+        Safe to re-run. Returns (entries posted, events balanced).
+        """
+        def unposted(model, source_type):
+            return ~db.exists().where(cls.source_type == source_type, cls.source_id == model.id)
+        
+        columns = ['event_id', 'entry_type', 'source_type', 'source_id', 'amount', 'balance_after', 'created_at']
+        contributions = db.select(
+            Contribution.event_id, db.literal('contribution'), db.literal('contribution'), Contribution.id,
+            Contribution.amount, db.literal(0), db.func.coalesce(Contribution.updated_at, Contribution.created_at)
+        ).where(Contribution.status == 'completed', unposted(Contribution, 'contribution'))
+        expenditures = db.select(
+            Expenditure.event_id, db.literal('expenditure'), db.literal('expenditure'), Expenditure.id,
+            -Expenditure.amount, db.literal(0), Expenditure.created_at
+        ).where(unposted(Expenditure, 'expenditure'))
+        posted = db.session.execute(db.insert(cls).from_select(columns, contributions)).rowcount
+        posted += db.session.execute(db.insert(cls).from_select(columns, expenditures)).rowcount
+        
+        running = db.select(
+            cls.id,
+            db.func.sum(cls.amount).over(partition_by=cls.event_id, order_by=(cls.created_at, cls.id)).label('balance')
+        ).subquery()
+        db.session.execute(
+            db.update(cls).where(cls.id == running.c.id).values(balance_after=running.c.balance),
+            execution_options={'synchronize_session': False}
+        )
+        
+        totals = db.select(
+            Event.id,
+            db.func.coalesce(db.func.sum(db.case((cls.source_type == 'contribution', cls.amount), else_=0)), 0),
+            db.func.coalesce(db.func.sum(db.case((cls.source_type == 'expenditure', -cls.amount), else_=0)), 0),
+            db.func.now()
+        ).outerjoin(cls, cls.event_id == Event.id).group_by(Event.id)
+        db.session.execute(db.delete(EventBalance))
+        balanced = db.session.execute(
+            db.insert(EventBalance).from_select(['event_id', 'raised', 'spent', 'updated_at'], totals)
+        ).rowcount
+        return posted, balanced
+
+class ContributionRollup(db.Model):
+    """Completed contributions per event per minute, hour or day.
+    
+    Maintained by app.rollups.compact() so charts and /stats never scan
+    the contributions table.
+    """
+    __tablename__ = 'contribution_rollups'
+    
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), primary_key=True)
+    granularity = db.Column(db.String(10), primary_key=True)  # minute, hour, day
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(Money, nullable=False, default=0)
+    contributors = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'bucket_start': self.bucket_start.isoformat(),
+            'count': self.count,
+            'amount': float(self.amount),
+            'contributors': self.contributors
+        }
+
+class RollupState(db.Model):
+    """Watermark of the last ledger entry folded into the rollups"""
+    __tablename__ = 'rollup_state'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    last_entry_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
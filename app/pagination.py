@@ -0,0 +1,68 @@
+# Keyset pagination and NDJSON streaming for list endpoints
+import base64
+import json
+from datetime import datetime
+
+from flask import Response, jsonify, stream_with_context
+
+from app import db
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_CHUNK = 1000
+
+
+def encode_cursor(row):
+    """Opaque cursor pointing just past ``row`` in (created_at, id) order"""
+    raw = f"{row.created_at.isoformat()}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    created_at, row_id = raw.rsplit('|', 1)
+    return datetime.fromisoformat(created_at), int(row_id)
+
+
+def page_args(args):
+    """Read ``limit`` and ``cursor`` from request args; raises ValueError"""
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    cursor = args.get('cursor')
+    return min(limit, MAX_LIMIT), decode_cursor(cursor) if cursor else None
+
+
+def keyset_page(query, model, limit, after=None):
+    """Return (rows, next_cursor) for ``query`` ordered newest first.
+
+    Seeks past the (created_at, id) of the previous page instead of using
+    OFFSET, so every page costs the same index range scan.
+    """
+    query = query.order_by(model.created_at.desc(), model.id.desc())
+    if after:
+        query = query.filter(db.tuple_(model.created_at, model.id) < after)
+    rows = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def ndjson_response(query, model, chunk=STREAM_CHUNK):
+    """Stream ``query`` as newline-delimited JSON from a server-side cursor"""
+    query = query.order_by(model.created_at.desc(), model.id.desc())
+
+    def generate():
+        # yield_per fetches rows in chunks (a named cursor on Postgres), so
+        # memory stays flat however many rows the event has
+        for row in query.yield_per(chunk):
+            yield json.dumps(row.to_dict()) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def paginated_json(rows, next_cursor):
+    """JSON list response with the next page cursor in X-Next-Cursor"""
+    response = jsonify([row.to_dict() for row in rows])
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
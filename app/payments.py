@@ -1,18 +1,258 @@
 # STK Push Handler for Till Payments
-import requests
-import json
 from datetime import datetime
+import logging
 import os
-from requests.auth import HTTPBasicAuth
+import random
 import base64
+import threading
+import time
+from urllib.parse import urlsplit
+from sqlalchemy.exc import IntegrityError
 
 from app import db
-from app.models import Contribution, PaymentCallback, Event
+from app.models import Contribution, PaymentCallback, Event, LedgerEntry
+from app.idempotency import seen_callbacks
+from app.cache import invalidate_event
+from app.live import notify_payment
+from app.instrumentation import observe_outbound
+from app.logs import log_event, mask_phone
+
+logger = logging.getLogger(__name__)
+
+class AccessTokenCache:
+    """Thread-safe cache for the Daraja OAuth token.
+
+    The token is reused until it is within ``refresh_margin`` seconds of its
+    ``expires_in``; inside that window callers still get the cached token while
+    a single background refresh runs. Once the token has expired, concurrent
+    callers wait on one shared in-flight fetch instead of each calling the
+    OAuth endpoint (single-flight).
+    """
+    
+    def __init__(self, fetch, refresh_margin=60, wait_timeout=15, clock=time.monotonic):
+        # fetch() must return (token, expires_in_seconds) or None on failure
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.wait_timeout = wait_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._inflight = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+    
+    def get(self):
+        """Return a valid token, fetching or refreshing it as needed"""
+        with self._lock:
+            now = self._clock()
+            if self._token and now < self._expires_at:
+                self.hits += 1
+                if now >= self._expires_at - self.refresh_margin:
+                    done, leader = self._claim_refresh()
+                    if leader:
+                        threading.Thread(target=self._refresh, args=(done,), daemon=True).start()
+                return self._token
+            self.misses += 1
+            done, leader = self._claim_refresh()
+        
+        if leader:
+            self._refresh(done)
+        else:
+            done.wait(self.wait_timeout)
+        
+        with self._lock:
+            if self._token and self._clock() < self._expires_at:
+                return self._token
+            return None
+    
+    def invalidate(self):
+        """Drop the cached token, e.g. after Safaricom rejects it with a 401"""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'ttl_seconds': max(0.0, self._expires_at - self._clock()) if self._token else 0.0,
+            }
+    
+    def _claim_refresh(self):
+        """Return (event, is_leader); caller must hold the lock"""
+        if self._inflight is None:
+            self._inflight = threading.Event()
+            return self._inflight, True
+        return self._inflight, False
+    
+    def _refresh(self, done):
+        try:
+            result = self._fetch()
+        except Exception as e:
+            log_event(logger, logging.ERROR, 'mpesa.token_refresh_failed', error=str(e))
+            result = None
+        with self._lock:
+            self.refreshes += 1
+            if result:
+                token, expires_in = result
+                self._token = token
+                self._expires_at = self._clock() + expires_in
+            else:
+                self.failures += 1
+            self._inflight = None
+        done.set()
+
+
+def build_session(pool_size=10):
+    """Create a keep-alive Session with a connection pool of ``pool_size``"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def settle_contribution(contribution, receipt):
+    """Mark a contribution completed, add it to its event total and post it
+    to the ledger. Returns False if it was already completed.
+    
+    The status change is one UPDATE guarded by status != 'completed', so when
+    the pending reconciler or another delivery settles the row between our
+    read and our commit, only one of them counts it. The total is bumped with
+    a single UPDATE so concurrent callbacks for the same event cannot
+    overwrite each other's increments.
+    """
+    settled = db.session.execute(
+        db.update(Contribution)
+        .where(Contribution.id == contribution.id, Contribution.status != 'completed')
+        .values(status='completed', transaction_id=receipt)
+    ).rowcount
+    if settled != 1:
+        return False
+    Event.add_to_total(contribution.event_id, contribution.amount)
+    LedgerEntry.post_contributions(contribution.event_id, [contribution])
+    return True
+
+
+def fail_contribution(contribution_id):
+    """Mark a contribution failed after its STK push could not be sent.
+
+    Guarded by status = 'pending': a push that timed out may still have
+    reached the phone, and a callback that completed it in the meantime wins.
+    """
+    db.session.execute(
+        db.update(Contribution)
+        .where(Contribution.id == contribution_id, Contribution.status == 'pending')
+        .values(status='failed')
+    )
+    db.session.commit()
+
+
+def normalize_phone(phone_number):
+    """Return a phone number as 2547XXXXXXXX / 2541XXXXXXXX, or None if it isn't one"""
+    if isinstance(phone_number, float) and phone_number.is_integer():
+        # Spreadsheets hand phone columns back as floats
+        phone_number = int(phone_number)
+    phone_number = str(phone_number).strip().replace(' ', '').replace('-', '')
+    if phone_number.startswith('+'):
+        phone_number = phone_number[1:]
+    if phone_number.startswith('0'):
+        phone_number = '254' + phone_number[1:]
+    elif phone_number.startswith(('7', '1')):
+        phone_number = '254' + phone_number[-9:]
+    if phone_number.startswith('254') and len(phone_number) == 12 and phone_number.isdigit():
+        return phone_number
+    return None
+
+
+def is_stk_callback(callback_data):
+    """True if ``callback_data`` has the Body.stkCallback shape parse_stk_callback expects"""
+    if not isinstance(callback_data, dict):
+        return False
+    body = callback_data.get('Body')
+    result = body.get('stkCallback') if isinstance(body, dict) else None
+    if not isinstance(result, dict) or not isinstance(result.get('CheckoutRequestID'), str):
+        return False
+    metadata = result.get('CallbackMetadata', {})
+    return isinstance(metadata, dict) and isinstance(metadata.get('Item', []), list) \
+        and all(isinstance(item, dict) for item in metadata.get('Item', []))
+
+
+def parse_stk_callback(callback_data):
+    """Flatten an stkCallback body into the fields we store"""
+    result = callback_data.get('Body', {}).get('stkCallback', {})
+    parsed = {
+        'checkout_id': result.get('CheckoutRequestID'),
+        'account_ref': result.get('MerchantRequestID', '') or result.get('AccountReference', ''),
+        'result_code': result.get('ResultCode', -1),
+        'result_desc': result.get('ResultDesc'),
+        'amount': None,
+        'receipt': None,
+        'phone': None,
+        'date': None
+    }
+    if parsed['result_code'] == 0:
+        for item in result.get('CallbackMetadata', {}).get('Item', []):
+            name = item.get('Name')
+            value = item.get('Value')
+            if name == 'Amount':
+                parsed['amount'] = value
+            elif name == 'MpesaReceiptNumber':
+                parsed['receipt'] = value
+            elif name == 'PhoneNumber':
+                parsed['phone'] = value
+            elif name == 'TransactionDate':
+                parsed['date'] = value
+    return parsed
+
+
+def record_callback(parsed, callback_data):
+    """Store the PaymentCallback row for a delivery, unless it was seen before.
+    
+    Returns None for a duplicate. Recently processed CheckoutRequestIDs are
+    answered from an in-process LRU; anything else relies on the unique
+    indexes on transaction_id / mpesa_receipt_number, so the insert itself is
+    the idempotency check and a duplicate never reaches Contribution or Event.
+    """
+    key = parsed['checkout_id']
+    if key and key in seen_callbacks:
+        return None
+    
+    callback = PaymentCallback(
+        raw_response=callback_data,
+        transaction_id=key,
+        status='success' if parsed['result_code'] == 0 else 'failed',
+        mpesa_receipt_number=parsed['receipt'],
+        phone_number=parsed['phone'],
+        amount=parsed['amount'],
+        contribution_id=None
+    )
+    db.session.add(callback)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        if key:
+            seen_callbacks.add(key)
+        return None
+    return callback
+
 
 class STKPushHandler:
     """Handle M-Pesa STK Push payment requests (Till)"""
     
-    def __init__(self):
+    def __init__(self, session=None):
+        # Imported here, not at module level, so a worker only loads requests when it first talks to Daraja
+        import requests
+        self.requests = requests
         self.consumer_key = os.getenv('MPESA_CONSUMER_KEY', '')
         self.consumer_secret = os.getenv('MPESA_CONSUMER_SECRET', '')
         self.business_shortcode = os.getenv('MPESA_SHORTCODE', '')
@@ -25,59 +265,112 @@ class STKPushHandler:
         self.environment = os.getenv('MPESA_ENV', 'sandbox')
         
         if self.environment == 'sandbox':
-            self.auth_url = 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-            self.stk_url = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
+            base_url = 'https://sandbox.safaricom.co.ke'
         else:
-            self.auth_url = 'https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-            self.stk_url = 'https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
+            base_url = 'https://api.safaricom.co.ke'
+        # MPESA_BASE_URL points the handler at a local stub (see scripts/mock_daraja.py)
+        base_url = os.getenv('MPESA_BASE_URL', base_url).rstrip('/')
+        self.auth_url = f'{base_url}/oauth/v1/generate?grant_type=client_credentials'
+        self.stk_url = f'{base_url}/mpesa/stkpush/v1/processrequest'
+        self.stk_query_url = f'{base_url}/mpesa/stkpushquery/v1/query'
+        
+        # One pooled session per worker process; connections are kept alive
+        # between STK pushes instead of paying a new TCP+TLS handshake each time
+        self.session = session or build_session(int(os.getenv('MPESA_POOL_SIZE', 10)))
+        self.max_retries = int(os.getenv('MPESA_MAX_RETRIES', 2))
+        self.retry_backoff = float(os.getenv('MPESA_RETRY_BACKOFF', 0.25))
+        self.connect_timeout = float(os.getenv('MPESA_CONNECT_TIMEOUT', 3))
+        self.timeout_budget = float(os.getenv('MPESA_TIMEOUT_BUDGET', 10))
+        
+        self.token_cache = AccessTokenCache(
+            self._fetch_access_token,
+            refresh_margin=int(os.getenv('MPESA_TOKEN_REFRESH_MARGIN', 60))
+        )
     
-    def get_access_token(self):
+    def _request(self, method, url, budget=None, idempotent=True, retries=None, **kwargs):
+        """Send a request with bounded retries inside an overall time budget.
+        
+        5xx responses and connection errors are retried with full-jitter
+        exponential backoff. Read timeouts are only retried for idempotent
+        calls, since a timed-out STK push may already have reached the phone.
+        """
+        requests = self.requests
+        deadline = time.monotonic() + (budget or self.timeout_budget)
+        max_retries = self.max_retries if retries is None else retries
+        retryable = (requests.exceptions.ConnectionError,)
+        if idempotent:
+            retryable += (requests.exceptions.Timeout,)
+        
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout(f'{method} {url} exceeded its time budget')
+            started = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url,
+                    timeout=(min(self.connect_timeout, remaining), remaining),
+                    **kwargs
+                )
+                observe_outbound(urlsplit(url).path, started, response.status_code)
+                if response.status_code < 500 or attempt >= max_retries:
+                    return response
+            except requests.exceptions.RequestException as e:
+                observe_outbound(urlsplit(url).path, started, type(e).__name__)
+                if not isinstance(e, retryable) or attempt >= max_retries:
+                    raise
+            
+            delay = random.uniform(0, self.retry_backoff * (2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                raise requests.exceptions.Timeout(f'{method} {url} exceeded its time budget')
+            time.sleep(delay)
+            attempt += 1
+    
+    def _fetch_access_token(self):
+        """Request a new OAuth token; returns (token, expires_in) or None"""
+        requests = self.requests
         try:
             if not self.consumer_key or not self.consumer_secret:
-                print("MPESA consumer key/secret not set.")
+                log_event(logger, logging.ERROR, 'mpesa.credentials_missing')
                 return None
-            response = requests.get(
+            response = self._request(
+                'GET',
                 self.auth_url,
-                auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret),
-                timeout=10
+                auth=requests.auth.HTTPBasicAuth(self.consumer_key, self.consumer_secret)
             )
             response.raise_for_status()
-            return response.json().get('access_token')
-        except requests.exceptions.RequestException as e:
-            print(f"Error getting access token: {e}")
+            data = response.json()
+            token = data.get('access_token')
+            if not token:
+                return None
+            # Daraja returns expires_in as a string, e.g. "3599"
+            return token, int(data.get('expires_in', 3599))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log_event(logger, logging.ERROR, 'mpesa.token_failed', error=str(e))
             return None
     
-    def initiate_stk_push(self, phone_number, amount, contribution_id, description):
-        """Initiate STK Push and store CheckoutRequestID in Contribution"""
-        access_token = self.get_access_token()
-        if not access_token:
-            return {'error': 'Failed to get access token'}
-        
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    def get_access_token(self):
+        return self.token_cache.get()
+    
+    def stk_push_payload(self, phone_number, amount, contribution_id, description):
+        """Daraja request body for a contribution's STK push, or {'error': ...}"""
         if not self.passkey:
             return {'error': 'MPESA passkey missing'}
         
-        # Normalize phone
-        phone_number = str(phone_number).strip()
-        if phone_number.startswith('+'):
-            phone_number = phone_number[1:]
-        if phone_number.startswith('0'):
-            phone_number = '254' + phone_number[1:]
-        elif phone_number.startswith('7'):
-            phone_number = '254' + phone_number[-9:]
-        elif phone_number.startswith('254') and len(phone_number) == 12:
-            pass
-        else:
+        phone_number = normalize_phone(phone_number)
+        if not phone_number:
             return {'error': 'Invalid phone number format'}
         
         # Generate password
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
         password_str = f"{self.business_shortcode}{self.passkey}{timestamp}"
         password = base64.b64encode(password_str.encode()).decode()
         
         # Shorten AccountReference to 12 chars max for sandbox
         account_ref = f"TILL{contribution_id}"[:12]
         
-        payload = {
+        return {
             "BusinessShortCode": self.business_shortcode,
             "Password": password,
             "Timestamp": timestamp,
@@ -90,6 +383,29 @@ class STKPushHandler:
             "AccountReference": account_ref,
             "TransactionDesc": description
         }
+    
+    def record_stk_push(self, contribution_id, resp_json):
+        """Store the CheckoutRequestID Safaricom returned on the pending contribution"""
+        if 'CheckoutRequestID' in resp_json:
+            contribution = Contribution.query.get(contribution_id)
+            if contribution:
+                contribution.transaction_id = resp_json['CheckoutRequestID']
+                db.session.commit()
+        log_event(logger, logging.INFO, 'stk_push.accepted', contribution_id=contribution_id,
+                  checkout_id=resp_json.get('CheckoutRequestID'),
+                  merchant_request_id=resp_json.get('MerchantRequestID'),
+                  response_code=resp_json.get('ResponseCode'))
+    
+    def initiate_stk_push(self, phone_number, amount, contribution_id, description):
+        """Initiate STK Push and store CheckoutRequestID in Contribution"""
+        requests = self.requests
+        access_token = self.get_access_token()
+        if not access_token:
+            return {'error': 'Failed to get access token'}
+        
+        payload = self.stk_push_payload(phone_number, amount, contribution_id, description)
+        if 'error' in payload:
+            return payload
         
         headers = {
             "Authorization": f"Bearer {access_token}",
@@ -97,80 +413,118 @@ class STKPushHandler:
         }
         
         try:
-            payload_safe = {k: v for k, v in payload.items() if k != 'Password'}
-            print("Initiating STK Push (Till). Payload (safe):", json.dumps(payload_safe, indent=2))
+            log_event(logger, logging.INFO, 'stk_push.sending', contribution_id=contribution_id,
+                      amount=payload['Amount'], phone=mask_phone(payload['PhoneNumber']),
+                      account_ref=payload['AccountReference'])
             
-            response = requests.post(self.stk_url, json=payload, headers=headers, timeout=10)
+            response = self._request('POST', self.stk_url, idempotent=False, json=payload, headers=headers)
+            if response.status_code == 401:
+                self.token_cache.invalidate()
             response.raise_for_status()
             resp_json = response.json()
             
             # Save CheckoutRequestID in contribution
-            if 'CheckoutRequestID' in resp_json:
-                contribution = Contribution.query.get(contribution_id)
-                if contribution:
-                    contribution.transaction_id = resp_json['CheckoutRequestID']
-                    db.session.commit()
-            
+            self.record_stk_push(contribution_id, resp_json)
             return resp_json
         except requests.exceptions.RequestException as e:
-            print(f"Error initiating STK Push (Till): {e}")
+            log_event(logger, logging.ERROR, 'stk_push.failed', contribution_id=contribution_id, error=str(e))
+            return {'error': str(e)}
+    
+    def query_stk_status(self, checkout_id):
+        """Ask Daraja for the outcome of an STK push (STK Push Query).
+        
+        Returns the response JSON: ResultCode 0 means paid, any other
+        ResultCode means the push failed or was cancelled. While the customer
+        has not answered yet Daraja replies with an errorCode instead of a
+        ResultCode; that case and transport errors come back as {'error': ...}.
+        """
+        requests = self.requests
+        access_token = self.get_access_token()
+        if not access_token:
+            return {'error': 'Failed to get access token'}
+        if not self.passkey:
+            return {'error': 'MPESA passkey missing'}
+        
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(f"{self.business_shortcode}{self.passkey}{timestamp}".encode()).decode()
+        payload = {
+            "BusinessShortCode": self.business_shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_id
+        }
+        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+        try:
+            # Daraja answers HTTP 500 while the customer hasn't responded; that is
+            # an answer, not an outage, so leave retrying to the next reconcile run
+            response = self._request('POST', self.stk_query_url, retries=0, json=payload, headers=headers)
+            if response.status_code == 401:
+                self.token_cache.invalidate()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
             return {'error': str(e)}
+        if 'ResultCode' not in data:
+            return {'error': data.get('errorMessage') or f'HTTP {response.status_code}',
+                    'error_code': data.get('errorCode')}
+        return data
     
     def validate_callback(self, callback_data):
         """Parse M-Pesa callback and auto-update contribution and event"""
         try:
-            result = callback_data.get('Body', {}).get('stkCallback', {})
-            checkout_id = result.get('CheckoutRequestID')
-            result_code = result.get('ResultCode', -1)
-            result_desc = result.get('ResultDesc')
+            parsed = parse_stk_callback(callback_data)
+            checkout_id = parsed['checkout_id']
+            result = {
+                'checkout_request_id': checkout_id,
+                'result_code': parsed['result_code'],
+                'result_desc': parsed['result_desc']
+            }
             
-            # Store raw callback
-            callback = PaymentCallback(
-                raw_response=callback_data,
-                status='failed' if result_code != 0 else 'success',
-                mpesa_receipt_number=None,
-                phone_number=None,
-                amount=None,
-                contribution_id=None
-            )
+            # Store raw callback; None means this delivery was already processed
+            callback = record_callback(parsed, callback_data)
+            if callback is None:
+                result['duplicate'] = True
+                return result
             
-            if result_code == 0:
-                metadata_items = result.get('CallbackMetadata', {}).get('Item', [])
-                payment_data = {}
-                for item in metadata_items:
-                    name = item.get('Name')
-                    value = item.get('Value')
-                    if name == 'Amount':
-                        payment_data['amount'] = value
-                    elif name == 'MpesaReceiptNumber':
-                        payment_data['receipt'] = value
-                    elif name == 'PhoneNumber':
-                        payment_data['phone'] = value
-                
+            contribution = None
+            if parsed['result_code'] == 0:
                 contribution = Contribution.query.filter_by(transaction_id=checkout_id).first()
-                if contribution:
-                    contribution.status = 'completed'
-                    contribution.transaction_id = payment_data.get('receipt')
-                    if contribution.event:
-                        contribution.event.current_amount += contribution.amount
+                if contribution and settle_contribution(contribution, parsed['receipt']):
                     callback.contribution_id = contribution.id
-                    db.session.commit()
-                
-                callback.mpesa_receipt_number = payment_data.get('receipt')
-                callback.phone_number = payment_data.get('phone')
-                callback.amount = payment_data.get('amount')
             
-            db.session.add(callback)
             db.session.commit()
+            if checkout_id:
+                seen_callbacks.add(checkout_id)
+            event_id = None
+            if callback.contribution_id:
+                event_id = contribution.event_id
+                invalidate_event(event_id)
+            notify_payment(checkout_id, 'completed' if parsed['result_code'] == 0 else 'failed', event_id)
+            log_event(logger, logging.INFO, 'callback.processed', checkout_id=checkout_id,
+                      contribution_id=callback.contribution_id, result_code=parsed['result_code'],
+                      receipt=parsed['receipt'])
             
-            return {
-                'checkout_request_id': checkout_id,
-                'result_code': result_code,
-                'result_desc': result_desc
-            }
+            return result
         except Exception as e:
-            print(f"Error validating callback: {e}")
+            db.session.rollback()
+            log_event(logger, logging.ERROR, 'callback.failed', exc_info=True, error=str(e))
             return {'error': str(e)}
 
-# Singleton instance
-stk_handler = STKPushHandler()
\ No newline at end of file
+# Singleton instance, built on first use: startup, and workers that never send
+# a push, skip importing requests and opening the connection pool
+_stk_handler = None
+_stk_handler_lock = threading.Lock()
+
+
+def get_stk_handler():
+    """This worker's STKPushHandler"""
+    global _stk_handler
+    if _stk_handler is None:
+        with _stk_handler_lock:
+            if _stk_handler is None:
+                _stk_handler = STKPushHandler()
+    return _stk_handler
+
+
+def token_cache_stats():
+    """The handler's token cache stats; empty until the first push"""
+    return _stk_handler.token_cache.stats() if _stk_handler is not None else {}
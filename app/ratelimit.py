@@ -0,0 +1,65 @@
+# Token bucket rate limiting shared by threads in one worker
+import threading
+import time
+
+
+class TokenBucket:
+    """Allow ``rate`` operations per second with bursts of up to ``capacity``.
+
+    Thread-safe. ``acquire`` blocks until a token is free (or ``timeout``
+    passes); ``try_acquire`` never blocks.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.throttled = 0
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take ``tokens`` if available; returns False instead of waiting"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                self.granted += 1
+                return True
+            self.throttled += 1
+            return False
+
+    def wait_time(self, tokens=1):
+        """Seconds until ``tokens`` would be available"""
+        with self._lock:
+            self._refill()
+            return max(0.0, (tokens - self._tokens) / self.rate) if self.rate > 0 else float('inf')
+
+    def acquire(self, tokens=1, timeout=None):
+        """Block until ``tokens`` are taken; returns False if ``timeout`` passes first"""
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.granted += 1
+                    return True
+                wait = (tokens - self._tokens) / self.rate if self.rate > 0 else float('inf')
+            if deadline is not None and self._clock() + wait > deadline:
+                with self._lock:
+                    self.throttled += 1
+                return False
+            time.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {'tokens': self._tokens, 'rate': self.rate, 'granted': self.granted, 'throttled': self.throttled}
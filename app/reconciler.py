@@ -0,0 +1,260 @@
+# Settle or expire pending contributions whose M-Pesa callback never arrived
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import Contribution, Event, LedgerEntry
+from app.cache import invalidate_event
+from app.live import notify_payment
+from app.logs import log_event
+from app.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_BATCH = 200
+# Daraja's STK Push Query errorCode while the customer hasn't answered
+STILL_PROCESSING = '500.001.1001'
+
+
+def _stale_filter(older_than):
+    return db.and_(Contribution.status == 'pending',
+                   Contribution.created_at < datetime.utcnow() - older_than)
+
+
+def backlog_size(older_than):
+    """Pending contributions older than ``older_than`` (an index range count)"""
+    return db.session.scalar(db.select(db.func.count(Contribution.id)).where(_stale_filter(older_than)))
+
+
+def stale_pending(older_than, limit=RECONCILE_BATCH, after=None):
+    """Oldest stale pending contributions, keyset-paged by (created_at, id) after ``after``"""
+    stmt = (
+        db.select(Contribution.id, Contribution.event_id, Contribution.amount, Contribution.transaction_id,
+                  Contribution.created_at)
+        .where(_stale_filter(older_than))
+        .order_by(Contribution.created_at, Contribution.id)
+        .limit(limit)
+    )
+    if after is not None:
+        stmt = stmt.where(db.tuple_(Contribution.created_at, Contribution.id) > after)
+    return db.session.execute(stmt).all()
+
+
+def query_outcomes(handler, rows, bucket, workers):
+    """STK Push Query every row that has a CheckoutRequestID, ``workers`` at a time.
+
+    Each query first takes a token from ``bucket`` so the whole pool stays
+    under Daraja's rate limit. Returns {contribution id: response dict}.
+    """
+    def query(row):
+        bucket.acquire()
+        return row.id, handler.query_stk_status(row.transaction_id)
+
+    queryable = [row for row in rows if row.transaction_id]
+    if not queryable:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(queryable)), thread_name_prefix='stk-query') as pool:
+        return dict(pool.map(query, queryable))
+
+
+def _result_code(response):
+    try:
+        return int(response['ResultCode'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def classify(rows, outcomes, expire_before):
+    """Split rows into (completed, failed, expired) by their query outcome.
+
+    ResultCode 0 is paid and any other ResultCode is final. A push that was
+    never accepted, or that Daraja still reports as being processed, expires
+    once created before ``expire_before``. Throttling and transport errors
+    leave the row for the next run: expiring it could hide a real payment.
+    """
+    completed, failed, expired = [], [], []
+    for row in rows:
+        response = outcomes.get(row.id) or {}
+        code = _result_code(response)
+        if code == 0:
+            completed.append(row)
+        elif code is not None:
+            failed.append(row)
+        elif row.created_at < expire_before and (
+                not row.transaction_id or response.get('error_code') == STILL_PROCESSING):
+            expired.append(row)
+    return completed, failed, expired
+
+
+def settle(completed, failed, expired):
+    """Apply outcomes in bulk, in one transaction.
+
+    Each UPDATE is guarded by status = 'pending' and returns the rows it
+    changed. A callback that settled a contribution in the meantime therefore
+    wins, and nothing is counted twice. Returns the rows actually changed,
+    as (completed, failed, expired).
+    """
+    def transition(rows, status):
+        if not rows:
+            return []
+        return db.session.execute(
+            db.update(Contribution)
+            .where(Contribution.id.in_([row.id for row in rows]), Contribution.status == 'pending')
+            .values(status=status, updated_at=datetime.utcnow())
+            .returning(Contribution.id, Contribution.event_id, Contribution.amount, Contribution.transaction_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+    done = transition(completed, 'completed')
+    by_event = defaultdict(list)
+    for row in done:
+        by_event[row.event_id].append(row)
+    for event_id, rows in by_event.items():
+        Event.add_to_total(event_id, sum(row.amount for row in rows), len(rows))
+        LedgerEntry.post_contributions(event_id, rows)
+    failed = transition(failed, 'failed')
+    expired = transition(expired, 'expired')
+    db.session.commit()
+
+    for event_id in by_event:
+        invalidate_event(event_id)
+    for status, rows in (('completed', done), ('failed', failed), ('failed', expired)):
+        for row in rows:
+            if row.transaction_id:
+                notify_payment(row.transaction_id, status, row.event_id if status == 'completed' else None)
+    return done, failed, expired
+
+
+def reconcile(handler, older_than, expire_after, bucket, batch_size=RECONCILE_BATCH, workers=4, dry_run=False):
+    """Walk the stale pending backlog once, oldest first, a batch at a time.
+
+    Returns a report with the backlog before and after and per-outcome counts.
+    """
+    start = time.perf_counter()
+    report = {'backlog': backlog_size(older_than), 'checked': 0, 'completed': 0, 'failed': 0,
+              'expired': 0, 'unresolved': 0, 'dry_run': dry_run}
+    after = None
+    while True:
+        rows = stale_pending(older_than, batch_size, after)
+        if not rows:
+            break
+        after = (rows[-1].created_at, rows[-1].id)
+        outcomes = query_outcomes(handler, rows, bucket, workers)
+        completed, failed, expired = classify(rows, outcomes, datetime.utcnow() - expire_after)
+        if not dry_run:
+            completed, failed, expired = settle(completed, failed, expired)
+        report['checked'] += len(rows)
+        report['completed'] += len(completed)
+        report['failed'] += len(failed)
+        report['expired'] += len(expired)
+        report['unresolved'] += len(rows) - len(completed) - len(failed) - len(expired)
+        if len(rows) < batch_size:
+            break
+    report['remaining'] = backlog_size(older_than)
+    report['seconds'] = time.perf_counter() - start
+    resolved = report['completed'] + report['failed'] + report['expired']
+    report['resolved_per_sec'] = resolved / report['seconds'] if report['seconds'] else 0.0
+    return report
+
+
+class PendingReconciler:
+    """Background thread that runs reconcile() every ``interval`` seconds"""
+
+    def __init__(self, app, handler, interval=60.0, older_than=timedelta(minutes=2),
+                 expire_after=timedelta(hours=1), batch_size=RECONCILE_BATCH, workers=4, rate=5.0):
+        self.app = app
+        self.handler = handler
+        self.interval = interval
+        self.older_than = older_than
+        self.expire_after = expire_after
+        self.batch_size = batch_size
+        self.workers = workers
+        # No burst: Daraja enforces a per-second spike arrest
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.pid = None
+        self.runs = 0
+        self.last = {}
+        self.totals = {'checked': 0, 'completed': 0, 'failed': 0, 'expired': 0}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            # A fork (gunicorn --preload) leaves the child without our thread
+            if self.pid == os.getpid():
+                return self
+            if self.pid is None:
+                atexit.register(self.stop)
+                os.register_at_fork(after_in_child=self.start)
+            self.pid = os.getpid()
+        threading.Thread(target=self._run, name='pending-reconciler', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def run_once(self):
+        report = reconcile(self.handler, self.older_than, self.expire_after, self.bucket,
+                           self.batch_size, self.workers)
+        with self._lock:
+            self.runs += 1
+            self.last = report
+            for key in self.totals:
+                self.totals[key] += report[key]
+        if report['checked']:
+            log_event(logger, logging.INFO, 'reconciler.run', **{k: v for k, v in report.items() if k != 'dry_run'})
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'backlog': self.last.get('remaining', 0),
+                'drain_rate': self.last.get('resolved_per_sec', 0.0),
+                'last_run_seconds': self.last.get('seconds', 0.0),
+                **{f'{key}_total': value for key, value in self.totals.items()}
+            }
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            if self._stopped:
+                break
+            with self.app.app_context():
+                try:
+                    self.run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    log_event(logger, logging.ERROR, 'reconciler.failed', exc_info=True, error=str(e))
+                finally:
+                    db.session.remove()
+
+
+def make_reconciler(app):
+    from app.payments import get_stk_handler
+    return PendingReconciler(
+        app, get_stk_handler(),
+        interval=app.config['RECONCILE_INTERVAL'],
+        older_than=timedelta(seconds=app.config['RECONCILE_AFTER']),
+        expire_after=timedelta(seconds=app.config['RECONCILE_EXPIRE_AFTER']),
+        batch_size=app.config['RECONCILE_BATCH'],
+        workers=app.config['RECONCILE_WORKERS'],
+        rate=app.config['RECONCILE_QPS']
+    )
+
+
+def init_reconciler(app):
+    """Start the pending reconciler unless RECONCILE_INTERVAL is 0"""
+    if app.config['RECONCILE_INTERVAL'] <= 0:
+        return None
+    reconciler = make_reconciler(app).start()
+    app.extensions['pending_reconciler'] = reconciler
+    return reconciler
@@ -0,0 +1,238 @@
+# Pre-computed per-minute / hour / day contribution rollups
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import Contribution, ContributionArchive, ContributionRollup, Event, LedgerEntry, RollupState
+from app.logs import log_event
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+# Default window served by /stats for each granularity
+DEFAULT_SPAN = {
+    'minute': timedelta(hours=1),
+    'hour': timedelta(hours=48),
+    'day': timedelta(days=30),
+}
+MAX_BUCKETS = 2000
+# Day buckets (here and on the analytics dashboard) follow local time, EAT by
+# default, rather than UTC midnight
+UTC_OFFSET = int(float(os.getenv('ANALYTICS_UTC_OFFSET_HOURS', 3)) * 3600)
+COMPACT_BATCH = 5000
+# Ledger ids are assigned before commit, so a slow transaction can commit a
+# lower id after a higher one. Entries younger than this are left for the
+# next run so the watermark never skips past one.
+SETTLE_LAG = timedelta(seconds=5)
+STATE_NAME = 'contributions'
+
+
+def bucket_start(when, granularity):
+    """Start of the bucket containing ``when`` (naive UTC).
+
+    Day buckets follow local midnight (ANALYTICS_UTC_OFFSET_HOURS), matching
+    the dashboard series.
+    """
+    if granularity == 'minute':
+        return when.replace(second=0, microsecond=0)
+    if granularity == 'hour':
+        return when.replace(minute=0, second=0, microsecond=0)
+    offset = timedelta(seconds=UTC_OFFSET)
+    return (when + offset).replace(hour=0, minute=0, second=0, microsecond=0) - offset
+
+
+def _recompute(model, event_id, granularity, start):
+    """Aggregate one bucket from the contributions it covers (an index range scan).
+
+    ``model`` is Contribution, or ContributionArchive for an archived event.
+    """
+    count, amount, contributors = db.session.execute(
+        db.select(db.func.count(model.id), db.func.sum(model.amount),
+                  db.func.count(db.distinct(model.contributor_phone)))
+        .where(model.event_id == event_id, model.status == 'completed',
+               model.created_at >= start, model.created_at < start + GRANULARITIES[granularity])
+    ).one()
+    return {'event_id': event_id, 'granularity': granularity, 'bucket_start': start, 'count': count,
+            'amount': amount or 0, 'contributors': contributors, 'updated_at': datetime.utcnow()}
+
+
+def compact(batch_size=COMPACT_BATCH, settle_lag=SETTLE_LAG):
+    """Fold contribution ledger entries past the watermark into the rollups.
+
+    The ledger is append-only, so only entries above ``RollupState.last_entry_id``
+    are read. Every bucket they touch is recomputed exactly from the
+    contributions table instead of incremented. Distinct contributor counts
+    stay correct, and a re-run after a crash can't double count. The state row
+    is locked (FOR UPDATE on PostgreSQL) so concurrent compactors serialise.
+    Returns the number of ledger entries folded in.
+    """
+    state = db.session.scalars(
+        db.select(RollupState).where(RollupState.name == STATE_NAME).with_for_update()
+    ).first()
+    if state is None:
+        state = RollupState(name=STATE_NAME, last_entry_id=0)
+        db.session.add(state)
+
+    # Entries of archived events only come up on a --rebuild; their rows are in the archive
+    created_at = db.func.coalesce(Contribution.created_at, ContributionArchive.created_at)
+    rows = db.session.execute(
+        db.select(LedgerEntry.id, LedgerEntry.event_id, created_at)
+        .outerjoin(Contribution, Contribution.id == LedgerEntry.source_id)
+        .outerjoin(ContributionArchive, ContributionArchive.id == LedgerEntry.source_id)
+        .where(LedgerEntry.id > state.last_entry_id, LedgerEntry.source_type == 'contribution',
+               LedgerEntry.entry_type == 'contribution', created_at.is_not(None),
+               LedgerEntry.created_at <= datetime.utcnow() - settle_lag)
+        .order_by(LedgerEntry.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        db.session.commit()
+        return 0
+
+    touched = defaultdict(set)
+    for _, event_id, created_at in rows:
+        for granularity in GRANULARITIES:
+            touched[event_id, granularity].add(bucket_start(created_at, granularity))
+    models = {event_id: Event.contribution_model(event_id) for event_id, _ in touched}
+    for (event_id, granularity), starts in touched.items():
+        buckets = [_recompute(models[event_id], event_id, granularity, start) for start in sorted(starts)]
+        # Replace rather than upsert: portable, and one statement each way
+        db.session.execute(db.delete(ContributionRollup).where(
+            ContributionRollup.event_id == event_id, ContributionRollup.granularity == granularity,
+            ContributionRollup.bucket_start.in_(starts)))
+        db.session.execute(db.insert(ContributionRollup), buckets)
+    state.last_entry_id = rows[-1].id
+    db.session.commit()
+    return len(rows)
+
+
+def compact_all(batch_size=COMPACT_BATCH, settle_lag=SETTLE_LAG):
+    """Run compact() until caught up; returns the total entries folded in"""
+    total = 0
+    while True:
+        done = compact(batch_size, settle_lag)
+        total += done
+        if done < batch_size:
+            return total
+
+
+def event_stats(event_id, granularity='hour', since=None, until=None):
+    """Rollup buckets for one event between ``since`` and ``until`` (naive UTC).
+
+    Reads only the rollup primary key range, so the cost depends on the
+    number of buckets, not the number of contributions.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    until = until or datetime.utcnow()
+    since = since or until - DEFAULT_SPAN[granularity]
+    if since > until:
+        raise ValueError('since must be before until')
+    if (until - since) / GRANULARITIES[granularity] > MAX_BUCKETS:
+        raise ValueError(f'at most {MAX_BUCKETS} buckets per request; narrow the range or use a coarser granularity')
+
+    buckets = db.session.scalars(
+        db.select(ContributionRollup)
+        .where(ContributionRollup.event_id == event_id, ContributionRollup.granularity == granularity,
+               ContributionRollup.bucket_start >= bucket_start(since, granularity),
+               ContributionRollup.bucket_start <= until)
+        .order_by(ContributionRollup.bucket_start)
+    ).all()
+    as_of = db.session.execute(
+        db.select(LedgerEntry.created_at)
+        .join(RollupState, RollupState.last_entry_id == LedgerEntry.id)
+        .where(RollupState.name == STATE_NAME)
+    ).scalar()
+    return {
+        'event_id': event_id,
+        'granularity': granularity,
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'buckets': [bucket.to_dict() for bucket in buckets],
+        'totals': {
+            'count': sum(bucket.count for bucket in buckets),
+            'amount': float(sum(bucket.amount for bucket in buckets))
+        },
+        'as_of': as_of.isoformat() if as_of else None
+    }
+
+
+def dense_series(event_id, granularity='hour', until=None):
+    """event_stats() over the default span with empty buckets filled in, for charts"""
+    stats = event_stats(event_id, granularity, until=until)
+    found = {bucket['bucket_start']: bucket for bucket in stats['buckets']}
+    step = GRANULARITIES[granularity]
+    start = bucket_start(datetime.fromisoformat(stats['since']), granularity)
+    until = datetime.fromisoformat(stats['until'])
+    series = []
+    while start <= until:
+        key = start.isoformat()
+        series.append(found.get(key, {'bucket_start': key, 'count': 0, 'amount': 0.0, 'contributors': 0}))
+        start += step
+    return series
+
+
+class RollupCompactor:
+    """Background thread that calls compact_all() every ``interval`` seconds"""
+
+    def __init__(self, app, interval=30.0, batch_size=COMPACT_BATCH):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pid = None
+        self.runs = 0
+        self.folded = 0
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def start(self):
+        with self._start_lock:
+            # A fork (gunicorn --preload) leaves the child without our thread
+            if self.pid == os.getpid():
+                return self
+            if self.pid is None:
+                atexit.register(self.stop)
+                os.register_at_fork(after_in_child=self.start)
+            self.pid = os.getpid()
+            threading.Thread(target=self._run, name='rollup-compactor', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def stats(self):
+        return {'runs': self.runs, 'folded': self.folded, 'interval': self.interval}
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            if self._stopped:
+                break
+            with self.app.app_context():
+                try:
+                    self.folded += compact_all(self.batch_size)
+                    self.runs += 1
+                except Exception as e:
+                    db.session.rollback()
+                    log_event(logger, logging.ERROR, 'rollups.compact_failed', exc_info=True, error=str(e))
+                finally:
+                    db.session.remove()
+
+
+def init_rollups(app):
+    """Start the rollup compactor unless ROLLUP_COMPACT_INTERVAL is 0"""
+    if app.config['ROLLUP_COMPACT_INTERVAL'] <= 0:
+        return None
+    compactor = RollupCompactor(app, interval=app.config['ROLLUP_COMPACT_INTERVAL']).start()
+    app.extensions['rollup_compactor'] = compactor
+    return compactor
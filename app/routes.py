@@ -1,11 +1,33 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, session
+from flask import (Blueprint, render_template, request, jsonify, redirect, url_for, session, current_app, abort,
+                   Response, stream_with_context, send_file)
 from app import db
-from app.models import Event, Contribution, EventType, PaymentCallback, Expenditure, ExpenditureCategory, User
-from app.payments import stk_handler
-from datetime import datetime
+from app.models import (Event, Contribution, EventType, PaymentCallback, Expenditure, ExpenditureCategory, User,
+                        EventBalance, LedgerEntry, ContributionArchive)
+from app.payments import (get_stk_handler, settle_contribution, fail_contribution, is_stk_callback,
+                          parse_stk_callback, record_callback)
+from app.idempotency import seen_callbacks
+from app.cache import (cache, event_snapshot, active_events, event_page, invalidate_event,
+                       expenditure_summary, invalidate_expenditure_summary)
+from app.live import stream, notify_payment
+from app.pagination import DEFAULT_LIMIT, page_args, decode_cursor, keyset_page, ndjson_response, paginated_json
+from app.dispatch import dispatcher, contribution_progress, QueueFullError
+from app.exports import EXPORTS, FORMATS, export_chunks, csv_stream, write_export
+from app.imports import read_rows, import_contributions
+from app.rollups import event_stats, dense_series
+from app.logs import log_event
+from app.archive import restore_event
+from app.auth import login_throttle, HasherBusyError
+from datetime import datetime, timezone
+from decimal import Decimal
+import hashlib
 import json
+import logging
+import math
+import tempfile
 from functools import wraps
 
+logger = logging.getLogger(__name__)
+
 # Create blueprints
 main_bp = Blueprint('main', __name__)
 api_bp = Blueprint('api', __name__)
@@ -23,6 +45,19 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def conditional_json(data):
+    """JSON response with an ETag; returns 304 when If-None-Match matches"""
+    response = jsonify(data)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    # Let browsers keep the body but revalidate on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@main_bp.app_template_filter('isodate')
+def isodate_filter(value, fmt='%d %b %Y'):
+    """Format an ISO 8601 string from a cached snapshot"""
+    return datetime.fromisoformat(value).strftime(fmt) if value else ''
+
 # ============================================================================
 # AUTH ROUTES
 # ============================================================================
@@ -33,9 +68,22 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         
+        wait = login_throttle.check(request.remote_addr, username)
+        if wait:
+            return _throttled('login.html', wait)
+        
         user = User.query.filter_by(username=username).first()
         
-        if user and user.check_password(password):
+        try:
+            valid = user is not None and user.check_password(password)
+            if valid and user.password_needs_rehash():
+                # Hash parameters changed since this password was set; upgrade it now we have the plaintext
+                user.set_password(password)
+                db.session.commit()
+        except HasherBusyError as e:
+            return render_template('login.html', error=str(e)), 503
+        
+        if valid:
             session['admin_id'] = user.id
             session['admin_username'] = user.username
             return redirect(url_for('admin.admin_dashboard'))
@@ -44,6 +92,13 @@ def login():
     
     return render_template('login.html')
 
+def _throttled(template, wait):
+    """429 for a client or username making too many sign-in attempts"""
+    response = current_app.make_response((render_template(
+        template, error='Too many attempts, please wait a minute and try again'), 429))
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
 @main_bp.route('/logout')
 def logout():
     """Logout Admin"""
@@ -59,6 +114,10 @@ def signup():
         password_confirm = request.form.get('password_confirm')
         email = request.form.get('email')
         
+        wait = login_throttle.check(request.remote_addr)
+        if wait:
+            return _throttled('signup.html', wait)
+        
         # Validation
         if not username or not password or not email:
             return render_template('signup.html', error='All fields are required')
@@ -84,7 +143,10 @@ def signup():
         
         # Create new user
         user = User(username=username, email=email)
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except HasherBusyError as e:
+            return render_template('signup.html', error=str(e)), 503
         
         db.session.add(user)
         db.session.commit()
@@ -105,18 +167,15 @@ def signup():
 @main_bp.route('/')
 def index():
     """Homepage with list of active events"""
-    events = Event.query.filter_by(status='active').all()
-    return render_template('index.html', events=events)
+    return render_template('index.html', events=active_events())
 
 @main_bp.route('/event/<int:event_id>')
 def event_detail(event_id):
     """Event detail page"""
-    event = Event.query.get_or_404(event_id)
-    contributors = Contribution.query.filter_by(
-        event_id=event_id,
-        status='completed'
-    ).order_by(Contribution.created_at.desc()).all()
-    return render_template('event_detail.html', event=event, contributors=contributors)
+    page = event_page(event_id)
+    if page is None:
+        abort(404)
+    return render_template('event_detail.html', event=page['event'], contributors=page['contributors'])
 
 @main_bp.route('/contribute/<int:event_id>', methods=['GET', 'POST'])
 def contribute(event_id):
@@ -133,23 +192,94 @@ def contribute(event_id):
 @api_bp.route('/events', methods=['GET'])
 def get_events():
     """Get all active events"""
-    events = Event.query.filter_by(status='active').all()
-    return jsonify([event.to_dict() for event in events])
+    return conditional_json(active_events())
 
 @api_bp.route('/event/<int:event_id>', methods=['GET'])
 def get_event(event_id):
     """Get event details"""
-    event = Event.query.get_or_404(event_id)
-    return jsonify(event.to_dict())
+    snapshot = event_snapshot(event_id)
+    if snapshot is None:
+        abort(404)
+    return conditional_json(snapshot)
+
+@api_bp.route('/event/<int:event_id>/stream', methods=['GET'])
+def stream_event(event_id):
+    """Server-Sent Events feed of an event's progress"""
+    if not current_app.config['LIVE_STREAMS']:
+        abort(404)
+    snapshot = event_snapshot(event_id)
+    if snapshot is None:
+        abort(404)
+    return stream(f'event:{event_id}', initial=snapshot)
 
 @api_bp.route('/event/<int:event_id>/contributions', methods=['GET'])
 def get_event_contributions(event_id):
-    """Get contributions for an event"""
-    contributions = Contribution.query.filter_by(
+    """Get contributions for an event, newest first.
+    
+    Paged with ?limit=&cursor= (next cursor in X-Next-Cursor), or streamed
+    in full with ?format=ndjson
+    """
+    model = Event.contribution_model(event_id)
+    query = model.query.filter_by(
         event_id=event_id,
         status='completed'
-    ).all()
-    return jsonify([contrib.to_dict() for contrib in contributions])
+    )
+    if request.args.get('format') == 'ndjson':
+        return ndjson_response(query, model)
+    try:
+        limit, after = page_args(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    return paginated_json(*keyset_page(query, model, limit, after))
+
+class InvalidContribution(Exception):
+    """A contribution request that fails validation; ``status`` is the HTTP status to answer with"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def create_pending_contribution(data):
+    """Validate a contribution request and commit it as pending; returns (contribution, event).
+    
+    Shared by the Flask view and the async view in app.asgi.
+    """
+    try:
+        event_id = int(data.get('event_id'))
+        amount = float(data.get('amount'))
+    except (ValueError, TypeError) as e:
+        raise InvalidContribution(f'Invalid input: {str(e)}')
+    phone = data.get('phone')
+    name = data.get('name', 'Anonymous')
+    
+    if not all([event_id, amount, phone]):
+        raise InvalidContribution('Missing required fields')
+    
+    if amount < 1:
+        raise InvalidContribution('Minimum contribution is KES 1')
+    
+    # Verify event exists
+    event = Event.query.get(event_id)
+    if not event:
+        raise InvalidContribution('Event not found', 404)
+    # Reads of an archived event go to contributions_archive; a new row here would never be seen
+    if event.archived_at:
+        raise InvalidContribution('This event is closed to contributions')
+    
+    # Create contribution record
+    contribution = Contribution(
+        event_id=event_id,
+        contributor_name=name,
+        contributor_phone=phone,
+        amount=amount,
+        payment_method='mpesa',
+        status='pending'
+    )
+    db.session.add(contribution)
+    db.session.commit()
+    log_event(logger, logging.INFO, 'contribution.created', contribution_id=contribution.id,
+              event_id=event_id, amount=amount)
+    return contribution, event
 
 @api_bp.route('/contribution', methods=['POST'])
 def process_contribution():
@@ -157,45 +287,40 @@ def process_contribution():
     data = request.get_json() or request.form
     
     try:
-        event_id = int(data.get('event_id'))
-        amount = float(data.get('amount'))
-        phone = data.get('phone')
-        name = data.get('name', 'Anonymous')
-        
-        if not all([event_id, amount, phone]):
-            return jsonify({'error': 'Missing required fields'}), 400
-        
-        if amount < 1:
-            return jsonify({'error': 'Minimum contribution is KES 1'}), 400
+        contribution, event = create_pending_contribution(data)
+        phone = contribution.contributor_phone
+        amount = int(contribution.amount)
         
-        # Verify event exists
-        event = Event.query.get(event_id)
-        if not event:
-            return jsonify({'error': 'Event not found'}), 404
-        
-        # Create contribution record
-        contribution = Contribution(
-            event_id=event_id,
-            contributor_name=name,
-            contributor_phone=phone,
-            amount=amount,
-            payment_method='mpesa',
-            status='pending'
-        )
-        db.session.add(contribution)
-        db.session.commit()
+        if current_app.config['STK_DISPATCH_MODE'] == 'async':
+            try:
+                dispatcher.submit(
+                    current_app._get_current_object(),
+                    contribution_id=contribution.id,
+                    phone=phone,
+                    amount=amount,
+                    description=f"Contribution to {event.title}"
+                )
+            except QueueFullError as e:
+                fail_contribution(contribution.id)
+                return jsonify({'error': str(e)}), 503
+            
+            return jsonify({
+                'success': True,
+                'message': 'STK Push queued',
+                'contribution_id': contribution.id,
+                'status_url': url_for('api.get_contribution_status', contribution_id=contribution.id)
+            }), 202
         
         # Initiate STK Push - FIXED
-        response = stk_handler.initiate_stk_push(
+        response = get_stk_handler().initiate_stk_push(
             phone_number=phone,
-            amount=int(amount),
+            amount=amount,
             contribution_id=contribution.id,  # <-- use contribution_id
             description=f"Contribution to {event.title}"
         )
         
         if 'error' in response:
-            contribution.status = 'failed'
-            db.session.commit()
+            fail_contribution(contribution.id)
             return jsonify({'error': response['error']}), 400
         
         return jsonify({
@@ -205,53 +330,66 @@ def process_contribution():
             'contribution_id': contribution.id
         })
     
-    except (ValueError, TypeError) as e:
-        return jsonify({'error': f'Invalid input: {str(e)}'}), 400
+    except InvalidContribution as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@api_bp.route('/payment/callback', methods=['POST'])
-def payment_callback():
-    """M-Pesa STK Push payment callback - robust version"""
+@api_bp.route('/contribution/<int:contribution_id>/status', methods=['GET'])
+def get_contribution_status(contribution_id):
+    """Report the STK push / payment progress of a contribution"""
+    contribution = Contribution.query.get_or_404(contribution_id)
+    return jsonify({
+        'contribution_id': contribution.id,
+        'status': contribution.status,
+        'progress': contribution_progress(contribution),
+        'checkout_request_id': contribution.transaction_id if contribution.status == 'pending' else None
+    })
+
+@api_bp.route('/payment/<checkout_id>/stream', methods=['GET'])
+def stream_payment(checkout_id):
+    """Server-Sent Events feed of one STK push's outcome"""
+    if not current_app.config['LIVE_STREAMS']:
+        abort(404)
+    callback = PaymentCallback.query.filter_by(transaction_id=checkout_id).first()
+    if callback:
+        status = 'completed' if callback.status == 'success' else 'failed'
+    else:
+        status = 'pending'
+    return stream(f'checkout:{checkout_id}', initial={'checkout_request_id': checkout_id, 'status': status})
+
+def handle_payment_callback(callback_data):
+    """Apply one M-Pesa callback; returns (response body, HTTP status).
+    
+    Shared by the Flask view and the async view in app.asgi.
+    """
     try:
-        callback_data = request.get_json()
         if not callback_data:
-            return jsonify({'error': 'No callback data received'}), 400
+            return {'error': 'No callback data received'}, 400
+        # Reject anything that isn't an stkCallback before it can reach the spool
+        if not is_stk_callback(callback_data):
+            return {'error': 'Invalid callback payload'}, 400
+
+        # Batch mode: spool durably, acknowledge now, apply with the next batch
+        batcher = current_app.extensions.get('callback_batcher')
+        if batcher:
+            batcher.submit(callback_data)
+            return {'status': 'success', 'message': 'Callback accepted'}, 200
 
         # Parse stkCallback
-        stk_result = callback_data.get('Body', {}).get('stkCallback', {})
-        result_code = stk_result.get('ResultCode', -1)
-        checkout_id = stk_result.get('CheckoutRequestID')
-        account_ref = stk_result.get('MerchantRequestID', '') or stk_result.get('AccountReference', '')
-
-        # Save raw callback
-        payment_callback = PaymentCallback(
-            raw_response=callback_data,
-            status='failed',
-            mpesa_receipt_number=None,
-            phone_number=None,
-            amount=None,
-            contribution_id=None
-        )
+        parsed = parse_stk_callback(callback_data)
+        checkout_id = parsed['checkout_id']
+        account_ref = parsed['account_ref']
 
-        # If payment was successful
-        if result_code == 0:
-            # Extract metadata
-            items = stk_result.get('CallbackMetadata', {}).get('Item', [])
-            payment_data = {}
-            for item in items:
-                name = item.get('Name')
-                value = item.get('Value')
-                if name == 'Amount':
-                    payment_data['amount'] = value
-                elif name == 'MpesaReceiptNumber':
-                    payment_data['receipt'] = value
-                elif name == 'PhoneNumber':
-                    payment_data['phone'] = value
-                elif name == 'TransactionDate':
-                    payment_data['date'] = value
+        # Save raw callback. Safaricom retries deliveries; a duplicate is
+        # acknowledged without touching Contribution or Event
+        payment_callback = record_callback(parsed, callback_data)
+        if payment_callback is None:
+            return {'status': 'success', 'message': 'Duplicate callback ignored'}, 200
 
+        # If payment was successful
+        if parsed['result_code'] == 0:
             # Try to find the contribution
             contribution = None
             if checkout_id:
@@ -263,69 +401,108 @@ def payment_callback():
                 except ValueError:
                     pass
 
-            if contribution:
-                contribution.status = 'completed'
-                contribution.transaction_id = payment_data.get('receipt')
-
-                # Update event totals
-                if contribution.event:
-                    if contribution.event.current_amount is None:
-                        contribution.event.current_amount = 0
-                    contribution.event.current_amount += contribution.amount
-
+            # Mark completed and update event totals atomically, unless already settled
+            if contribution and settle_contribution(contribution, parsed['receipt']):
                 payment_callback.contribution_id = contribution.id
 
-            # Update callback fields
-            payment_callback.status = 'success'
-            payment_callback.mpesa_receipt_number = payment_data.get('receipt')
-            payment_callback.phone_number = payment_data.get('phone')
-            payment_callback.amount = payment_data.get('amount')
-
-        else:
-            # Payment failed
-            payment_callback.status = 'failed'
-
         # Commit everything in one go
-        db.session.add(payment_callback)
         db.session.commit()
+        if checkout_id:
+            seen_callbacks.add(checkout_id)
+        event_id = None
+        if payment_callback.contribution_id:
+            event_id = contribution.event_id
+            invalidate_event(event_id)
+        notify_payment(checkout_id, 'completed' if parsed['result_code'] == 0 else 'failed', event_id)
+        log_event(logger, logging.INFO, 'callback.processed', checkout_id=checkout_id,
+                  contribution_id=payment_callback.contribution_id, result_code=parsed['result_code'],
+                  receipt=parsed['receipt'])
+
+        return {'status': 'success', 'message': 'Callback processed'}, 200
 
-        return jsonify({'status': 'success', 'message': 'Callback processed'}), 200
+    except Exception as e:
+        db.session.rollback()
+        log_event(logger, logging.ERROR, 'callback.failed', exc_info=True, error=str(e))
+        return {'error': str(e)}, 500
 
+@api_bp.route('/payment/callback', methods=['POST'])
+def payment_callback():
+    """M-Pesa STK Push payment callback - robust version"""
+    try:
+        callback_data = request.get_json()
     except Exception as e:
-        print(f"Callback processing error: {e}")
+        log_event(logger, logging.ERROR, 'callback.failed', error=str(e))
         return jsonify({'error': str(e)}), 500
+    body, status = handle_payment_callback(callback_data)
+    return jsonify(body), status
 
 @api_bp.route('/event/<int:event_id>/expenditures', methods=['GET'])
 def get_event_expenditures(event_id):
-    """Get all expenditures for an event"""
-    expenditures = Expenditure.query.filter_by(event_id=event_id).order_by(Expenditure.created_at.desc()).all()
-    return jsonify([exp.to_dict() for exp in expenditures])
+    """Get expenditures for an event, newest first (same paging as contributions)"""
+    query = Expenditure.query.filter_by(event_id=event_id)
+    if request.args.get('format') == 'ndjson':
+        return ndjson_response(query, Expenditure)
+    try:
+        limit, after = page_args(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    return paginated_json(*keyset_page(query, Expenditure, limit, after))
 
 @api_bp.route('/event/<int:event_id>/expenditure/summary', methods=['GET'])
 def get_expenditure_summary(event_id):
     """Get expenditure summary for an event"""
-    event = Event.query.get_or_404(event_id)
-    expenditures = Expenditure.query.filter_by(event_id=event_id).all()
-    
-    total_expenditure = sum(exp.amount for exp in expenditures)
-    remaining = event.current_amount - total_expenditure
-    
-    # Group by category
-    by_category = {}
-    for exp in expenditures:
-        cat = exp.category.value
-        if cat not in by_category:
-            by_category[cat] = 0
-        by_category[cat] += exp.amount
+    Event.query.get_or_404(event_id)
+    summary = expenditure_summary(event_id)
+    balance = EventBalance.for_event(event_id)
     
     return jsonify({
-        'total_raised': event.current_amount,
-        'total_expenditure': total_expenditure,
-        'remaining': remaining,
-        'by_category': by_category,
-        'count': len(expenditures)
+        'total_raised': float(balance.raised),
+        'total_expenditure': float(balance.spent),
+        'remaining': float(balance.balance),
+        'by_category': summary['by_category'],
+        'count': summary['count']
     })
 
+def parse_utc(value):
+    """Parse an ISO 8601 query parameter into the naive UTC the database stores"""
+    when = datetime.fromisoformat(value)
+    if when.tzinfo:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when
+
+@api_bp.route('/event/<int:event_id>/balance', methods=['GET'])
+def get_event_balance(event_id):
+    """Raised, spent and remaining for an event; ?at=<ISO time> for a past balance"""
+    Event.query.get_or_404(event_id)
+    at = request.args.get('at')
+    if at:
+        try:
+            when = parse_utc(at)
+        except ValueError:
+            return jsonify({'error': 'at must be an ISO 8601 timestamp'}), 400
+        return jsonify({'event_id': event_id, 'at': when.isoformat(),
+                        'balance': float(LedgerEntry.balance_at(event_id, when))})
+    return jsonify(EventBalance.for_event(event_id).to_dict())
+
+@api_bp.route('/event/<int:event_id>/stats', methods=['GET'])
+def get_event_stats(event_id):
+    """Contribution count, amount and distinct contributors per minute, hour or day.
+
+    ?granularity=minute|hour|day (default hour), optional ?since= and ?until=
+    ISO timestamps. Served from the pre-computed rollups.
+    """
+    Event.query.get_or_404(event_id)
+    try:
+        since = parse_utc(request.args['since']) if request.args.get('since') else None
+        until = parse_utc(request.args['until']) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({'error': 'since and until must be ISO 8601 timestamps'}), 400
+    try:
+        stats = event_stats(event_id, request.args.get('granularity', 'hour'), since, until)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(stats)
+
 # ============================================================================
 # ADMIN ROUTES
 # ============================================================================
@@ -334,18 +511,30 @@ def get_expenditure_summary(event_id):
 @login_required
 def admin_dashboard():
     """Admin dashboard - shows only this admin's events"""
+    # numpy loads with the first dashboard, not with every worker
+    from app.analytics import dashboard_metrics
     admin_id = session.get('admin_id')
     events = Event.query.filter_by(admin_id=admin_id).all()
-    total_contributions = db.session.query(db.func.coalesce(db.func.sum(Contribution.amount), 0)).filter(
-        Contribution.status == 'completed',
-        Contribution.event_id.in_([e.id for e in events])
-    ).scalar()
+    # Running totals cover archived events too, without touching either contributions table
+    total_contributions = sum((e.current_amount or 0 for e in events), Decimal('0.00'))
     total_events = len(events)
+    active_count = sum(1 for e in events if e.status == 'active')
     
     return render_template('admin/dashboard.html', 
                           events=events,
                           total_contributions=total_contributions,
-                          total_events=total_events)
+                          total_events=total_events,
+                          active_count=active_count,
+                          analytics=dashboard_metrics(admin_id, events))
+
+@admin_bp.route('/analytics', methods=['GET'])
+@login_required
+def admin_analytics():
+    """Dashboard metrics for this admin's events as JSON"""
+    from app.analytics import dashboard_metrics
+    admin_id = session.get('admin_id')
+    events = Event.query.filter_by(admin_id=admin_id).all()
+    return jsonify(dashboard_metrics(admin_id, events))
 
 @admin_bp.route('/create-event', methods=['GET', 'POST'])
 @login_required
@@ -365,7 +554,10 @@ def create_event():
                 event_date=datetime.fromisoformat(request.form.get('event_date')) if request.form.get('event_date') else None
             )
             db.session.add(event)
+            db.session.flush()
+            db.session.add(EventBalance(event_id=event.id))
             db.session.commit()
+            invalidate_event(event.id)
             return redirect(url_for('admin.admin_dashboard'))
         except Exception as e:
             return render_template('admin/create_event.html', error=str(e))
@@ -385,6 +577,10 @@ def edit_event(event_id):
         event.target_amount = float(request.form.get('target_amount'))
         event.status = request.form.get('status')
         db.session.commit()
+        if event.status == 'active' and event.archived_at:
+            # Reopened: new payments must find their contributions in the hot table
+            restore_event(event_id)
+        invalidate_event(event_id)
         return redirect(url_for('admin.admin_dashboard'))
     
     return render_template('admin/edit_event.html', event=event, event_types=[et.value for et in EventType])
@@ -395,19 +591,35 @@ def event_admin_detail(event_id):
     """View event details in admin - only if owner"""
     admin_id = session.get('admin_id')
     event = Event.query.filter_by(id=event_id, admin_id=admin_id).first_or_404()
-    contributions = Contribution.query.filter_by(event_id=event_id).all()
-    expenditures = Expenditure.query.filter_by(event_id=event_id).order_by(Expenditure.created_at.desc()).all()
+    cursor = request.args.get('contributions_cursor')
+    try:
+        contributions_after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        contributions_after = None
+    # Archived events read their history from contributions_archive
+    model = ContributionArchive if event.archived_at else Contribution
+    contributions, contributions_cursor = keyset_page(
+        model.query.filter_by(event_id=event_id), model, DEFAULT_LIMIT, contributions_after
+    )
+    expenditures, expenditures_cursor = keyset_page(
+        Expenditure.query.filter_by(event_id=event_id), Expenditure, 10
+    )
+    summary = expenditure_summary(event_id)
+    balance = EventBalance.for_event(event_id)
     
-    # Calculate totals
-    total_expenditure = sum(exp.amount for exp in expenditures)
-    remaining = event.current_amount - total_expenditure
+    # Totals come from the materialised ledger balance
+    total_expenditure = balance.spent
+    remaining = balance.balance
     
     return render_template('admin/event_detail.html', 
                           event=event, 
                           contributions=contributions,
+                          contributions_cursor=contributions_cursor,
                           expenditures=expenditures,
+                          expenditure_count=summary['count'],
                           total_expenditure=total_expenditure,
-                          remaining=remaining)
+                          remaining=remaining,
+                          hourly=dense_series(event_id, 'hour'))
 
 @admin_bp.route('/event/<int:event_id>/expenditure/add', methods=['GET', 'POST'])
 @login_required
@@ -426,9 +638,13 @@ def add_expenditure(event_id):
                 approved_by=request.form.get('approved_by')
             )
             db.session.add(expenditure)
+            db.session.flush()
+            LedgerEntry.post_expenditure(expenditure)
             db.session.commit()
+            invalidate_expenditure_summary(event_id)
             return redirect(url_for('admin.event_admin_detail', event_id=event_id))
         except Exception as e:
+            db.session.rollback()
             return render_template('admin/add_expenditure.html', 
                                  event=event, 
                                  error=str(e),
@@ -438,6 +654,55 @@ def add_expenditure(event_id):
                           event=event,
                           categories=[cat.value for cat in ExpenditureCategory])
 
+@admin_bp.route('/event/<int:event_id>/import', methods=['GET', 'POST'])
+@login_required
+def import_event_contributions(event_id):
+    """Bulk import cash/bank contributions from a spreadsheet - only if owner"""
+    admin_id = session.get('admin_id')
+    event = Event.query.filter_by(id=event_id, admin_id=admin_id).first_or_404()
+    
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            return render_template('admin/import_contributions.html', event=event, error='Choose a CSV or XLSX file')
+        try:
+            report = import_contributions(event_id, read_rows(upload.stream, upload.filename),
+                                          dry_run=bool(request.form.get('dry_run')))
+        except (RuntimeError, ValueError) as e:
+            db.session.rollback()
+            return render_template('admin/import_contributions.html', event=event, error=str(e))
+        return render_template('admin/import_contributions.html', event=event, report=report)
+    
+    return render_template('admin/import_contributions.html', event=event)
+
+@admin_bp.route('/event/<int:event_id>/export/<kind>.<fmt>', methods=['GET'])
+@login_required
+def export_event(event_id, kind, fmt):
+    """Download an event's contributions or expenditures as CSV, XLSX or Parquet"""
+    admin_id = session.get('admin_id')
+    Event.query.filter_by(id=event_id, admin_id=admin_id).first_or_404()
+    if kind not in EXPORTS or fmt not in FORMATS:
+        abort(404)
+    filename = f'event-{event_id}-{kind}.{fmt}'
+    
+    if fmt == 'csv':
+        # Streamed straight from the cursor; nothing is buffered beyond one chunk
+        return Response(
+            stream_with_context(csv_stream(export_chunks(kind, event_id), EXPORTS[kind][1])),
+            mimetype=FORMATS[fmt],
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+    
+    # XLSX and Parquet are zip/footer formats, so build them in a temp file on disk
+    spool = tempfile.TemporaryFile()
+    try:
+        write_export(kind, event_id, fmt, spool)
+    except RuntimeError as e:
+        spool.close()
+        return jsonify({'error': str(e)}), 501
+    spool.seek(0)
+    return send_file(spool, mimetype=FORMATS[fmt], as_attachment=True, download_name=filename)
+
 @admin_bp.route('/expenditure/<int:expenditure_id>/delete', methods=['POST'])
 @login_required
 def delete_expenditure(expenditure_id):
@@ -449,6 +714,14 @@ def delete_expenditure(expenditure_id):
     event = Event.query.filter_by(id=expenditure.event_id, admin_id=admin_id).first_or_404()
     
     event_id = expenditure.event_id
+    LedgerEntry.post_expenditure(expenditure, reversal=True)
     db.session.delete(expenditure)
     db.session.commit()
+    invalidate_expenditure_summary(event_id)
     return redirect(url_for('admin.event_admin_detail', event_id=event_id))
+
+@admin_bp.route('/cache/stats', methods=['GET'])
+@login_required
+def cache_stats():
+    """Hit ratio and size of the event snapshot cache"""
+    return jsonify(cache.stats())
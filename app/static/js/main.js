@@ -74,41 +74,57 @@ function formatPhoneInput(input) {
     return value;
 }
 
-// Refresh event progress
+// Apply an event snapshot to the progress widget
+function renderEventProgress(event) {
+    if (document.getElementById('currentAmount')) {
+        document.getElementById('currentAmount').textContent = formatCurrency(event.current_amount);
+        
+        const progressFill = document.querySelector('.progress-fill');
+        if (progressFill) {
+            const percent = (event.current_amount / event.target_amount * 100);
+            progressFill.style.width = percent + '%';
+        }
+    }
+}
+
+// Refresh event progress once
 async function refreshEventProgress(eventId) {
     try {
         const response = await fetch(`/api/event/${eventId}`);
-        const event = await response.json();
-        
-        if (document.getElementById('currentAmount')) {
-            document.getElementById('currentAmount').textContent = formatCurrency(event.current_amount);
-            
-            const progressFill = document.querySelector('.progress-fill');
-            if (progressFill) {
-                const percent = (event.current_amount / event.target_amount * 100);
-                progressFill.style.width = percent + '%';
-            }
-        }
+        renderEventProgress(await response.json());
     } catch (error) {
         console.error('Error refreshing progress:', error);
     }
 }
 
-// Poll for payment updates (simple implementation)
-function pollPaymentStatus(checkoutRequestId, maxAttempts = 30) {
-    let attempts = 0;
+// Live event progress pushed by the server (Server-Sent Events)
+function subscribeEventProgress(eventId) {
+    if (!window.EventSource) {
+        refreshEventProgress(eventId);
+        return null;
+    }
+    const source = new EventSource(`/api/event/${eventId}/stream`);
+    source.onmessage = (message) => renderEventProgress(JSON.parse(message.data));
+    return source;
+}
+
+// Wait for the outcome of an STK push; onUpdate receives 'completed' or 'failed'
+function watchPaymentStatus(checkoutRequestId, onUpdate, timeoutMs = 120000) {
+    const source = new EventSource(`/api/payment/${encodeURIComponent(checkoutRequestId)}/stream`);
+    const timer = setTimeout(() => {
+        source.close();
+        console.log('Payment status timeout');
+    }, timeoutMs);
     
-    const interval = setInterval(() => {
-        attempts++;
-        
-        if (attempts >= maxAttempts) {
-            clearInterval(interval);
-            console.log('Payment polling timeout');
-            return;
+    source.onmessage = (message) => {
+        const data = JSON.parse(message.data);
+        if (data.status !== 'pending') {
+            clearTimeout(timer);
+            source.close();
+            onUpdate(data.status);
         }
-        
-        // The page will auto-refresh on callback
-    }, 2000);
+    };
+    return source;
 }
 
 // Load expenditure summary for event
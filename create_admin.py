@@ -17,6 +17,10 @@ def create_admin():
     app = create_app()
     
     with app.app_context():
+        if not db.inspect(db.engine).has_table(User.__tablename__):
+            print("✗ No database tables yet; run `flask init-db` first")
+            sys.exit(1)
+        
         # Check if admin user exists
         admin = User.query.filter_by(username='admin').first()
         if admin:
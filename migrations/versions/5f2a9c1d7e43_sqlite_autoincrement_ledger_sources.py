@@ -0,0 +1,50 @@
+"""never reuse contribution and expenditure ids on SQLite
+
+Revision ID: 5f2a9c1d7e43
+Revises: 8e4b1c7d2f50
+Create Date: 2026-10-18 09:12:31.504117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2a9c1d7e43'
+down_revision = '8e4b1c7d2f50'
+branch_labels = None
+depends_on = None
+
+# Ledger entries name their source by id, so an id must never come back after
+# its row is deleted or archived. PostgreSQL sequences never go back; SQLite
+# reuses the highest rowid unless the table is AUTOINCREMENT.
+TABLES = {
+    'contributions': ('contribution', ['contributions', 'contributions_archive']),
+    'expenditures': ('expenditure', ['expenditures']),
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+    for table, (source_type, id_tables) in TABLES.items():
+        with op.batch_alter_table(table, recreate='always', table_kwargs={'sqlite_autoincrement': True}):
+            pass
+        # Start above every id ever handed out, including deleted rows the ledger still names
+        highest = max(
+            [bind.scalar(sa.text(f'SELECT coalesce(max(id), 0) FROM {name}')) for name in id_tables]
+            + [bind.scalar(sa.text('SELECT coalesce(max(source_id), 0) FROM ledger_entries '
+                                   'WHERE source_type = :source_type'), {'source_type': source_type})]
+        )
+        bind.execute(sa.text('DELETE FROM sqlite_sequence WHERE name = :name'), {'name': table})
+        bind.execute(sa.text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                     {'name': table, 'seq': highest})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table in TABLES:
+        with op.batch_alter_table(table, recreate='always', table_kwargs={'sqlite_autoincrement': False}):
+            pass
@@ -0,0 +1,44 @@
+"""store money as integer cents
+
+Revision ID: d41e7b9a0c25
+Revises: 9f3a6d2c71b4
+Create Date: 2026-10-17 09:48:31.604127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41e7b9a0c25'
+down_revision = '9f3a6d2c71b4'
+branch_labels = None
+depends_on = None
+
+MONEY_COLUMNS = {
+    'events': [('target_amount', False), ('current_amount', True)],
+    'contributions': [('amount', False)],
+    'payment_callbacks': [('amount', True)],
+    'expenditures': [('amount', False)],
+    'event_balances': [('raised', False), ('spent', False)],
+    'ledger_entries': [('amount', False), ('balance_after', False)],
+}
+
+
+def upgrade():
+    for table, columns in MONEY_COLUMNS.items():
+        # Scale to cents while still a float, then change the type
+        op.execute(f"UPDATE {table} SET " + ', '.join(f"{name} = ROUND({name} * 100)" for name, _ in columns))
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for name, nullable in columns:
+                batch_op.alter_column(name, existing_type=sa.Float(), type_=sa.BigInteger(),
+                                      existing_nullable=nullable, postgresql_using=f'{name}::bigint')
+
+
+def downgrade():
+    for table, columns in MONEY_COLUMNS.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for name, nullable in columns:
+                batch_op.alter_column(name, existing_type=sa.BigInteger(), type_=sa.Float(),
+                                      existing_nullable=nullable)
+        op.execute(f"UPDATE {table} SET " + ', '.join(f"{name} = {name} / 100.0" for name, _ in columns))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Compare the sync worker model with ASGI mode on the contribution endpoint.
+
+Starts the Daraja stub with --latency seconds per STK push, then serves the
+app twice on a temporary database:
+
+  - sync:  gunicorn run:app with --workers sync workers of --threads threads
+  - asgi:  uvicorn asgi:app with --workers processes
+
+Each server gets --requests POST /api/contribution calls from --concurrency
+concurrent clients. The script reports throughput, latency percentiles, errors
+and the largest number of pushes in flight at Daraja at any time. With
+Daraja's real latency of one to three seconds, the sync model tops out at
+workers x threads pushes in flight, while one ASGI process is bounded by
+ASGI_MAX_STK_PUSHES.
+
+Needs gunicorn, uvicorn, asgiref and httpx (pip install gunicorn uvicorn asgiref httpx).
+
+Usage:
+  python scripts/bench_asgi.py --requests 2000 --concurrency 500 --latency 1.0
+  python scripts/bench_asgi.py --mode asgi --database-url postgresql://localhost/finance_bench
+"""
+import os
+import sys
+import argparse
+import asyncio
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mock_daraja import start_server
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed_event():
+    from app import create_app, db
+    from app.models import User, Event
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        admin = User(username=f'bench-{uuid.uuid4().hex[:8]}', password_hash='x')
+        db.session.add(admin)
+        db.session.flush()
+        event = Event(admin_id=admin.id, title='ASGI benchmark', description='Benchmark',
+                      organizer_name='Bench', organizer_phone='254712345678', target_amount=1e9)
+        db.session.add(event)
+        db.session.commit()
+        return event.id
+
+
+def serve(mode, port, args):
+    if mode == 'sync':
+        command = ['gunicorn', '--workers', str(args.workers), '--threads', str(args.threads),
+                   '--bind', f'127.0.0.1:{port}', '--backlog', '4096', '--timeout', '120', 'run:app']
+    else:
+        command = ['uvicorn', 'asgi:app', '--workers', str(args.workers), '--host', '127.0.0.1',
+                   '--port', str(port), '--backlog', '4096', '--timeout-keep-alive', '60', '--no-access-log',
+                   '--log-level', 'warning']
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return process
+        if process.poll() is not None:
+            raise SystemExit(f'{mode} server exited: {process.stderr.read().decode()[-2000:]}')
+        time.sleep(0.2)
+    process.kill()
+    raise SystemExit(f'{mode} server did not start')
+
+
+async def load(url, event_id, total, concurrency):
+    import httpx
+
+    samples, errors = [], {}
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        async def worker():
+            while not queue.empty():
+                i = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json={
+                        'event_id': event_id, 'amount': 10, 'phone': '254712345678', 'name': f'Bench {i}'})
+                    outcome = response.status_code
+                except httpx.HTTPError as e:
+                    outcome = type(e).__name__
+                if outcome == 200:
+                    samples.append(time.perf_counter() - start)
+                else:
+                    errors[outcome] = errors.get(outcome, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return samples, errors, time.perf_counter() - start
+
+
+def track_in_flight(server, stop):
+    """Sample the stub's concurrent STK pushes; returns the peak"""
+    peak = [0]
+
+    def run():
+        while not stop.is_set():
+            peak[0] = max(peak[0], server.in_flight)
+            time.sleep(0.005)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return peak
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--mode', choices=['both', 'sync', 'asgi'], default='both')
+    p.add_argument('--requests', type=int, default=2000)
+    p.add_argument('--concurrency', type=int, default=500, help='Concurrent clients')
+    p.add_argument('--latency', type=float, default=1.0, help='Stub latency per STK push in seconds')
+    p.add_argument('--workers', type=int, default=1, help='Server processes')
+    p.add_argument('--threads', type=int, default=32, help='Threads per gunicorn worker (sync mode)')
+    p.add_argument('--database-url', help='Defaults to a temporary SQLite file')
+    args = p.parse_args()
+
+    server = start_server(latency=args.latency)
+    db_file = None
+    if not args.database_url:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ.update({
+        'DATABASE_URL': args.database_url or f'sqlite:///{db_file.name}',
+        'MPESA_BASE_URL': server.base_url,
+        'MPESA_CONSUMER_KEY': 'bench',
+        'MPESA_CONSUMER_SECRET': 'bench',
+        'MPESA_SHORTCODE': '174379',
+        'MPESA_PASSKEY': 'bench',
+        'TILL_NUMBER': '174379',
+        'MPESA_TIMEOUT_BUDGET': '60',
+        'ROLLUP_COMPACT_INTERVAL': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    event_id = seed_event()
+
+    modes = ['sync', 'asgi'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        port = free_port()
+        process = serve(mode, port, args)
+        stop = threading.Event()
+        peak = track_in_flight(server, stop)
+        try:
+            samples, errors, elapsed = asyncio.run(
+                load(f'http://127.0.0.1:{port}/api/contribution', event_id, args.requests, args.concurrency))
+        finally:
+            stop.set()
+            process.terminate()
+            process.wait(timeout=30)
+        shape = f'{args.workers} x {args.threads} threads' if mode == 'sync' else f'{args.workers} process(es)'
+        print(f"{mode:>4} ({shape}): {len(samples):,} ok in {elapsed:.1f}s = {len(samples) / elapsed:,.0f} req/s; "
+              f"peak {peak[0]} pushes in flight; "
+              + (f"p50 {percentile(samples, 50) * 1000:.0f} ms, p99 {percentile(samples, 99) * 1000:.0f} ms"
+                 if samples else 'no successful requests')
+              + (f"; errors {errors}" if errors else ''))
+
+    server.shutdown()
+    if db_file:
+        os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Benchmark expenditure summaries: Python loops vs GROUP BY vs cached.
+
+Usage:
+  python scripts/bench_expenditure_summary.py --expenditures 100000 --events 3
+"""
+import os
+import sys
+import argparse
+import random
+import statistics
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def python_loop_summary(Expenditure, event_id):
+    """The previous implementation: load every row and sum in Python"""
+    expenditures = Expenditure.query.filter_by(event_id=event_id).all()
+    by_category = {}
+    for exp in expenditures:
+        by_category[exp.category.value] = by_category.get(exp.category.value, 0) + exp.amount
+    return {'total': sum(exp.amount for exp in expenditures), 'count': len(expenditures),
+            'by_category': by_category}
+
+
+def timed(fn, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--expenditures', type=int, default=100000, help='Expenditures per event')
+    p.add_argument('--events', type=int, default=3)
+    p.add_argument('--repeats', type=int, default=5)
+    p.add_argument('--database-url', help='Defaults to a temporary SQLite file')
+    args = p.parse_args()
+
+    db_file = None
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_file.name}'
+
+    from app import create_app, db
+    from app.models import User, Event, Expenditure, ExpenditureCategory
+    from app.cache import cache, expenditure_summary
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        admin = User(username='bench-expenditures', password_hash='x')
+        db.session.add(admin)
+        db.session.flush()
+        event_ids = []
+        for i in range(args.events):
+            event = Event(admin_id=admin.id, title=f'Event {i}', description='Bench',
+                          organizer_name='Bench', organizer_phone='254712345678', target_amount=1e9)
+            db.session.add(event)
+            db.session.flush()
+            event_ids.append(event.id)
+        categories = list(ExpenditureCategory)
+        for event_id in event_ids:
+            rows = [{'event_id': event_id, 'description': f'Item {n}', 'amount': random.randint(100, 50000),
+                     'category': random.choice(categories)} for n in range(args.expenditures)]
+            db.session.execute(db.insert(Expenditure), rows)
+        db.session.commit()
+
+        event_id = event_ids[0]
+        assert python_loop_summary(Expenditure, event_id)['total'] == Expenditure.summarize(event_id)['total']
+
+        def cached():
+            expenditure_summary(event_id)
+
+        loop_time = timed(lambda: python_loop_summary(Expenditure, event_id), args.repeats)
+        group_by_time = timed(lambda: Expenditure.summarize(event_id), args.repeats)
+        cache.clear()
+        expenditure_summary(event_id)
+        cached_time = timed(cached, args.repeats)
+
+    print(f"{args.expenditures:,} expenditures per event, {args.events} events")
+    print(f"{'python loop':<14}{loop_time * 1000:>10.2f} ms")
+    print(f"{'GROUP BY':<14}{group_by_time * 1000:>10.2f} ms")
+    print(f"{'cached':<14}{cached_time * 1000:>10.4f} ms")
+
+    if db_file:
+        os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
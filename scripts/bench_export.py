@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Benchmark statement exports: rows/sec per format and peak Python memory.
+
+Seeds one event with --rows completed contributions, then runs the same
+export the admin endpoint and `flask export-event` use into a temp file.
+XLSX and Parquet are skipped when openpyxl / pyarrow are not installed.
+Memory is measured in a separate CSV pass under tracemalloc. It should stay
+flat as --rows grows.
+
+Usage:
+  python scripts/bench_export.py --rows 1000000
+  python scripts/bench_export.py --database-url postgresql://localhost/bench_db
+"""
+import os
+import sys
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEED_BATCH = 50000
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--rows', type=int, default=1000000)
+    p.add_argument('--chunk', type=int, default=None, help='Rows per fetch (default EXPORT_CHUNK)')
+    p.add_argument('--database-url', help='Defaults to a temporary SQLite file')
+    args = p.parse_args()
+
+    db_file = None
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_file.name}'
+
+    from app import create_app, db
+    from app.models import User, Event, Contribution
+    from app.exports import FORMATS, EXPORT_CHUNK, write_export
+
+    chunk = args.chunk or EXPORT_CHUNK
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        admin = User(username=f'bench-export-{os.getpid()}', password_hash='x')
+        db.session.add(admin)
+        db.session.flush()
+        event = Event(admin_id=admin.id, title='Export', description='Export benchmark',
+                      organizer_name='Bench', organizer_phone='254712345678', target_amount=1e9)
+        db.session.add(event)
+        db.session.flush()
+        event_id = event.id
+        start = time.perf_counter()
+        for offset in range(0, args.rows, SEED_BATCH):
+            rows = [{'event_id': event_id, 'contributor_name': f'Contributor {n}', 'contributor_phone': '254712345678',
+                     'amount': (n % 5000) + 10.5, 'status': 'completed', 'transaction_id': f'R{event_id}-{n}'}
+                    for n in range(offset, min(offset + SEED_BATCH, args.rows))]
+            db.session.execute(db.insert(Contribution), rows)
+        db.session.commit()
+        print(f"seeded {args.rows:,} contributions in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'format':<10}{'rows/s':>14}{'seconds':>10}{'size MB':>10}")
+        for fmt in FORMATS:
+            with tempfile.TemporaryFile() as f:
+                start = time.perf_counter()
+                try:
+                    count = write_export('contributions', event_id, fmt, f, chunk)
+                except RuntimeError as e:
+                    print(f"{fmt:<10}skipped: {e}")
+                    continue
+                elapsed = time.perf_counter() - start
+                size = f.tell() / 1e6
+            assert count == args.rows, (fmt, count)
+            print(f"{fmt:<10}{count / elapsed:>14,.0f}{elapsed:>10.2f}{size:>10.1f}")
+
+        with tempfile.TemporaryFile() as f:
+            tracemalloc.start()
+            write_export('contributions', event_id, 'csv', f, chunk)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print(f"csv peak Python memory: {peak / 1e6:.1f} MB for {args.rows:,} rows (chunk {chunk:,})")
+
+    if db_file:
+        os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Measure login throughput, and what a login burst does to payment-side requests.
+
+Seeds --users admin accounts and an event on a temporary database, then for
+each hashing mode serves run:app with gunicorn (--workers x --threads) and
+sends --logins POST /login requests from --concurrency concurrent clients.
+Meanwhile one client polls the public contributions API, standing in for
+the payment endpoints, and the script reports its latency next to login
+throughput:
+
+  - inline: PASSWORD_HASH_WORKERS=0, every request thread hashes itself
+  - pool:   PASSWORD_HASH_WORKERS=--hash-workers
+
+A last run replays the logins as credential stuffing against one username
+with the default throttle, which should answer almost all of them 429.
+
+Needs gunicorn and httpx (pip install gunicorn httpx).
+
+Usage:
+  python scripts/bench_login.py --logins 200 --concurrency 32
+  python scripts/bench_login.py --method scrypt:65536:8:1 --hash-workers 4
+"""
+import os
+import sys
+import argparse
+import asyncio
+import socket
+import subprocess
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_asgi import ROOT, free_port, percentile
+
+PASSWORD = 'correct horse battery'
+
+
+def seed(users, method):
+    from app import create_app, db
+    from app.models import User, Event
+    from werkzeug.security import generate_password_hash
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        pwhash = generate_password_hash(PASSWORD, method)
+        names = [f'bench-{uuid.uuid4().hex[:8]}' for _ in range(users)]
+        db.session.add_all(User(username=name, email=f'{name}@example.com', password_hash=pwhash) for name in names)
+        db.session.flush()
+        admin = User.query.filter_by(username=names[0]).first()
+        event = Event(admin_id=admin.id, title='Login benchmark', description='Benchmark', organizer_name='Bench',
+                      organizer_phone='254712345678', target_amount=1e9)
+        db.session.add(event)
+        db.session.commit()
+        return names, event.id
+
+
+def serve(port, args, env):
+    command = ['gunicorn', '--workers', str(args.workers), '--threads', str(args.threads),
+               '--bind', f'127.0.0.1:{port}', '--backlog', '4096', '--timeout', '120', 'run:app']
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return process
+        if process.poll() is not None:
+            raise SystemExit(f'server exited: {process.stderr.read().decode()[-2000:]}')
+        time.sleep(0.2)
+    process.kill()
+    raise SystemExit('server did not start')
+
+
+async def load(base, usernames, total, concurrency, probe_path):
+    import httpx
+
+    samples, probes, outcomes = [], [], {}
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(usernames[i % len(usernames)])
+    done = asyncio.Event()
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=120) as client:
+        async def worker():
+            while not queue.empty():
+                username = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    response = await client.post('/login', data={'username': username, 'password': PASSWORD})
+                    outcome = response.status_code
+                except httpx.HTTPError as e:
+                    outcome = type(e).__name__
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                if outcome == 302:
+                    samples.append(time.perf_counter() - start)
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get(probe_path)
+                probes.append(time.perf_counter() - start)
+                await asyncio.sleep(0.05)
+
+        prober = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await prober
+        return samples, probes, outcomes, elapsed
+
+
+def run(label, args, env, usernames, total, probe_path):
+    port = free_port()
+    process = serve(port, args, env)
+    try:
+        samples, probes, outcomes, elapsed = asyncio.run(
+            load(f'http://127.0.0.1:{port}', usernames, total, args.concurrency, probe_path))
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    print(f"{label:>8}: {len(samples):,} logins in {elapsed:.1f}s = {len(samples) / elapsed:,.1f}/s"
+          + (f", p50 {percentile(samples, 50) * 1000:.0f} ms, p99 {percentile(samples, 99) * 1000:.0f} ms"
+             if samples else '')
+          + (f"; probe p50 {percentile(probes, 50) * 1000:.0f} ms, p99 {percentile(probes, 99) * 1000:.0f} ms"
+             if probes else '')
+          + f"; responses {outcomes}")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--users', type=int, default=50)
+    p.add_argument('--logins', type=int, default=200)
+    p.add_argument('--concurrency', type=int, default=32, help='Concurrent login clients')
+    p.add_argument('--workers', type=int, default=1, help='gunicorn processes')
+    p.add_argument('--threads', type=int, default=32, help='Threads per gunicorn worker')
+    p.add_argument('--hash-workers', type=int, default=2, help='PASSWORD_HASH_WORKERS for the pool run')
+    p.add_argument('--method', default='scrypt', help='PASSWORD_HASH_METHOD')
+    args = p.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{db_file.name}',
+        'PASSWORD_HASH_METHOD': args.method,
+        'ROLLUP_COMPACT_INTERVAL': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    usernames, event_id = seed(args.users, args.method)
+    probe_path = f'/api/event/{event_id}/contributions'
+    unthrottled = {'LOGIN_ATTEMPTS_PER_IP': '1000000', 'LOGIN_ATTEMPTS_PER_USER': '1000000'}
+
+    run('inline', args, {**os.environ, **unthrottled, 'PASSWORD_HASH_WORKERS': '0'},
+        usernames, args.logins, probe_path)
+    run('pool', args, {**os.environ, **unthrottled, 'PASSWORD_HASH_WORKERS': str(args.hash_workers)},
+        usernames, args.logins, probe_path)
+    run('stuffing', args, {**os.environ, 'PASSWORD_HASH_WORKERS': str(args.hash_workers)},
+        usernames[:1], args.logins, probe_path)
+    os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Compare query plans and latency of the hot read paths with and without indexes.
+
+Seeds a scratch database with many contributions, then times the queries
+behind event_detail, get_event_contributions and admin_dashboard. It runs them
+first with the hot-path indexes dropped and then with them created.
+
+Usage:
+  python scripts/bench_queries.py --contributions 1000000
+  python scripts/bench_queries.py --database-url postgresql://localhost/bench_db
+"""
+import os
+import sys
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOT_PATH_INDEXES = (
+    'ix_contributions_event_id_status_created_at',
+    'ix_events_admin_id',
+    'ix_events_status',
+    'ix_expenditures_event_id_created_at',
+)
+
+
+def seed(db, models, contributions, events, admins):
+    User, Event, Contribution = models
+    users = [User(username=f'bench-{i}', password_hash='x') for i in range(admins)]
+    db.session.add_all(users)
+    db.session.flush()
+    rows = [Event(admin_id=users[i % admins].id, title=f'Event {i}', description='Bench',
+                  organizer_name='Bench', organizer_phone='254712345678', target_amount=1e6,
+                  status='active' if i % 4 else 'closed')
+            for i in range(events)]
+    db.session.add_all(rows)
+    db.session.commit()
+    event_ids = [e.id for e in rows]
+
+    now = datetime.utcnow()
+    statuses = ['completed'] * 16 + ['pending'] * 3 + ['failed']
+    chunk = 50000
+    for offset in range(0, contributions, chunk):
+        batch = []
+        for i in range(offset, min(offset + chunk, contributions)):
+            created = now - timedelta(seconds=random.randint(0, 90 * 86400))
+            batch.append({
+                'event_id': random.choice(event_ids),
+                'contributor_name': f'C{i}',
+                'contributor_phone': '254712345678',
+                'amount': random.randint(10, 5000),
+                'payment_method': 'mpesa',
+                'status': random.choice(statuses),
+                'created_at': created,
+                'updated_at': created,
+            })
+        db.session.execute(db.insert(Contribution), batch)
+        db.session.commit()
+        print(f"  seeded {min(offset + chunk, contributions):,} contributions", end='\r')
+    print()
+    return event_ids, [u.id for u in users]
+
+
+def hot_queries(db, models, event_id, admin_id):
+    User, Event, Contribution = models
+    return {
+        'event_detail': db.select(Contribution).where(
+            Contribution.event_id == event_id, Contribution.status == 'completed'
+        ).order_by(Contribution.created_at.desc()),
+        'get_event_contributions': db.select(Contribution).where(
+            Contribution.event_id == event_id, Contribution.status == 'completed'
+        ),
+        'admin_dashboard (events)': db.select(Event).where(Event.admin_id == admin_id),
+        'admin_dashboard (total)': db.select(db.func.coalesce(db.func.sum(Contribution.amount), 0)).where(
+            Contribution.status == 'completed',
+            Contribution.event_id.in_(db.select(Event.id).where(Event.admin_id == admin_id))
+        ),
+        'index (active events)': db.select(Event).where(Event.status == 'active'),
+    }
+
+
+def explain(db, statement):
+    sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = db.session.execute(db.text(prefix + sql)).all()
+    return ' | '.join(str(row[-1]) for row in rows)
+
+
+def measure(db, queries, repeats):
+    results = {}
+    for name, statement in queries.items():
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            db.session.execute(statement).all()
+            samples.append(time.perf_counter() - start)
+        results[name] = (statistics.median(samples), explain(db, statement))
+    return results
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--contributions', type=int, default=1000000)
+    p.add_argument('--events', type=int, default=500)
+    p.add_argument('--admins', type=int, default=50)
+    p.add_argument('--repeats', type=int, default=5)
+    p.add_argument('--database-url', help='Defaults to a temporary SQLite file')
+    args = p.parse_args()
+
+    db_file = None
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_file.name}'
+
+    from app import create_app, db
+    from app.models import User, Event, Contribution
+    models = (User, Event, Contribution)
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        print(f"Seeding {args.contributions:,} contributions over {args.events} events...")
+        event_ids, admin_ids = seed(db, models, args.contributions, args.events, args.admins)
+        queries = hot_queries(db, models, event_ids[len(event_ids) // 2], admin_ids[0])
+
+        indexes = [index for table in db.metadata.tables.values()
+                   for index in table.indexes if index.name in HOT_PATH_INDEXES]
+        for index in indexes:
+            index.drop(db.engine)
+        without = measure(db, queries, args.repeats)
+
+        for index in indexes:
+            index.create(db.engine)
+        db.session.execute(db.text('ANALYZE'))
+        with_indexes = measure(db, queries, args.repeats)
+
+    print(f"\n{'query':<28}{'no index ms':>14}{'indexed ms':>14}{'speedup':>10}")
+    for name in queries:
+        before, after = without[name][0], with_indexes[name][0]
+        print(f"{name:<28}{before * 1000:>14.2f}{after * 1000:>14.2f}{before / max(after, 1e-9):>9.1f}x")
+    print("\nQuery plans:")
+    for name in queries:
+        print(f"  {name}\n    before: {without[name][1]}\n    after:  {with_indexes[name][1]}")
+
+    if db_file:
+        os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Measure worker cold start: importing the app, create_app() and the first request.
+
+Each of --runs fresh interpreters times the three phases against a temporary
+SQLite database (created once up front, as `flask init-db` would) and lists
+which heavy optional modules were loaded by the time the first response was
+sent. Those should only load when a request needs them: requests with the
+first STK push, numpy with the first dashboard.
+
+Needs no network or server, so it can run in CI. With --budget-ms it exits
+nonzero when the median total exceeds the budget.
+
+Usage:
+  python scripts/bench_startup.py --runs 10
+  python scripts/bench_startup.py --runs 5 --budget-ms 1500 --path /login
+"""
+import os
+import sys
+import argparse
+import json
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['numpy', 'requests', 'httpx', 'openpyxl', 'pyarrow']
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+status = app.test_client().get(sys.argv[1]).status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import': imported - start, 'create_app': created - imported, 'first_request': served - created,
+    'status': status, 'loaded': [name for name in json.loads(sys.argv[2]) if name in sys.modules],
+}))
+"""
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--runs', type=int, default=10)
+    p.add_argument('--path', default='/', help='First request to time')
+    p.add_argument('--budget-ms', type=float, help='Fail if the median total is slower than this')
+    args = p.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    env = {**os.environ, 'DATABASE_URL': f'sqlite:///{db_file.name}', 'LOG_LEVEL': 'WARNING',
+           'ROLLUP_COMPACT_INTERVAL': '0', 'RECONCILE_INTERVAL': '0'}
+    subprocess.run([sys.executable, '-c', 'from app import create_app, db\n'
+                    'with create_app().app_context(): db.create_all()'],
+                   cwd=ROOT, env=env, check=True)
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', CHILD, args.path, json.dumps(HEAVY)],
+                                cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    os.unlink(db_file.name)
+
+    phases = ['import', 'create_app', 'first_request']
+    totals = [sum(run[phase] for phase in phases) for run in runs]
+    for phase in phases:
+        print(f"{phase:>13}: median {median([run[phase] for run in runs]) * 1000:6.0f} ms")
+    total = median(totals) * 1000
+    print(f"{'total':>13}: median {total:6.0f} ms, min {min(totals) * 1000:.0f} ms, max {max(totals) * 1000:.0f} ms "
+          f"over {args.runs} runs (GET {args.path} -> {runs[0]['status']})")
+    print(f"heavy modules loaded at startup: {', '.join(runs[0]['loaded']) or 'none'}")
+
+    if args.budget_ms is not None and total > args.budget_ms:
+        print(f"FAIL: median {total:.0f} ms exceeds the {args.budget_ms:.0f} ms budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Latency benchmark for STKPushHandler.initiate_stk_push against a local mock Daraja.
+
+Compares a fresh connection per call (the old bare requests.post behaviour)
+with the pooled keep-alive session.
+
+Usage:
+  python scripts/bench_stk_push.py --requests 500 --concurrency 8 --latency 0.02
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_daraja import start_server
+
+
+class FreshConnectionSession:
+    """Session stand-in that opens a new connection for every request"""
+
+    def request(self, method, url, **kwargs):
+        with requests.Session() as session:
+            return session.request(method, url, **kwargs)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(handler, app, contribution_id, total, concurrency):
+    def one(_):
+        with app.app_context():
+            start = time.perf_counter()
+            result = handler.initiate_stk_push('254712345678', 10, contribution_id, 'Benchmark')
+            elapsed = time.perf_counter() - start
+            if 'error' in result:
+                raise RuntimeError(result['error'])
+            return elapsed
+
+    # Warm the token cache so both runs measure the STK call path only
+    handler.get_access_token()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, range(total)))
+    return samples
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--requests', type=int, default=300)
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--latency', type=float, default=0.0, help='Mock server latency in seconds')
+    args = p.parse_args()
+
+    server = start_server(latency=args.latency)
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{db_file.name}',
+        'MPESA_BASE_URL': server.base_url,
+        'MPESA_CONSUMER_KEY': 'bench',
+        'MPESA_CONSUMER_SECRET': 'bench',
+        'MPESA_SHORTCODE': '174379',
+        'MPESA_PASSKEY': 'bench',
+        'TILL_NUMBER': '174379',
+    })
+
+    from app import create_app, db
+    from app.models import User, Event, Contribution
+    from app.payments import STKPushHandler
+
+    app = create_app()
+    with app.app_context():
+        admin = User(username='bench')
+        admin.set_password('bench')
+        db.session.add(admin)
+        db.session.flush()
+        event = Event(admin_id=admin.id, title='Bench', description='Bench',
+                      organizer_name='Bench', organizer_phone='254712345678', target_amount=1000)
+        db.session.add(event)
+        db.session.flush()
+        contribution = Contribution(event_id=event.id, contributor_name='Bench',
+                                    contributor_phone='254712345678', amount=10)
+        db.session.add(contribution)
+        db.session.commit()
+        contribution_id = contribution.id
+
+    results = {}
+    for label, session in (('fresh connection', FreshConnectionSession()),
+                           ('pooled session', None)):
+        handler = STKPushHandler(session=session)
+        samples = run(handler, app, contribution_id, args.requests, args.concurrency)
+        results[label] = samples
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, mock latency {args.latency * 1000:.0f} ms")
+    print(f"{'mode':<18}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for label, samples in results.items():
+        print(f"{label:<18}{percentile(samples, 50) * 1000:>10.2f}"
+              f"{percentile(samples, 99) * 1000:>10.2f}{statistics.mean(samples) * 1000:>10.2f}")
+    server.shutdown()
+    os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
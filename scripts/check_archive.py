@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Check that archiving a closed event changes nothing anyone can see.
+
+Seeds a closed event and an active one with --contributions contributions
+each, their callbacks, and some old callbacks with no contribution. It then
+posts everything to the ledger, builds the rollups and records what the read
+paths return for the closed event: the contributions API (paged and
+ndjson), the export, /stats, the dashboard extract and reconcile-totals.
+Then it runs the same archive() as `flask archive-history` and checks:
+
+  - the closed event's contributions and callbacks left the hot tables
+  - the active event and recent callbacks were not touched
+  - every read path returns exactly what it did before, including a rollup
+    rebuild from the whole ledger
+  - archived callback payloads decompress to the original JSON
+  - restore_event() puts the contributions back unchanged
+
+Exits nonzero on any mismatch.
+
+Usage:
+  python scripts/check_archive.py --contributions 5000
+"""
+import os
+import sys
+import argparse
+import json
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stress_callbacks import callback_payload
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--contributions', type=int, default=5000, help='Contributions per event')
+    args = p.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{db_file.name}',
+        'ROLLUP_COMPACT_INTERVAL': '0',
+        'RECONCILE_INTERVAL': '0',
+    })
+
+    from app import create_app, db
+    from app.models import (User, Event, Contribution, ContributionArchive, PaymentCallback,
+                            PaymentCallbackArchive, LedgerEntry, ContributionRollup, RollupState)
+    from app.analytics import LedgerExtract
+    from app.archive import archive, restore_event
+    from app.exports import export_chunks
+    from app.rollups import compact_all, event_stats
+
+    app = create_app()
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+        admin = User(username=f'archive-{uuid.uuid4().hex[:8]}', password_hash='x')
+        db.session.add(admin)
+        db.session.flush()
+        events = []
+        for title, status in (('Closed', 'closed'), ('Active', 'active')):
+            event = Event(admin_id=admin.id, title=title, description='Archive check', organizer_name='Check',
+                          organizer_phone='254712345678', target_amount=1e9, status=status)
+            db.session.add(event)
+            events.append(event)
+        db.session.flush()
+        closed, active = events
+
+        start = datetime.utcnow() - timedelta(days=120)
+        rows = []
+        for event in events:
+            for i in range(args.contributions):
+                rows.append({
+                    'event_id': event.id, 'contributor_name': f'C{i % 300}', 'contributor_phone': f'2547{i % 300:08d}',
+                    'amount': (i % 50) + 1, 'status': 'completed' if i % 10 else 'failed',
+                    'transaction_id': f'R{event.id}x{i}', 'created_at': start + timedelta(minutes=17 * i)
+                })
+        db.session.execute(db.insert(Contribution), rows)
+        contributions = db.session.execute(
+            db.select(Contribution.id, Contribution.created_at, Contribution.transaction_id)).all()
+        callbacks = [{'contribution_id': c.id, 'transaction_id': f'ws_CO_{c.transaction_id}',
+                      'mpesa_receipt_number': c.transaction_id, 'status': 'success', 'amount': 1,
+                      'raw_response': callback_payload(f'ws_CO_{c.transaction_id}', 1, c.transaction_id),
+                      # Recent, so only the closed event's callbacks move with it
+                      'created_at': datetime.utcnow() - timedelta(hours=1)} for c in contributions]
+        # Orphans: old enough to archive, and recent ones that must stay
+        for i, age in enumerate([200] * 50 + [1] * 50):
+            callbacks.append({'transaction_id': f'ws_CO_orphan{i}', 'status': 'failed',
+                              'raw_response': {'ResultCode': 1032, 'i': i},
+                              'created_at': datetime.utcnow() - timedelta(days=age)})
+        db.session.execute(db.insert(PaymentCallback), callbacks)
+        LedgerEntry.backfill()
+        Event.rebuild_totals()
+        db.session.execute(db.update(Event).where(Event.id == closed.id)
+                           .values(updated_at=datetime.utcnow() - timedelta(days=60)))
+        db.session.commit()
+        compact_all(settle_lag=timedelta(0))
+        closed_id, active_id, admin_id = closed.id, active.id, admin.id
+        raw_before = {row.transaction_id: row.raw_response for row in db.session.execute(
+            db.select(PaymentCallback.transaction_id, PaymentCallback.raw_response)).all()}
+        db.session.remove()
+
+    def snapshot():
+        with app.app_context():
+            pages, cursor = [], None
+            while True:
+                response = client.get(f'/api/event/{closed_id}/contributions?limit=500'
+                                      + (f'&cursor={cursor}' if cursor else ''))
+                pages.extend(response.get_json())
+                cursor = response.headers.get('X-Next-Cursor')
+                if not cursor:
+                    break
+            extract = LedgerExtract(admin_id)
+            extract.refresh(settle_lag=timedelta(0))
+            totals = Event.completed_totals_subquery()
+            state = {
+                'page': pages,
+                'ndjson': client.get(f'/api/event/{closed_id}/contributions?format=ndjson').get_data(as_text=True),
+                'export': [row for chunk in export_chunks('contributions', closed_id) for row in chunk],
+                'stats': event_stats(closed_id, 'day', start, start + timedelta(days=100))['buckets'],
+                'extract': (extract.ts.tolist(), extract.phone.tolist(), extract.name.tolist()),
+                'totals': sorted(db.session.execute(db.select(totals.c.event_id, totals.c.total, totals.c.count)).all()),
+            }
+            db.session.remove()
+            return state
+
+    before = snapshot()
+    with app.app_context():
+        began = time.perf_counter()
+        report = archive(timedelta(days=30), timedelta(days=90))
+        elapsed = time.perf_counter() - began
+        hot = dict(db.session.execute(
+            db.select(Contribution.event_id, db.func.count()).group_by(Contribution.event_id)).all())
+        archived = db.session.scalar(db.select(db.func.count()).select_from(ContributionArchive))
+        hot_callbacks = db.session.scalar(db.select(db.func.count()).select_from(PaymentCallback))
+        cold = db.session.execute(db.select(PaymentCallbackArchive)).scalars().all()
+        payloads_ok = all(cb.raw_response == raw_before[cb.transaction_id] for cb in cold)
+        raw_bytes = sum(len(json.dumps(raw_before[cb.transaction_id])) for cb in cold)
+        stored_bytes = sum(len(cb.raw_response_z) for cb in cold)
+        db.session.remove()
+    after = snapshot()
+
+    # A rebuild reads the ledger from the start, including archived events
+    with app.app_context():
+        db.session.execute(db.delete(ContributionRollup))
+        db.session.execute(db.delete(RollupState))
+        db.session.commit()
+        compact_all(settle_lag=timedelta(0))
+        db.session.remove()
+    rebuilt = snapshot()
+
+    with app.app_context():
+        restored = restore_event(closed_id)
+        hot_after_restore = db.session.scalar(
+            db.select(db.func.count(Contribution.id)).where(Contribution.event_id == closed_id))
+        db.session.remove()
+    reopened = snapshot()
+
+    print(f"archived {report['events']} events, {report['contributions']:,} contributions and "
+          f"{report['callbacks']:,} callbacks in {elapsed:.2f}s")
+    print(f"hot contributions per event {hot}; archive {archived:,}; hot callbacks {hot_callbacks:,}, "
+          f"archived {len(cold):,} ({raw_bytes:,} -> {stored_bytes:,} payload bytes)")
+    mismatched = [key for key in before if not (before[key] == after[key] == rebuilt[key] == reopened[key])]
+    print(f"read paths differing after archive/rebuild/restore: {mismatched or 'none'}")
+
+    n = args.contributions
+    ok = (
+        report['events'] == 1
+        and report['contributions'] == n == archived
+        and hot == {active_id: n}
+        and hot_callbacks == n + 50
+        and len(cold) == n + 50
+        and payloads_ok
+        and not mismatched
+        and restored == n == hot_after_restore
+    )
+    os.unlink(db_file.name)
+    print('OK' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
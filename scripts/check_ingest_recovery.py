@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""Check that batched callback ingestion survives a crash.
+
+A child process runs the app with CALLBACK_INGEST_MODE=batch and accepts
+--callbacks callbacks (each delivered twice). It dies with os._exit() leaving
+three kinds of leftovers:
+
+  - a batch that committed but whose file was never deleted
+  - a batch file that was rotated but never applied
+  - a live spool with acknowledged lines and a truncated final line
+
+The unapplied batch also holds a payload that cannot be parsed (spooled
+before the endpoint validated bodies; the endpoint itself must now answer
+400). A fresh app started on the same spool directory must apply every
+acknowledged callback exactly once and move only the bad payload to
+dead-letter/. Before that, the leftovers are renamed to the PID of a live,
+unrelated process, as when a container reuses a dead worker's PID: ownership
+must come from the spool's owner lock, not from PID liveness. The script
+exits nonzero if it doesn't.
+
+Usage:
+  python scripts/check_ingest_recovery.py --callbacks 300
+"""
+import os
+import sys
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stress_callbacks import callback_payload
+
+
+def seed(callbacks):
+    """Create an event with pending contributions; returns (event_id, payloads)"""
+    from app import create_app, db
+    from app.models import User, Event, Contribution
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        admin = User(username=f'ingest-{uuid.uuid4().hex[:8]}', password_hash='x')
+        db.session.add(admin)
+        db.session.flush()
+        event = Event(admin_id=admin.id, title='Ingest', description='Crash recovery check',
+                      organizer_name='Ingest', organizer_phone='254712345678', target_amount=1e9)
+        db.session.add(event)
+        db.session.flush()
+        payloads = []
+        for i in range(callbacks):
+            checkout_id = f'ws_CO_{uuid.uuid4().hex[:24]}'
+            amount = (i % 50) + 1
+            db.session.add(Contribution(event_id=event.id, contributor_name=f'C{i}',
+                                        contributor_phone='254712345678', amount=amount,
+                                        transaction_id=checkout_id))
+            payloads.append(callback_payload(checkout_id, amount, f'R{uuid.uuid4().hex[:10].upper()}'))
+        db.session.commit()
+        return event.id, payloads
+
+
+def child(payloads):
+    """Accept every callback twice, then die without a clean shutdown"""
+    from app import create_app
+
+    app = create_app()
+    batcher = app.extensions['callback_batcher']
+    client = app.test_client()
+    first, second, third = (payloads[i::3] for i in range(3))
+
+    for payload in first + first:
+        assert client.post('/api/payment/callback', json=payload).status_code == 200
+    batcher.flush()
+    # Committed, but the process died before deleting the batch file
+    with open(batcher._batch_path('committed'), 'w') as f:
+        for payload in first:
+            f.write(json.dumps(payload) + '\n')
+
+    assert client.post('/api/payment/callback', json=[1]).status_code == 400
+    batcher.submit([1])
+    for payload in second + second:
+        assert client.post('/api/payment/callback', json=payload).status_code == 200
+    batcher._rotate()
+
+    for payload in third + third:
+        assert client.post('/api/payment/callback', json=payload).status_code == 200
+    batcher._spool.write('{"Body": {"stkCallback": {"CheckoutRe')
+    batcher._spool.flush()
+    os._exit(9)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--callbacks', type=int, default=300)
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.child:
+        with open(args.child) as f:
+            child(json.load(f))
+        return
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "ingest.db")}'
+    os.environ['CALLBACK_SPOOL_DIR'] = os.path.join(workdir, 'spool')
+    os.environ['CALLBACK_FLUSH_INTERVAL'] = '3600'
+    os.environ['CALLBACK_BATCH_SIZE'] = str(args.callbacks * 10)
+
+    event_id, payloads = seed(args.callbacks)
+    payload_file = os.path.join(workdir, 'payloads.json')
+    with open(payload_file, 'w') as f:
+        json.dump(payloads, f)
+
+    env = dict(os.environ, CALLBACK_INGEST_MODE='batch')
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', payload_file], env=env)
+    spool_dir = os.environ['CALLBACK_SPOOL_DIR']
+    leftovers = sorted(os.listdir(spool_dir))
+    print(f"child exited with {result.returncode}, left {leftovers}")
+    # The dead child's PID now belongs to a process that is not a batcher
+    child_pid = next(name.split('-')[1].split('.')[0] for name in leftovers if name.startswith('spool-'))
+    squatter = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(600)'],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for name in leftovers:
+        if child_pid in name:
+            os.replace(os.path.join(spool_dir, name),
+                       os.path.join(spool_dir, name.replace(f'-{child_pid}', f'-{squatter.pid}', 1)))
+
+    os.environ['CALLBACK_INGEST_MODE'] = 'batch'
+    from app import create_app
+    from app.models import Event, Contribution, PaymentCallback
+
+    try:
+        app = create_app()
+        with app.app_context():
+            event = Event.query.get(event_id)
+            expected = sum((i % 50) + 1 for i in range(args.callbacks))
+            completed = Contribution.query.filter_by(event_id=event_id, status='completed').count()
+            stored = PaymentCallback.query.count()
+            remaining = [name for name in os.listdir(spool_dir) if name.startswith('batch-')]
+            dead_dir = os.path.join(spool_dir, 'dead-letter')
+            dead = [json.loads(line) for name in (os.listdir(dead_dir) if os.path.isdir(dead_dir) else [])
+                    for line in open(os.path.join(dead_dir, name))]
+            print(f"current_amount={event.current_amount} expected={expected}")
+            print(f"contribution_count={event.contribution_count} completed={completed} callbacks stored={stored}")
+            print(f"dead-lettered {dead}; unapplied batch files {remaining}")
+            ok = (event.current_amount == expected and event.contribution_count == completed == stored == args.callbacks
+                  and not remaining and dead == [[1]])
+    finally:
+        squatter.kill()
+    shutil.rmtree(workdir)
+    print('OK' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
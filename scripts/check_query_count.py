@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Check that listing events costs the same number of queries for 1 event as for N.
+
+Seeds one active event, requests the homepage and /api/events with the cache
+cleared and counts the SQL statements each issues (a before_cursor_execute
+listener on the engine). Then it adds --events more active events, each
+with --contributions completed contributions, and counts again. Any growth
+means per-event queries are back: an N+1 such as Event.to_dict() lazy-loading
+its contributions. Exits nonzero on any growth.
+
+Usage:
+  python scripts/check_query_count.py --events 50 --contributions 20
+"""
+import os
+import sys
+import argparse
+import tempfile
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PATHS = ['/', '/api/events']
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--events', type=int, default=50)
+    p.add_argument('--contributions', type=int, default=20, help='Completed contributions per event')
+    args = p.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{db_file.name}',
+        'ROLLUP_COMPACT_INTERVAL': '0',
+        'RECONCILE_INTERVAL': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+
+    from sqlalchemy import event as sa_event
+    from app import create_app, db
+    from app.models import User, Event, Contribution
+    from app.cache import cache
+
+    app = create_app()
+    client = app.test_client()
+    statements = []
+
+    def add_events(admin_id, count):
+        events = [Event(admin_id=admin_id, title=f'Event {uuid.uuid4().hex[:8]}', description='Query count',
+                        organizer_name='Check', organizer_phone='254712345678', target_amount=1e6)
+                  for _ in range(count)]
+        db.session.add_all(events)
+        db.session.flush()
+        db.session.execute(db.insert(Contribution), [
+            {'event_id': event.id, 'contributor_name': f'C{i}', 'contributor_phone': '254712345678',
+             'amount': 10, 'status': 'completed', 'transaction_id': f'R{uuid.uuid4().hex[:12]}'}
+            for event in events for i in range(args.contributions)
+        ])
+        for event in events:
+            Event.add_to_total(event.id, 10 * args.contributions, args.contributions)
+        db.session.commit()
+
+    def count_queries():
+        counts = {}
+        for path in PATHS:
+            cache.clear()
+            statements.clear()
+            response = client.get(path)
+            assert response.status_code == 200, (path, response.status_code)
+            counts[path] = len(statements)
+        return counts
+
+    with app.app_context():
+        db.create_all()
+        sa_event.listen(db.engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+        admin = User(username=f'queries-{uuid.uuid4().hex[:8]}', password_hash='x')
+        db.session.add(admin)
+        db.session.commit()
+        admin_id = admin.id
+
+        add_events(admin_id, 1)
+        single = count_queries()
+        add_events(admin_id, args.events)
+        many = count_queries()
+        listed = len(client.get('/api/events').get_json())
+        db.session.remove()
+
+    for path in PATHS:
+        print(f"{path:<12} 1 event: {single[path]} queries; {args.events + 1} events: {many[path]} queries")
+    os.unlink(db_file.name)
+    ok = single == many and listed == args.events + 1
+    print('OK' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Check the pending reconciler against the local Daraja stub.
+
+Seeds --pending stale pending contributions (plus a few that are too young
+to touch and a few whose push was never accepted), points STKPushHandler at
+scripts/mock_daraja.py and runs the same reconcile() the background thread
+and `flask reconcile-pending` use. The stub decides each outcome from the
+CheckoutRequestID, so the expected result is known up front. A second run
+must find nothing left to do. Two races with callbacks are simulated too:
+one callback settles a contribution before the reconciler gets to it, and
+another reads a contribution while it is pending but only settles it after
+the reconciler (running in another thread and session) has committed it.
+
+Checks:
+  - every paid push is completed exactly once (event total, count and ledger)
+  - cancelled / timed-out pushes are failed, unanswered ones expired
+  - young contributions are left pending
+  - the STK query rate stays under --qps
+
+Prints the drain rate. Exits nonzero on any mismatch.
+
+Usage:
+  python scripts/check_reconciler.py --pending 500 --qps 50
+"""
+import os
+import sys
+import argparse
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_daraja import start_server
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--pending', type=int, default=500)
+    p.add_argument('--qps', type=float, default=50, help='STK queries per second allowed by the token bucket')
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--latency', type=float, default=0.02, help='Stub latency per request in seconds')
+    args = p.parse_args()
+
+    # The stub answers 429 above its own limit; the reconciler must stay below it
+    server = start_server(latency=args.latency, query_rate=int(args.qps * 1.5) + 1)
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{db_file.name}',
+        'MPESA_BASE_URL': server.base_url,
+        'MPESA_CONSUMER_KEY': 'check',
+        'MPESA_CONSUMER_SECRET': 'check',
+        'MPESA_SHORTCODE': '174379',
+        'MPESA_PASSKEY': 'check',
+        'ROLLUP_COMPACT_INTERVAL': '0',
+        'RECONCILE_INTERVAL': '0',
+    })
+
+    from app import create_app, db
+    from app.models import User, Event, Contribution, LedgerEntry
+    from app.payments import STKPushHandler, settle_contribution
+    from app.ratelimit import TokenBucket
+    from app.reconciler import reconcile
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        admin = User(username=f'reconcile-{uuid.uuid4().hex[:8]}', password_hash='x')
+        db.session.add(admin)
+        db.session.flush()
+        event = Event(admin_id=admin.id, title='Reconcile', description='Reconciler check',
+                      organizer_name='Check', organizer_phone='254712345678', target_amount=1e9)
+        db.session.add(event)
+        db.session.flush()
+
+        old = datetime.utcnow() - timedelta(hours=2)
+        expected = {'completed': 0, 'failed': 0, 'expired': 0}
+        paid_amount = 0
+        rows = []
+        for i in range(args.pending):
+            checkout_id = f'ws_CO_{uuid.uuid4().hex[:24]}'
+            code = server.query_outcome(checkout_id)
+            outcome = 'completed' if code == 0 else 'expired' if code is None else 'failed'
+            expected[outcome] += 1
+            amount = (i % 50) + 1
+            if code == 0:
+                paid_amount += amount
+            rows.append({'event_id': event.id, 'contributor_name': f'C{i}', 'contributor_phone': '254712345678',
+                         'amount': amount, 'status': 'pending', 'transaction_id': checkout_id, 'created_at': old})
+        # Push never accepted by Safaricom: nothing to query, expires
+        for i in range(5):
+            rows.append({'event_id': event.id, 'contributor_name': f'Q{i}', 'contributor_phone': '254712345678',
+                         'amount': 10, 'status': 'pending', 'created_at': old})
+        expected['expired'] += 5
+        # Too young to reconcile
+        for i in range(5):
+            rows.append({'event_id': event.id, 'contributor_name': f'Y{i}', 'contributor_phone': '254712345678',
+                         'amount': 10, 'status': 'pending', 'transaction_id': f'ws_CO_young{i}',
+                         'created_at': datetime.utcnow()})
+        db.session.execute(db.insert(Contribution), rows)
+        db.session.commit()
+
+        paid = [r['transaction_id'] for r in rows[:args.pending] if server.query_outcome(r['transaction_id']) == 0]
+        # A real callback settles one paid contribution before the reconciler sees it
+        raced = Contribution.query.filter_by(transaction_id=paid[0]).one()
+        settle_contribution(raced, 'RACEDRECEIPT')
+        db.session.commit()
+        # Another callback has read this one while it is pending, but commits after the reconciler
+        interleaved = Contribution.query.filter_by(transaction_id=paid[1]).one()
+
+        handler = STKPushHandler()
+        bucket = TokenBucket(args.qps, capacity=1)
+        start = time.perf_counter()
+        queries_before = server.counts.get('stkpushquery', 0)
+        reports = []
+
+        def run_reconciler():
+            with app.app_context():
+                reports.append(reconcile(handler, timedelta(minutes=2), timedelta(hours=1), bucket,
+                                         workers=args.workers))
+                db.session.remove()
+        thread = threading.Thread(target=run_reconciler)
+        thread.start()
+        thread.join()
+        report = reports[0]
+        elapsed = time.perf_counter() - start
+        late_settled = settle_contribution(interleaved, 'INTERLEAVEDRECEIPT')
+        db.session.commit()
+        queries = server.counts.get('stkpushquery', 0) - queries_before
+        second = reconcile(handler, timedelta(minutes=2), timedelta(hours=1), bucket, workers=args.workers)
+
+        statuses = dict(db.session.execute(
+            db.select(Contribution.status, db.func.count()).group_by(Contribution.status)).all())
+        db.session.refresh(event)
+        ledger = db.session.scalar(db.select(db.func.count(LedgerEntry.id)).where(LedgerEntry.event_id == event.id))
+
+    throttled = server.counts.get('stkpushquery_throttled', 0)
+    print(f"backlog {report['backlog']:,}: {report['completed']} completed, {report['failed']} failed, "
+          f"{report['expired']} expired, {report['unresolved']} unresolved in {elapsed:.1f}s "
+          f"({report['resolved_per_sec']:,.0f} resolved/s, {queries / elapsed:,.1f} queries/s, {throttled} throttled)")
+    print(f"second run: checked {second['checked']}, remaining {second['remaining']}")
+    print(f"statuses {statuses}; total {event.current_amount} expected {paid_amount}; "
+          f"count {event.contribution_count}; ledger entries {ledger}; "
+          f"late callback {'counted again' if late_settled else 'skipped'}")
+
+    ok = (
+        report['completed'] == expected['completed'] - 1
+        and report['failed'] == expected['failed']
+        and report['expired'] == expected['expired']
+        and statuses.get('completed') == expected['completed']
+        and statuses.get('pending') == 5
+        and event.current_amount == paid_amount
+        and event.contribution_count == expected['completed'] == ledger
+        and second['checked'] == 0
+        and throttled == 0
+        and not late_settled
+    )
+    os.unlink(db_file.name)
+    server.shutdown()
+    print('OK' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Load test the SSE progress feed: many subscribers, one callback, one broadcast.
+
+Starts the app on a threaded local server with a throwaway SQLite database,
+opens --subscribers streams to /api/event/<id>/stream, then delivers one
+payment callback. It reports how quickly every subscriber saw the new total,
+and how many SQL queries the broadcast cost.
+
+Usage:
+  python scripts/load_sse.py --subscribers 500
+"""
+import os
+import sys
+import argparse
+import json
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stress_callbacks import callback_payload
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--subscribers', type=int, default=200)
+    p.add_argument('--timeout', type=float, default=30)
+    args = p.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ.update({'DATABASE_URL': f'sqlite:///{db_file.name}', 'LIVE_STREAMS': '1'})
+
+    from sqlalchemy import event as sa_event
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from app import create_app, db
+    from app.models import User, Event, Contribution
+    from app.live import hub
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        admin = User(username='sse-load', password_hash='x')
+        db.session.add(admin)
+        db.session.flush()
+        event = Event(admin_id=admin.id, title='Load', description='SSE load test',
+                      organizer_name='Load', organizer_phone='254712345678', target_amount=10000)
+        db.session.add(event)
+        db.session.flush()
+        db.session.add(Contribution(event_id=event.id, contributor_name='Load', contributor_phone='254712345678',
+                                    amount=500, transaction_id='ws_CO_load'))
+        db.session.commit()
+        event_id = event.id
+        queries = [0]
+        sa_event.listen(db.engine, 'before_cursor_execute', lambda *a: queries.__setitem__(0, queries[0] + 1))
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    received = []
+    lock = threading.Lock()
+    sent_at = [None]
+
+    def subscribe():
+        with requests.get(f'{base_url}/api/event/{event_id}/stream', stream=True, timeout=args.timeout) as response:
+            for line in response.iter_lines():
+                if line.startswith(b'data: ') and json.loads(line[6:])['current_amount'] > 0:
+                    with lock:
+                        received.append(time.perf_counter() - sent_at[0])
+                    return
+
+    threads = [threading.Thread(target=subscribe, daemon=True) for _ in range(args.subscribers)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + args.timeout
+    while hub.stats()['subscribers'] < args.subscribers and time.monotonic() < deadline:
+        time.sleep(0.05)
+    print(f"{hub.stats()['subscribers']} subscribers connected")
+
+    queries[0] = 0
+    sent_at[0] = time.perf_counter()
+    response = requests.post(f'{base_url}/api/payment/callback',
+                             json=callback_payload('ws_CO_load', 500, 'RLOADTEST1'))
+    callback_queries = queries[0]
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+
+    print(f"callback: HTTP {response.status_code}, {callback_queries} SQL queries, "
+          f"{hub.stats()['published']} broadcast(s)")
+    if received:
+        print(f"delivered to {len(received)}/{args.subscribers} subscribers: "
+              f"p50 {percentile(received, 50) * 1000:.1f} ms, p99 {percentile(received, 99) * 1000:.1f} ms, "
+              f"max {max(received) * 1000:.1f} ms")
+    server.shutdown()
+    os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Local stub of the Safaricom Daraja API for development and benchmarks.
+
+Point the app at it with MPESA_BASE_URL, e.g.:
+  python scripts/mock_daraja.py --port 8089 --latency 0.05
+  MPESA_BASE_URL=http://127.0.0.1:8089 python run.py
+
+Endpoints:
+  GET  /oauth/v1/generate                 - returns a token with a configurable expires_in
+  POST /mpesa/stkpush/v1/processrequest   - accepts an STK Push request
+  POST /mpesa/stkpushquery/v1/query       - STK Push Query; the outcome is derived from the
+                                            CheckoutRequestID (see --paid/--cancelled/--processing)
+  GET  /stats                             - request counters
+"""
+import argparse
+import json
+import zlib
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockDarajaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Benchmarks open hundreds of connections at once
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0, token_ttl=3599, paid=0.6, cancelled=0.2, processing=0.1,
+                 query_rate=0):
+        super().__init__(address, MockDarajaHandler)
+        self.latency = latency
+        self.token_ttl = token_ttl
+        # STK Push Query outcome shares; the rest time out (ResultCode 1037)
+        self.paid = paid
+        self.cancelled = cancelled
+        self.processing = processing
+        # Queries per second before answering 429, like Daraja's spike arrest (0 = unlimited)
+        self.query_rate = query_rate
+        self.query_window = (0, 0)
+        # Fixed outcomes for specific CheckoutRequestIDs: {checkout_id: result code or None for processing}
+        self.outcomes = {}
+        self.counts = {}
+        # STK pushes currently being answered
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def query_outcome(self, checkout_id):
+        """ResultCode for a CheckoutRequestID, or None while it is still processing"""
+        if checkout_id in self.outcomes:
+            return self.outcomes[checkout_id]
+        share = zlib.crc32(checkout_id.encode()) / 0xFFFFFFFF
+        if share < self.paid:
+            return 0
+        if share < self.paid + self.cancelled:
+            return 1032
+        if share < self.paid + self.cancelled + self.processing:
+            return None
+        return 1037
+
+    def over_query_rate(self):
+        if not self.query_rate:
+            return False
+        with self.lock:
+            second = int(time.time())
+            start, count = self.query_window
+            if start != second:
+                start, count = second, 0
+            self.query_window = (start, count + 1)
+            return count + 1 > self.query_rate
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+class MockDarajaHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; avoid Nagle/delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def do_GET(self):
+        if self.path.startswith('/oauth/v1/generate'):
+            self.server.count('oauth')
+            time.sleep(self.server.latency)
+            if not self.headers.get('Authorization', '').startswith('Basic '):
+                return self._send_json(400, {'errorMessage': 'Invalid Authentication passed'})
+            return self._send_json(200, {
+                'access_token': uuid.uuid4().hex,
+                'expires_in': str(self.server.token_ttl)
+            })
+        if self.path == '/stats':
+            with self.server.lock:
+                return self._send_json(200, dict(self.server.counts))
+        self._send_json(404, {'errorMessage': 'Not found'})
+
+    def do_POST(self):
+        payload = self._read_json()
+        if self.path == '/mpesa/stkpush/v1/processrequest':
+            self.server.count('stkpush')
+            with self.server.lock:
+                self.server.in_flight += 1
+            time.sleep(self.server.latency)
+            with self.server.lock:
+                self.server.in_flight -= 1
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                return self._send_json(401, {'errorMessage': 'Invalid Access Token'})
+            return self._send_json(200, {
+                'MerchantRequestID': uuid.uuid4().hex[:20],
+                'CheckoutRequestID': f'ws_CO_{uuid.uuid4().hex[:24]}',
+                'ResponseCode': '0',
+                'ResponseDescription': 'Success. Request accepted for processing',
+                'CustomerMessage': 'Success. Request accepted for processing'
+            })
+        if self.path == '/mpesa/stkpushquery/v1/query':
+            self.server.count('stkpushquery')
+            time.sleep(self.server.latency)
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                return self._send_json(401, {'errorMessage': 'Invalid Access Token'})
+            if self.server.over_query_rate():
+                self.server.count('stkpushquery_throttled')
+                return self._send_json(429, {'errorCode': '429.001.01', 'errorMessage': 'Spike arrest violation'})
+            checkout_id = payload.get('CheckoutRequestID', '')
+            code = self.server.query_outcome(checkout_id)
+            if code is None:
+                return self._send_json(500, {
+                    'requestId': uuid.uuid4().hex[:20],
+                    'errorCode': '500.001.1001',
+                    'errorMessage': 'The transaction is being processed'
+                })
+            descriptions = {0: 'The service request is processed successfully.',
+                            1032: 'Request cancelled by user', 1037: 'DS timeout user cannot be reached'}
+            return self._send_json(200, {
+                'ResponseCode': '0',
+                'ResponseDescription': 'The service request has been accepted successsfully',
+                'MerchantRequestID': uuid.uuid4().hex[:20],
+                'CheckoutRequestID': checkout_id,
+                'ResultCode': str(code),
+                'ResultDesc': descriptions.get(code, 'Failed')
+            })
+        self._send_json(404, {'errorMessage': 'Not found'})
+
+
+def start_server(host='127.0.0.1', port=0, **kwargs):
+    """Start the stub in a background thread and return the server"""
+    server = MockDarajaServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8089)
+    p.add_argument('--latency', type=float, default=0.0, help='Seconds to sleep per request')
+    p.add_argument('--token-ttl', type=int, default=3599, help='expires_in returned by the OAuth endpoint')
+    p.add_argument('--paid', type=float, default=0.6, help='Share of STK queries answered as paid')
+    p.add_argument('--cancelled', type=float, default=0.2, help='Share answered as cancelled (1032)')
+    p.add_argument('--processing', type=float, default=0.1, help='Share still processing; the rest time out (1037)')
+    p.add_argument('--query-rate', type=int, default=0, help='STK queries per second before 429 (0 = unlimited)')
+    args = p.parse_args()
+
+    server = MockDarajaServer((args.host, args.port), latency=args.latency, token_ttl=args.token_ttl,
+                              paid=args.paid, cancelled=args.cancelled, processing=args.processing,
+                              query_rate=args.query_rate)
+    print(f'Mock Daraja listening on {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
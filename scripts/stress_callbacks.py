@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Fire many M-Pesa callbacks in parallel and check the event total is exact.
+
+Runs against a throwaway SQLite file by default, or any database given with
+--database-url (e.g. a local Postgres). The tables are created in that
+database and the seeded rows are left behind, so point it at a scratch DB.
+
+Usage:
+  python scripts/stress_callbacks.py --callbacks 500 --threads 32
+  python scripts/stress_callbacks.py --deliveries 3   # Safaricom-style retries
+  python scripts/stress_callbacks.py --database-url postgresql://localhost/stress_db
+"""
+import os
+import sys
+import argparse
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def callback_payload(checkout_id, amount, receipt):
+    return {
+        'Body': {
+            'stkCallback': {
+                'MerchantRequestID': uuid.uuid4().hex[:20],
+                'CheckoutRequestID': checkout_id,
+                'ResultCode': 0,
+                'ResultDesc': 'The service request is processed successfully.',
+                'CallbackMetadata': {
+                    'Item': [
+                        {'Name': 'Amount', 'Value': amount},
+                        {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+                        {'Name': 'TransactionDate', 'Value': 20250101120000},
+                        {'Name': 'PhoneNumber', 'Value': 254712345678},
+                    ]
+                }
+            }
+        }
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--callbacks', type=int, default=300)
+    p.add_argument('--threads', type=int, default=16)
+    p.add_argument('--deliveries', type=int, default=1, help='Times each callback is delivered')
+    p.add_argument('--database-url', help='Defaults to a temporary SQLite file')
+    args = p.parse_args()
+
+    db_file = None
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_file.name}'
+
+    from app import create_app, db
+    from app.models import User, Event, Contribution, PaymentCallback
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        admin = User(username=f'stress-{uuid.uuid4().hex[:8]}')
+        admin.set_password('stress')
+        db.session.add(admin)
+        db.session.flush()
+        event = Event(admin_id=admin.id, title='Stress', description='Stress test',
+                      organizer_name='Stress', organizer_phone='254712345678', target_amount=1e9)
+        db.session.add(event)
+        db.session.flush()
+        event_id = event.id
+
+        payloads = []
+        expected = 0
+        for i in range(args.callbacks):
+            amount = (i % 50) + 1
+            checkout_id = f'ws_CO_{uuid.uuid4().hex[:24]}'
+            db.session.add(Contribution(event_id=event_id, contributor_name=f'C{i}',
+                                        contributor_phone='254712345678', amount=amount,
+                                        transaction_id=checkout_id))
+            payloads.append(callback_payload(checkout_id, amount, f'R{uuid.uuid4().hex[:10].upper()}'))
+            expected += amount
+        db.session.commit()
+
+    def deliver(payload):
+        with app.test_client() as client:
+            return client.post('/api/payment/callback', json=payload).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        statuses = list(pool.map(deliver, payloads * args.deliveries))
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        total = db.session.get(Event, event_id).current_amount
+        completed = Contribution.query.filter_by(event_id=event_id, status='completed').count()
+        stored = PaymentCallback.query.filter(
+            PaymentCallback.contribution_id.in_(
+                db.select(Contribution.id).where(Contribution.event_id == event_id)
+            )
+        ).count()
+
+    errors = len([s for s in statuses if s != 200])
+    delivered = len(payloads) * args.deliveries
+    print(f"{delivered} deliveries on {args.threads} threads in {elapsed:.2f}s "
+          f"({delivered / elapsed:.0f}/s), {errors} non-200 responses")
+    print(f"completed contributions: {completed}/{args.callbacks}, stored callbacks: {stored}")
+    print(f"event total: {total:,.2f}, expected: {expected:,.2f}, lost: {expected - total:,.2f}")
+
+    if db_file:
+        os.unlink(db_file.name)
+    sys.exit(0 if total == expected and stored == args.callbacks and not errors else 1)
+
+
+if __name__ == '__main__':
+    main()